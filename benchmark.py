@@ -0,0 +1,526 @@
+"""
+Comechi的性能基准
+为各平台生成格式与真实评论文件一致的模拟评论，逐一转换并统计各处理阶段的吞吐量与峰值内存，再与保存的基准数据对比
+ニコニコチャンネルプラス/Openrec的接口数据由本地的stub服务器提供，下载阶段包含真实的分段请求与json解析，不会访问外部网络
+
+用例:
+    benchmark.py                                  # 全部平台，各10000条评论
+    benchmark.py -p n y -n 10000 100000 1000000   # 指定平台与评论数
+    benchmark.py --save_baseline                  # 将本次结果保存为基准
+    benchmark.py --timestamps 1000000             # 对比评论时间的解析与strptime
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import bisect
+import datetime
+import argparse
+import tempfile
+import contextlib
+import dataclasses
+import subprocess
+from xml.sax.saxutils import escape, quoteattr
+
+script_path = os.path.split(os.path.realpath(__file__))[0]
+sys.path.insert(0, script_path)
+
+import comechi
+from stub_server import StubServer
+
+WORDS = ['草', 'www', 'かわいい', 'きたああああ', '8888888', 'うおおおおおおおおおおおおお', 'おつ', 'すごい！', 'いいね',
+         'ｗｗｗｗｗｗｗｗｗｗｗｗｗｗｗｗｗｗｗｗ', 'hello world']
+NCV_MAILS = ['', '', '184', '184 red', 'shita', 'big', 'small #ff00aa', 'mincho blue2', 'gothic white']
+OFFICIAL_MESSAGES = ['お知らせです', '/perm 告知：次回は来週', '長いお知らせ' * 5,
+                     '<a href="https://example.com/watch/sm9"><u>動画はこちら</u></a>']
+
+BASE_TIME = datetime.datetime(2022, 5, 1, 19, 0, 0)
+
+
+@dataclasses.dataclass(frozen=True)
+class GeneratorParams:
+    count: int  # 评论数
+    burst: float = 0.3  # 评论处于弹幕高峰、紧跟着上一条出现的概率
+    official_rate: float = 0.005  # 运营评论所占比例
+    vote_cnt: int = 3  # 投票数（ニコニコ生放送/ニコニコチャンネルプラス）
+    comment_art_cnt: int = 10  # CommentArt数（ニコニコ生放送）
+    seed: int = 1
+
+
+def comment_times(rng, params):
+    """
+    :return: 各条评论的出现时间(0.01s)，已按时间排序
+    """
+    t = 0
+    times = []
+    for _ in range(params.count):
+        t += rng.randint(0, 3) if rng.random() < params.burst else rng.randint(1, 20)
+        times.append(t)
+    return times
+
+
+def random_message(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+
+
+def event_times(rng, times, cnt):
+    """
+    :return: 在评论时间范围内均匀分布的cnt个时间点，用于投票与CommentArt
+    """
+    span = times[-1] if times else 0
+    return [round(span * (i + rng.random()) / cnt) for i in range(cnt)]
+
+
+def generate_ncv(directory, params, rng):
+    open_time = int(BASE_TIME.timestamp())
+    times = comment_times(rng, params)
+
+    rows = []
+    for i, t in enumerate(times):
+        attrs = f'thread="1" no="{i}" vpos="0" date="{open_time + t // 100}" date_usec="{t % 100 * 10000}"' \
+                f' user_id="u{rng.randint(0, params.count // 50)}"'
+        if rng.random() < params.official_rate:
+            message = rng.choice(OFFICIAL_MESSAGES)
+            attrs += ' premium="3"'
+        else:
+            message = random_message(rng)
+            mail = rng.choice(NCV_MAILS)
+            if mail:
+                attrs += f' mail={quoteattr(mail)}'
+            attrs += f' premium="{rng.choice(["1", "1", "24"])}"'
+        rows.append((t, f'<chat {attrs}>{escape(message)}</chat>'))
+
+    for k, t in enumerate(event_times(rng, times, params.vote_cnt)):
+        for dt, message in [(0, '/vote start 好きな色は？ 赤 青 "黄 色"'), (3000, '/vote showresult per 300 500 200'),
+                            (4000, '/vote stop')]:
+            rows.append((t + dt, f'<chat thread="1" no="v{k}{dt}" vpos="0" date="{open_time + (t + dt) // 100}" '
+                                 f'date_usec="0" user_id="op" premium="3">{escape(message)}</chat>'))
+
+    for k, t in enumerate(event_times(rng, times, params.comment_art_cnt)):
+        for part in range(3):
+            art = '\n'.join('■□■□' * rng.randint(1, 4) for _ in range(5))
+            rows.append((t + part * 10, f'<chat thread="1" no="a{k}{part}" vpos="0" '
+                                        f'date="{open_time + (t + part * 10) // 100}" date_usec="0" user_id="art" '
+                                        f'mail="{rng.choice(["ue", "red", "small", "big ue"])}">{escape(art)}</chat>'))
+
+    rows.sort(key=lambda r: r[0])
+    path = os.path.join(directory, 'ncv.xml')
+    with open(path, 'w', encoding='utf-8') as f_out:
+        f_out.write('<?xml version="1.0" encoding="utf-8"?>\n<NiconamaCommentViewer><LiveInfo>'
+                    f'<LiveTitle>benchmark</LiveTitle><OpenTime>{open_time}</OpenTime></LiveInfo><Chats>\n')
+        for _, row in rows:
+            f_out.write(row + '\n')
+        f_out.write('</Chats></NiconamaCommentViewer>\n')
+    return path
+
+
+def generate_youtube(directory, params, rng):
+    chats = []
+    for t in comment_times(rng, params):
+        c = {'message': random_message(rng) + rng.choice(['', '', ':smile:']), 'time_in_seconds': t / 100,
+             'author': {'name': f'user{rng.randint(0, params.count // 50)}', 'id': f'UC{rng.randint(0, 10 ** 9)}'}}
+        r = rng.random()
+        if r < params.official_rate:
+            c['author']['badges'] = [{'title': 'Owner'}]
+        elif r < 0.1:
+            c['author']['badges'] = [{'title': 'Member (1 year)'}]
+        chats.append(c)
+
+    path = os.path.join(directory, 'youtube.json')
+    with open(path, 'w', encoding='utf-8') as f_out:
+        json.dump(chats, f_out, ensure_ascii=False)
+    return path
+
+
+def generate_zaiko(directory, params, rng):
+    path = os.path.join(directory, 'zaiko.txt')
+    with open(path, 'w', encoding='utf-8') as f_out:
+        for t in comment_times(rng, params):
+            created_at = BASE_TIME + datetime.timedelta(seconds=t // 100)
+            if rng.random() < params.official_rate:
+                nickname = '(・D・)'
+            else:
+                nickname = f'z{rng.randint(0, params.count // 50)}'
+            data = {'text': random_message(rng), 'member': {'nickname': nickname, 'uuid': f'uuid-{rng.randint(0, 99)}'},
+                    'created_at': created_at.strftime('%Y-%m-%dT%H:%M:%S.000000Z')}
+            f_out.write('recv ' + json.dumps({'event': 'chat', 'data': json.dumps(data, ensure_ascii=False)},
+                                             ensure_ascii=False) + '\n')
+            if rng.random() < 0.05:
+                f_out.write('ping\n')
+
+    # 以第一条评论作为对齐时间的依据，放在视频开头
+    with open(comechi.anchor_path(path), 'w', encoding='utf-8') as f_anchor:
+        json.dump({'anchor_index': 0, 'offset': '0:00:00.00'}, f_anchor)
+    return path
+
+
+def generate_asobi(directory, params, rng):
+    def asobi_line(t, official):
+        c_time = BASE_TIME + datetime.timedelta(seconds=t / 100)
+        return json.dumps({'time': f"{c_time.strftime('%Y-%m-%d %H:%M:%S')}.{c_time.microsecond:06d}000",
+                           'data': {'comment': [random_message(rng), rng.choice(['', '', ':(emoji):'])],
+                                    'userName': f'a{rng.randint(0, params.count // 50)}',
+                                    'type': 'official/send-comment' if official else 'user/send-comment'}},
+                          ensure_ascii=False)
+
+    path = os.path.join(directory, 'asobi.jsonl')
+    with open(path, 'w', encoding='utf-8') as f_out:
+        for t in comment_times(rng, params):
+            f_out.write(asobi_line(t, rng.random() < params.official_rate) + '\n')
+            if rng.random() < 0.02:
+                f_out.write('{"type":"ping"}\n')
+
+    with open(comechi.anchor_path(path), 'w', encoding='utf-8') as f_anchor:
+        json.dump({'anchor_time': f"{BASE_TIME.strftime('%Y-%m-%d %H:%M:%S')}.000000000", 'offset': '0:00:00.00'},
+                  f_anchor)
+    return path
+
+
+class NchpApi:
+    """
+    ニコニコチャンネルプラス接口的stub，评论按older_than从新到旧分段返回
+    """
+    source = 'https://nicochannel.jp/benchmark/live/benchmark'
+
+    def __init__(self, video_pages, comments, operator_broadcasts_list):
+        """
+        :param comments: 按时间排序的评论
+        """
+        self.video_pages = video_pages
+        self.comments = comments
+        self.created_at = [c['created_at'] for c in comments]
+        self.operator_broadcasts_list = operator_broadcasts_list
+
+    def api_urls(self, url):
+        """
+        :param url: stub服务器的地址
+        :return: 需要替换的comechi中的接口地址
+        """
+        return {'NCHP_API': f'{url}/fc', 'SHEETA_API': url}
+
+    def route(self, method, path, query, body):
+        if path == '/fc/video_pages/benchmark/comments_user_token':
+            return 200, {'data': {'access_token': 'benchmark'}}
+        if path == '/fc/video_pages/benchmark':
+            return 200, self.video_pages
+        if path == '/messages.history':
+            end = bisect.bisect_left(self.created_at, query['older_than'][0]) if 'older_than' in query \
+                else len(self.comments)
+            return 200, self.comments[max(0, end - int(query['limit'][0])):end][::-1]
+        if path == '/groups.operator-broadcasts.list':
+            return 200, self.operator_broadcasts_list
+        return 404, {}
+
+
+class OpenrecApi:
+    """
+    Openrec接口的stub，从from_created_at开始每页返回page_size条评论
+    """
+    source = 'https://www.openrec.tv/live/benchmark'
+
+    def __init__(self, page, chats, page_size=100):
+        """
+        :param chats: 按时间排序的评论
+        """
+        self.page = page
+        self.chats = chats
+        self.posted_at = [c['posted_at'] for c in chats]
+        self.page_size = page_size
+
+    def api_urls(self, url):
+        return {'OPENREC_API': url}
+
+    def route(self, method, path, query, body):
+        if path == '/movies/benchmark':
+            return 200, self.page
+        if path == '/movies/benchmark/chats':
+            # from_created_at为UTC+0，评论时间为UTC+9
+            time_from = datetime.datetime.strptime(query['from_created_at'][0], '%Y-%m-%dT%H:%M:%S.000Z')
+            start = bisect.bisect_left(self.posted_at,
+                                       (time_from + datetime.timedelta(hours=9)).strftime('%Y-%m-%dT%H:%M:%S+09:00'))
+            return 200, self.chats[start:start + self.page_size]
+        return 404, {}
+
+
+def generate_nchp(directory, params, rng):
+    def iso(t):
+        return (BASE_TIME + datetime.timedelta(seconds=t / 100)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    times = comment_times(rng, params)
+    comments = []
+    for i, t in enumerate(times):
+        c = {'id': f'id{i}', 'created_at': iso(t), 'message': random_message(rng),
+             'nickname': rng.choice(['ゲスト', f'n{rng.randint(0, params.count // 50)}'])}
+        if rng.random() < params.official_rate:
+            c['priority'] = 1
+            c['nickname'] = '公式'
+            c['message'] = rng.choice(OFFICIAL_MESSAGES[:3])
+        comments.append(c)
+
+    operator_broadcasts_list = []
+    for k, t in enumerate(event_times(rng, times, params.vote_cnt)):
+        options = [{'id': 10 + j, 'text': f'選択肢{j}'} for j in range(3)]
+        results = [{'id': 10 + j, 'percentage': 100 / 3, 'count_video_questionnaire_user_answers': 10} for j in range(3)]
+        for dt, c_type in [(0, 'questionnaire_post_questions'), (2000, 'questionnaire_result'),
+                           (4000, 'questionnaire_hide_result')]:
+            payload = {'type': c_type, 'video_questionnaire_id': k, 'question': f'質問{k}',
+                       'video_questionnaire_options': options, 'video_questionnaire_results': results}
+            operator_broadcasts_list.append({'created_at': iso(t + dt), 'type': 'questionnaire', 'payload': payload})
+
+    video_pages = {'data': {'video_page': {'title': 'benchmark',
+                                           'live_started_at': BASE_TIME.strftime('%Y-%m-%d %H:%M:%S'),
+                                           'live_finished_at': (BASE_TIME + datetime.timedelta(
+                                               seconds=times[-1] // 100 + 1)).strftime('%Y-%m-%d %H:%M:%S'),
+                                           'video_comment_setting': {'comment_group_id': 'benchmark'},
+                                           'video_aggregate_info': {'number_of_comments': len(comments)},
+                                           'video_questionnaires': []}}}
+    return NchpApi(video_pages, comments, operator_broadcasts_list)
+
+
+def generate_openrec(directory, params, rng):
+    def jst(t):
+        return (BASE_TIME + datetime.timedelta(seconds=t // 100)).strftime('%Y-%m-%dT%H:%M:%S+09:00')
+
+    times = comment_times(rng, params)
+    chats = []
+    for i, t in enumerate(times):
+        chats.append({'id': i, 'posted_at': jst(t), 'message': random_message(rng),
+                      'user': {'nickname': f'o{rng.randint(0, params.count // 50)}',
+                               'is_official': rng.random() < params.official_rate, 'icon_image_url': 'x' * 60}})
+
+    page = {'title': 'benchmark', 'created_at': jst(0), 'started_at': jst(0), 'ended_at': jst(times[-1] + 100)}
+    return OpenrecApi(page, chats)
+
+
+GENERATORS = {'a': generate_asobi, 'n': generate_ncv, 'nchp': generate_nchp, 'o': generate_openrec,
+              'y': generate_youtube, 'z': generate_zaiko}
+
+
+def run_case(platform, source, cache_dir, api_urls=None):
+    """
+    在当前进程中转换一次，由子进程调用，使峰值内存不受其他用例影响
+    Zaiko/ASOBISTAGE使用生成评论时写入的锚点文件对齐时间，不需要输入
+    :param api_urls: 指向stub服务器的接口地址(ニコニコチャンネルプラス/Openrec)
+    :return: 各处理阶段的统计
+    """
+    for name, url in (api_urls or {}).items():
+        setattr(comechi, name, url)
+
+    profiler = comechi.StageProfiler()
+    options = comechi.RenderOptions(max_row_cnt=11, cache_dir=cache_dir, profiler=profiler)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        cmt = comechi.render(source, platform, options=options)
+        with open(os.devnull, 'w', encoding='utf_8_sig') as f_out:
+            cmt.write_ass(f_out)
+
+    return profiler.stages
+
+
+def benchmark(platform, params):
+    """
+    生成模拟评论并在子进程中转换
+    ニコニコチャンネルプラス/Openrec的评论由当前进程中的stub服务器提供，子进程从空的缓存目录开始下载
+    :return: {'platform', 'count', 'stages'}
+    """
+    with tempfile.TemporaryDirectory() as directory, contextlib.ExitStack() as stack:
+        source = GENERATORS[platform](directory, params, random.Random(params.seed))
+        case = {'platform': platform, 'source': source, 'cache_dir': os.path.join(directory, 'cache')}
+        if isinstance(source, (NchpApi, OpenrecApi)):
+            stub = stack.enter_context(StubServer(source.route))
+            case.update(source=source.source, api_urls=source.api_urls(stub.url))
+        # stdin为空，需要输入时直接报错而不是卡住；Openrec的断点记录写在临时目录中
+        proc = subprocess.run([sys.executable, os.path.realpath(__file__), '--case', json.dumps(case)],
+                              stdin=subprocess.DEVNULL, capture_output=True, text=True, encoding='utf-8',
+                              cwd=directory)
+    if proc.returncode:
+        raise RuntimeError(f'{platform} {params.count}: {proc.stderr.strip()}')
+
+    return {'platform': platform, 'count': params.count, 'stages': json.loads(proc.stdout)}
+
+
+def strptime_nchp(text):
+    return round(datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%fZ').timestamp() * 100)
+
+
+def strptime_asobi(text):
+    return round(datetime.datetime.strptime(text[:19], '%Y-%m-%d %H:%M:%S').timestamp() * 100 + (int(text[20:23]) / 10))
+
+
+OPENREC_START = BASE_TIME.strftime('%Y-%m-%dT%H:%M:%S+09:00')
+
+
+def strptime_openrec(text):
+    # 每条评论都重新解析直播开始时间
+    time_start = datetime.datetime.strptime(OPENREC_START, '%Y-%m-%dT%H:%M:%S+09:00')
+    return int((datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S+09:00') - time_start).total_seconds() * 100)
+
+
+# 直播开始时间只解析一次
+OPENREC_START_SECONDS = comechi.naive_seconds(OPENREC_START)
+
+
+def fixed_openrec(text):
+    return comechi.openrec_time_to_vpos(text, OPENREC_START_SECONDS)
+
+
+# 评论时间的格式 -> (生成评论时间的函数, 使用strptime的解析, comechi中的解析)
+TIMESTAMP_CASES = {
+    'nchp': (lambda t: t.strftime('%Y-%m-%dT%H:%M:%S.') + f'{t.microsecond // 1000:03d}Z',
+             strptime_nchp, comechi.nchp_time_to_vpos),
+    'a': (lambda t: t.strftime('%Y-%m-%d %H:%M:%S.') + f'{t.microsecond:06d}000',
+          strptime_asobi, comechi.asobi_time_to_vpos),
+    'o': (lambda t: t.strftime('%Y-%m-%dT%H:%M:%S+09:00'), strptime_openrec, fixed_openrec),
+}
+
+
+def benchmark_timestamps(count, params):
+    """
+    对比评论时间的解析与strptime的用时，并确认两者的结果一致
+    :param count: 各格式的评论时间数
+    :return: [{'platform', 'count', 'strptime', 'fixed'}]，用时的单位为秒
+    """
+    times = comment_times(random.Random(params.seed), dataclasses.replace(params, count=count))
+    results = []
+    for platform, (make, parse_strptime, parse_fixed) in TIMESTAMP_CASES.items():
+        samples = [make(BASE_TIME + datetime.timedelta(milliseconds=t * 10)) for t in times]
+
+        t_start = time.perf_counter()
+        expected = [parse_strptime(s) for s in samples]
+        t_strptime = time.perf_counter() - t_start
+
+        comechi.local_timestamp.cache_clear()
+        comechi.date_ordinal.cache_clear()
+        t_start = time.perf_counter()
+        got = [parse_fixed(s) for s in samples]
+        t_fixed = time.perf_counter() - t_start
+
+        if got != expected:
+            raise RuntimeError(f'{platform}: 解析结果与strptime不一致')
+        results.append({'platform': platform, 'count': count, 'strptime': t_strptime, 'fixed': t_fixed})
+    return results
+
+
+def print_timestamp_results(results):
+    print(f"{'平台':<8}{'条数':>7}{'strptime(s)':>13}{'固定格式(s)':>9}{'加速':>6}")
+    for r in results:
+        print(f"{r['platform']:<10}{r['count']:>9}{r['strptime']:>13.3f}{r['fixed']:>13.3f}"
+              f"{r['strptime'] / r['fixed']:>7.1f}x")
+
+
+def print_results(results, baseline, threshold):
+    """
+    :return: 用时超出基准threshold以上的阶段
+    """
+    regressions = []
+    # 表头中的汉字显示宽度为2
+    print(f"{'平台':<8}{'评论数':>6}  {'阶段':<42}{'用时(s)':>7}{'条/s':>12}{'累计峰值(MB)':>9}{'峰值增长(MB)':>9}"
+          f"{'对比基准':>6}")
+    for r in results:
+        platform = r['platform']
+        for stage in r['stages']:
+            name = '  ' * stage['depth'] + stage['stage']
+            wall = stage['wall']
+            count = stage['count']
+            throughput = f"{count / wall:.0f}" if count and wall > 1e-3 else '-'
+            peak_rss = '-' if stage['peak_rss_mb'] is None else f"{stage['peak_rss_mb']:.1f}"
+            growth = '-' if stage['peak_rss_growth_mb'] is None else f"{stage['peak_rss_growth_mb']:.1f}"
+
+            compare = ''
+            base = baseline.get(f"{r['platform']}/{r['count']}", {}).get(stage['stage'])
+            if base and base['wall'] > 1e-2:
+                ratio = wall / base['wall'] - 1
+                compare = f'{ratio:+.0%}'
+                if ratio > threshold:
+                    compare += ' !'
+                    regressions.append(f"{platform} {r['count']} {stage['stage']} {compare}")
+
+            print(f"{platform:<10}{r['count']:>9}  {name:<44}{wall:>9.3f}{throughput:>12}{peak_rss:>13}{growth:>13}"
+                  f"{compare:>10}")
+        print()
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-p', '--platform', type=str, nargs='+', default=list(GENERATORS), choices=list(GENERATORS),
+                        help='测试的平台，简称与comechi.py相同 [默认为全部]')
+    parser.add_argument('-n', '--count', type=int, nargs='+', default=[10000], help='评论数，可指定多个 [默认为10000]')
+    parser.add_argument('--burst', type=float, default=0.3, help='评论处于弹幕高峰的概率 [默认为0.3]')
+    parser.add_argument('--official_rate', type=float, default=0.005, help='运营评论所占比例 [默认为0.005]')
+    parser.add_argument('--vote_cnt', type=int, default=3, help='投票数 [默认为3]')
+    parser.add_argument('--comment_art_cnt', type=int, default=10, help='CommentArt数 [默认为10]')
+    parser.add_argument('--seed', type=int, default=1, help='随机数种子 [默认为1]')
+    parser.add_argument('--baseline', type=str, default=os.path.join(script_path, 'benchmark_baseline.json'),
+                        help='基准数据文件 [默认为脚本所在目录的benchmark_baseline.json]')
+    parser.add_argument('--save_baseline', action='store_true', help='将本次结果保存为基准 [默认为否]')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='用时超出基准的比例大于该值时视为性能下降，以非0状态退出 [默认为0.2]')
+    parser.add_argument('--timestamps', type=int, metavar='COUNT',
+                        help='只对比评论时间的解析与strptime的用时，指定各格式的评论时间数')
+    parser.add_argument('--case', type=str, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.case:
+        case = json.loads(args.case)
+        print(json.dumps(run_case(**case)))
+        return
+
+    if args.timestamps:
+        params = GeneratorParams(args.timestamps, args.burst, seed=args.seed)
+        print_timestamp_results(benchmark_timestamps(args.timestamps, params))
+        return
+
+    results = []
+    for count in args.count:
+        params = GeneratorParams(count, args.burst, args.official_rate, args.vote_cnt, args.comment_art_cnt, args.seed)
+        for platform in args.platform:
+            print(f'{comechi.PLATFORMS[platform]} {count}...', file=sys.stderr)
+            results.append(benchmark(platform, params))
+
+    params = dataclasses.asdict(GeneratorParams(0, args.burst, args.official_rate, args.vote_cnt,
+                                                args.comment_art_cnt, args.seed))
+    del params['count']
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f_baseline:
+            saved = json.load(f_baseline)
+        if saved['params'] == params:
+            baseline = saved['results']
+        else:
+            print(f'基准数据的生成参数与本次不同，不进行对比: {saved["params"]}', file=sys.stderr)
+    elif not args.save_baseline:
+        print(f'没有基准数据，不进行对比，可以用--save_baseline在本机生成: {args.baseline}', file=sys.stderr)
+
+    regressions = print_results(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        saved = {'params': params, 'results': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r', encoding='utf-8') as f_baseline:
+                old = json.load(f_baseline)
+            if old['params'] == params:
+                saved['results'] = old['results']
+        for r in results:
+            saved['results'][f"{r['platform']}/{r['count']}"] = {
+                s['stage']: {'wall': s['wall'], 'peak_rss_mb': s['peak_rss_mb'],
+                             'peak_rss_growth_mb': s['peak_rss_growth_mb']} for s in r['stages']}
+        with open(args.baseline, 'w', encoding='utf-8') as f_baseline:
+            json.dump(saved, f_baseline, ensure_ascii=False, indent=2)
+        print(f'已保存基准: {args.baseline}')
+
+    if regressions:
+        print('性能下降:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
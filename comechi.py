@@ -1,16 +1,204 @@
+import io
+import sys
 import os
 import re
 import json
+import glob
+import gzip
 import math
 import time
 import datetime
-from copy import deepcopy
-import xml.dom.minidom
-import requests
+import dataclasses
+import bisect
+import functools
+import importlib.util
 import argparse
+import contextlib
+import threading
+import types
 from collections import Counter
 
+# numpy为可选依赖，导入较慢，只在计算弹幕布局时才导入
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+script_path = os.path.split(os.path.realpath(__file__))[0]
+
+OPENREC_API = 'https://public.openrec.tv/external/api/v5'
+NCHP_API = 'https://nfc-api.nicochannel.jp/fc'
+# ニコニコチャンネルプラス的评论接口
+SHEETA_API = 'https://comm-api.sheeta.com'
+
+# 命令行参数中的平台简称
+PLATFORMS = {'a': 'ASOBISTAGE', 'n': 'ニコニコ生放送', 'nchp': 'ニコニコチャンネルプラス', 'o': 'Openrec', 'y': 'YouTube',
+             'z': 'Zaiko'}
+
+# 逐行读取评论日志时使用的json解析，安装了orjson时使用更快的orjson
+fast_json_loads = orjson.loads if orjson else json.loads
+
+# 对每条评论都会用到的正则表达式，预先编译
+NG_PATTERN = re.compile('(NGコメントです)')
+# ニコニコ生放送中不作为弹幕显示的系统命令
+NICO_SYSTEM_COMMAND_PATTERN = re.compile(
+    '(/trialpanel|/nicoad|/info|/disconnect|/play |/commentlock|/gift|/jump|/redirect|/spi)')
+# ニコニコ生放送中运营的premium
+NICO_OFFICIAL_PREMIUM_PATTERN = re.compile('([37])')
+# 非会员的premium
+NON_MEMBER_PREMIUM_PATTERN = re.compile('(24|25)')
+STILL_COMMAND_PATTERN = re.compile(r'(\bue|\bshita)')
+COLOR_CODE_PATTERN = re.compile('#.{6}')
+YOUTUBE_EMOJI_PATTERN = re.compile(r':\w+?:')
+ASOBI_EMOJI_PATTERN = re.compile(r':\(.*\)?:')
+# 对齐评论时间时输入的时间
+VIDEO_TIME_PATTERN = re.compile(r'\d{1,2}:\d{2}:\d{2}.\d{2,3}')
+ASOBI_TIME_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}.\d{9}')
+
+
+def create_session(headers, pool_size=10, retry=True):
+    """
+    创建复用连接的requests.Session，可以用with语句确保关闭
+    :param headers: 每个请求都会带上的headers
+    :param pool_size: 连接池大小，不应小于同时发出请求的线程数
+    :param retry: 遇到限流或服务器错误时自动重试，由request_json负责重试时应为False，避免两层重试叠加
+    """
+    # 只有下载评论时才需要requests，不在启动时导入
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.headers.update(headers)
+
+    max_retries = Retry(total=5, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504)) if retry else 0
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+async def request_json(session, method, url, max_attempts=5, **kwargs):
+    """
+    在线程中发出请求并解析返回的json，连接失败、限流或服务器错误时等待一段时间后重试
+    对包括POST在内的所有请求都进行重试，session应使用create_session(retry=False)创建
+    :param session: create_session创建的Session
+    :param method: 'get'或'post'
+    :param max_attempts: 最多尝试的次数，每次重试前的等待时间翻倍
+    """
+    import asyncio
+    import requests
+
+    for attempt in range(max_attempts):
+        try:
+            # asyncio.to_thread需要Python 3.9
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(getattr(session, method), url, timeout=30, **kwargs))
+            response.raise_for_status()
+            return json.loads(response.text)
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            status = e.response.status_code if e.response is not None else None
+            if attempt == max_attempts - 1 or (status is not None and status not in (429, 500, 502, 503, 504)):
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+def nchp_video_page_url(content_code):
+    """
+    :param content_code: 直播链接中的content code
+    :return: ニコニコチャンネルプラス直播信息的url
+    """
+    return f'{NCHP_API}/video_pages/{content_code}'
+
+
+async def fetch_nchp_page(session, content_code):
+    """
+    同时获取ニコニコチャンネルプラス的直播信息与获取评论用的token
+    :param session: create_session(retry=False)创建的Session
+    :param content_code: 直播链接中的content code
+    :return: (video_pages, 获取评论时提交的json)
+    """
+    import asyncio
+
+    url_page = nchp_video_page_url(content_code)
+    token, video_pages = await asyncio.gather(request_json(session, 'get', f'{url_page}/comments_user_token'),
+                                              request_json(session, 'get', url_page))
+
+    group_id = video_pages['data']['video_page']['video_comment_setting']['comment_group_id']
+    return video_pages, {'token': token['data']['access_token'], 'group_id': group_id}
+
+
+async def fetch_nchp(content_code, headers, chunk_size=1000):
+    """
+    获取ニコニコチャンネルプラス的直播信息与评论，互不依赖的请求同时发出
+    评论从新到旧分段获取，每段都包含上一段中最早的时刻，同一时刻的评论跨越两段时也不会遗漏（重复的评论按id去除）
+    第二段中出现了比分段终点更晚的评论时说明接口不支持分段，改为一次获取全部评论
+    :param content_code: 直播链接中的content code
+    :param headers: 请求使用的headers
+    :param chunk_size: 每次获取的评论数
+    :return: (video_pages, 评论列表, operator_broadcasts_list)
+    """
+    import asyncio
+
+    url_history = f'{SHEETA_API}/messages.history'
+
+    with create_session(headers, retry=False) as session:
+        video_pages, json_data = await fetch_nchp_page(session, content_code)
+
+        number_of_comments = video_pages['data']['video_page']['video_aggregate_info']['number_of_comments']
+
+        async def fetch_history():
+            comments = []
+            comments_id = set()
+            older_than = None
+            cursor_checked = False
+            while True:
+                url = f'{url_history}?limit={chunk_size}'
+                if older_than:
+                    url += f'&older_than={older_than}'
+                chunk = await request_json(session, 'post', url, json=json_data)
+
+                if older_than and not cursor_checked:
+                    cursor_checked = True
+                    if any(c['created_at'] >= older_than for c in chunk):
+                        # 接口忽略了older_than，第二段返回的仍是最新的评论
+                        if len(comments) < chunk_size:
+                            # 第一段已包含全部评论
+                            return comments
+                        # 按评论总数一次获取（在此期间可能有新评论，多获取500条）
+                        return await request_json(session, 'post',
+                                                  f'{url_history}?limit={number_of_comments + 500}', json=json_data)
+
+                new_comments = [c for c in chunk if c['id'] not in comments_id]
+                if not new_comments:
+                    oldest = min((c['created_at'] for c in chunk), default=None)
+                    if len(chunk) < chunk_size or oldest == older_than:
+                        return comments
+                    # 同一时刻的评论多于一段时无法再向前推进，跳过该时刻剩余的评论
+                    older_than = oldest
+                    continue
+                comments_id.update(c['id'] for c in new_comments)
+                comments += new_comments
+                # older_than不包含该时刻本身，推后一个单位，使下一段从这一段最早的时刻开始
+                older_than = nchp_time_after(min(c['created_at'] for c in new_comments))
+
+        comments, operator_broadcasts_list = await asyncio.gather(
+            fetch_history(),
+            request_json(session, 'post', f'{SHEETA_API}/groups.operator-broadcasts.list', json=json_data))
+
+    return video_pages, comments, operator_broadcasts_list
+
+
+# 背景的尺寸只有少数几种，相同尺寸的圆角矩形共用缓存结果
+# typed=True: 整数与浮点数格式化后的文本不同，不能共用
+@functools.lru_cache(maxsize=1024, typed=True)
 def draw_rounded_rectangle(width, height, r):
     bgw = width
     bgh = height
@@ -32,16 +220,22 @@ def color(rgba):
     return f"&H{a}{b}{g}{r}"
 
 
+# 将秒数转换成x:xx:xx，同一秒内的时间戳共用缓存结果
+@functools.lru_cache(maxsize=4096)
+def second_to_time(second):
+    m, s = divmod(second, 60)
+    h, m = divmod(m, 60)
+    return f'{h}:{m:02d}:{s:02d}'
+
+
+# ass文件时间中.xx的部分
+CENTISECONDS = tuple(f'.{ms:02d}' for ms in range(100))
+
+
 # 将时间戳(个位数为0.01s)转换成ass文件的时间(x:xx:xx.xx)
 def stamp_to_time(stamp):
-    h = stamp // 360000
-    re = stamp % 360000
-    m = re // 6000
-    re = re % 6000
-    s = re // 100
-    ms = re % 100
-    timehmsms = '{}:{}:{}.{}'.format(str(h), str(m).zfill(2), str(s).zfill(2), str(ms).zfill(2))
-    return timehmsms
+    s, ms = divmod(round(stamp), 100)
+    return second_to_time(s) + CENTISECONDS[ms]
 
 
 def time_to_stamp(t):
@@ -52,10 +246,102 @@ def time_to_stamp(t):
     return stamp
 
 
+def anchor_path(source):
+    """
+    :return: 评论文件旁记录对齐时间依据的锚点文件(json)，Zaiko与ASOBISTAGE不需要手动输入时使用
+    """
+    return f'{source}.anchor.json'
+
+
 def fix_invalid_file_name(file_name):
     return re.sub(r'[/\\:*?\"<>|]', '_', file_name)
 
 
+# 各平台评论时间的解析
+# 评论时间都以'YYYY-MM-DD HH:MM:SS'开头(日期与时间之间的分隔符不限)，按固定位置直接解析，不使用strptime
+
+def parse_local_time(text):
+    """
+    按固定位置解析时间，只读取到秒
+    """
+    return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                             int(text[11:13]), int(text[14:16]), int(text[17:19]))
+
+
+# 同一秒内的评论共用缓存结果
+@functools.lru_cache(maxsize=4096)
+def local_timestamp(text):
+    """
+    :param text: 精确到秒的本地时间
+    :return: Unix时间戳(秒)
+    """
+    return parse_local_time(text).timestamp()
+
+
+# 同一天内的评论共用缓存结果
+@functools.lru_cache(maxsize=1024)
+def date_ordinal(text):
+    return datetime.date(int(text[0:4]), int(text[5:7]), int(text[8:10])).toordinal()
+
+
+def naive_seconds(text):
+    """
+    :return: 不考虑时区与夏令时的秒数，只用于计算同一时区内两个时间的差
+    """
+    return date_ordinal(text[:10]) * 86400 + int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])
+
+
+def nchp_time_to_vpos(time_nchp):
+    """
+    :param time_nchp: 如'2022-05-01T10:00:01.300Z'
+    :return: 时间戳(0.01s)，与按本地时间解析'%Y-%m-%dT%H:%M:%S.%fZ'的结果一致
+    """
+    microsecond = int(time_nchp[20:-1].ljust(6, '0')[:6])
+    return round((local_timestamp(time_nchp[:19]) + microsecond / 1e6) * 100)
+
+
+def nchp_time_after(time_nchp):
+    """
+    :param time_nchp: 如'2022-05-01T10:00:01.300Z'
+    :return: 比它晚一个最小单位(最后一位小数)的时间，格式不变，如'2022-05-01T10:00:01.301Z'
+    """
+    second = datetime.datetime.strptime(time_nchp[:19], '%Y-%m-%dT%H:%M:%S')
+    fraction = time_nchp[20:-1]
+    tick = int(fraction or 0) + 1
+    if tick == 10 ** len(fraction):
+        second += datetime.timedelta(seconds=1)
+        tick = 0
+    if not fraction:
+        return f"{second:%Y-%m-%dT%H:%M:%S}Z"
+    return f"{second:%Y-%m-%dT%H:%M:%S}.{tick:0{len(fraction)}d}Z"
+
+
+def asobi_time_to_vpos(a_time):
+    """
+    :param a_time: 如'2022-05-01 10:00:00.000000123'
+    :return: 时间戳(0.01s)
+    """
+    return round(local_timestamp(a_time[:19]) * 100 + (int(a_time[20:23]) / 10))
+
+
+def openrec_time_to_vpos(time, start_seconds):
+    """
+    :param time: 如'2022-05-01T19:00:10+09:00'
+    :param start_seconds: 直播开始时间的naive_seconds，每场直播只计算一次
+    :return: 相对直播开始时间的vpos(0.01s)
+    """
+    return (naive_seconds(time) - start_seconds) * 100
+
+
+def parse_time_openrec(time):
+    return parse_local_time(time)
+
+
+def format_time_openrec(time):
+    # 获取评论时用到的时间时UTC+0的时间，需要把从page页获取到的时间从UTC+9转成UTC+0再用
+    return datetime.datetime.strftime(time - datetime.timedelta(hours=9), '%Y-%m-%dT%H:%M:%S.000Z')
+
+
 class AssTag:
     color_command = {'white': '#FFFFFF', 'red': '#FF0000', 'pink': '#FF8080', 'orange': '#FFC000', 'yellow': '#FFFF00',
                      'green': '#00FF00', 'cyan': '#00FFFF', 'blue': '#0000FF', 'purple': '#C000FF', 'black': '#000000',
@@ -63,6 +349,14 @@ class AssTag:
                      'yellow2': '#999900', 'green2': '#00CC66', 'cyan2': '#00CCCC', 'blue2': '#3399FF',
                      'purple2': '#6633CC', 'black2': '#666666'}
 
+    # 前10项按顺序拼接成ass标签，x/x1/x2/y仅用于记录坐标
+    # pos_tag之前的7项很少变化，拼接结果缓存在static中，修改这几项需要通过set_*方法
+    __slots__ = ('font_name', 'font_size', 'color', 'outline_color', 'opacity', 'outline_opacity', 'alignment',
+                 'pos_tag', 'other', 'clip', 'x', 'x1', 'x2', 'y', 'static')
+
+    # 拼接结果 -> 同一个字符串对象，相同组合的标签共用
+    static_cache = {}
+
     def __init__(self):
         self.font_name = ''
         self.font_size = ''
@@ -74,35 +368,50 @@ class AssTag:
         self.alignment = ''
         self.pos_tag = ''
         self.other = ''
+        self.clip = ''
 
         self.x = ''
         self.x1 = ''
         self.x2 = ''
         self.y = ''
 
+        self.static = ''
+
+    def clone(self):
+        tag = AssTag.__new__(AssTag)
+        for attr in AssTag.__slots__:
+            setattr(tag, attr, getattr(self, attr))
+        return tag
+
     def set_font_name(self, f_name):
         self.font_name = fr'\fn{f_name}'
+        self.static = None
 
     def set_font_size(self, f_size):
         self.font_size = fr'\fs{f_size}'
+        self.static = None
 
     def set_color(self, color_code):
         r_hex = color_code[1:3]
         g_hex = color_code[3:5]
         b_hex = color_code[5:7]
         self.color = fr"\c&H{b_hex}{g_hex}{r_hex}&"
+        self.static = None
 
     def set_outline_color(self, color_code):
         r_hex = color_code[1:3]
         g_hex = color_code[3:5]
         b_hex = color_code[5:7]
         self.outline_color = fr"\3c&H{b_hex}{g_hex}{r_hex}&"
+        self.static = None
 
     def set_opacity(self, value):
         self.opacity = fr"\1a&H{hex(round(255 * value))[2:4]}&"
+        self.static = None
 
     def set_outline_opacity(self, value):
         self.outline_opacity = fr"\3a&H{hex(round(255 * value))[2:4]}&"
+        self.static = None
 
     def set_alignment(self, a):
         """
@@ -111,6 +420,7 @@ class AssTag:
         :return:
         """
         self.alignment = fr'\an{a}'
+        self.static = None
 
     def set_pos(self, x, y):
         self.pos_tag = fr'\pos({x}, {y})'
@@ -121,47 +431,67 @@ class AssTag:
         self.y = y
         self.pos_tag = fr'\move({x1},{y},{x2},{y})'
 
-    def translate_command(self, command_list):
+    def command_small(self, config):
+        self.set_font_size(round(config.style['font_size'] * 0.6))
+
+    def command_big(self, config):
+        self.set_font_size(round(config.style['font_size'] * 1.47))
+
+    def command_mincho(self, config):
+        self.set_font_name('Yu Mincho')
+
+    def command_gothic(self, config):
+        self.set_font_name('Yu Gothic')
+
+    def command_ue(self, config):
+        self.set_alignment('8')
+        self.set_pos(config.width / 2, 0)
+
+    def command_shita(self, config):
+        self.set_alignment('2')
+        self.set_pos(config.width / 2, config.height)
+
+    # mail中的命令 -> 设置对应ass标签的方法
+    command_handlers = {'small': command_small, 'big': command_big, 'mincho': command_mincho,
+                        'gothic': command_gothic, 'ue': command_ue, 'shita': command_shita}
+
+    def translate_command(self, command_list, config):
         for command in command_list:
             if command in self.color_command:
                 self.set_color(self.color_command[command])
-            elif re.search('#.{6}', command):
+            elif command in self.command_handlers:
+                self.command_handlers[command](self, config)
+            elif COLOR_CODE_PATTERN.search(command):
                 self.set_color(command)
-            elif command == 'small':
-                self.set_font_size(round(style['font_size'] * 0.6))
-            elif command == 'big':
-                self.set_font_size(round(style['font_size'] * 1.47))
-            elif command == 'mincho':
-                self.set_font_name('Yu Mincho')
-            elif command == 'gothic':
-                self.set_font_name('Yu Gothic')
-            elif command == 'ue':
-                self.set_alignment('8')
-                self.set_pos(WIDTH / 2, 0)
-            elif command == 'shita':
-                self.set_alignment('2')
-                self.set_pos(WIDTH / 2, HEIGHT)
 
-    def string(self):
-        attribute_dict = {}
-        attribute_dict_temp = self.__dict__
-        key_del = ['x', 'x1', 'x2', 'y']
+    def apply(self, fields):
+        """
+        :param fields: Comment.mail_tag得到的(属性名, 值)
+        """
+        for attr, value in fields:
+            setattr(self, attr, value)
+        self.static = None
 
-        for k, v in attribute_dict_temp.items():
-            if k not in key_del:
-                attribute_dict[k] = v
+    def string(self):
+        static = self.static
+        if static is None:
+            static = ''.join((self.font_name, self.font_size, self.color, self.outline_color, self.opacity,
+                              self.outline_opacity, self.alignment))
+            static = self.static = self.static_cache.setdefault(static, static)
 
-        tag_text = ''.join(attribute_dict.values())
-        if tag_text:
-            tag_text = f"{{{tag_text}}}"
-        return tag_text
+        if static or self.pos_tag or self.other or self.clip:
+            return f"{{{static}{self.pos_tag}{self.other}{self.clip}}}"
+        return ''
 
 
 class Dialogue:
+    __slots__ = ('layer', 'vpos_in', 'vpos_out', 'style', 'name', 'margin_l', 'margin_r', 'margin_v', 'effect', 'text',
+                 'tag', 'text_row_cnt', 'font_size', 'speed', 'has_been_moved_down', 'raw')
+
     def __init__(self):
         self.layer = '0'
-        self.start = ''
-        self.end = ''
+        self.vpos_in = 0  # 出现时间(0.01s)
+        self.vpos_out = 0  # 消失时间(0.01s)
         self.style = ''
         self.name = ''
         self.margin_l = '0'
@@ -173,8 +503,29 @@ class Dialogue:
         self.tag = AssTag()
 
         self.text_row_cnt = 1
+        self.font_size = None  # 运营评论的实际字号
+        self.speed = 0  # 滚动速度(像素/0.01s)
+        self.has_been_moved_down = False
 
-        self.raw = None
+        self.raw = None  # 生成该弹幕的CommentRecord
+
+    def clone(self):
+        """
+        复制弹幕，除tag以外的属性均为不可变对象或只读的原始评论，浅复制即可
+        """
+        d = Dialogue.__new__(Dialogue)
+        for attr in Dialogue.__slots__:
+            setattr(d, attr, getattr(self, attr))
+        d.tag = self.tag.clone()
+        return d
+
+    @property
+    def start(self):
+        return stamp_to_time(self.vpos_in)
+
+    @property
+    def end(self):
+        return stamp_to_time(self.vpos_out)
 
     def tag_and_text(self):
         return f"{self.tag.string()}{self.text}"
@@ -186,44 +537,44 @@ class Dialogue:
         self.tag.set_outline_opacity(style_bg['outline_opacity'])
         self.tag.other += style_bg['other']
 
-    def draw_bg_official(self, font_size):
+    def draw_bg_official(self, font_size, config):
         self.layer = '3'
         self.name = f'BG {self.name}'
 
-        style_bg = style['official']['background']
+        style_bg = config.style['official']['background']
         self.set_default_bg_style(style_bg)
 
-        bg_width = WIDTH - style_bg['marginH'] * 2
+        bg_width = config.width - style_bg['marginH'] * 2
         bg_height = font_size * self.text_row_cnt + style_bg['paddingV'] * 2
         border_radius = style_bg['border_radius']
 
         self.text = draw_rounded_rectangle(bg_width, bg_height, border_radius)
 
-    def draw_bg_vote_question(self, bg_width, bg_height):
+    def draw_bg_vote_question(self, bg_width, bg_height, config):
         self.layer = '3'
         self.name = f'BG {self.name}'
 
-        style_bg = style['vote']['question']['bg']
+        style_bg = config.style['vote']['question']['bg']
         self.set_default_bg_style(style_bg)
 
         border_radius = style_bg['border_radius']
         self.text = draw_rounded_rectangle(bg_width, bg_height, border_radius)
 
-    def draw_bg_vote_choice(self, bg_width, bg_height):
+    def draw_bg_vote_choice(self, bg_width, bg_height, config):
         self.layer = '3'
         self.name = f'BG {self.name}'
 
-        style_bg = style['vote']['choice']['bg']
+        style_bg = config.style['vote']['choice']['bg']
         self.set_default_bg_style(style_bg)
 
         border_radius = style_bg['border_radius']
         self.text = draw_rounded_rectangle(bg_width, bg_height, border_radius)
 
-    def draw_bg_vote_result(self, x1, bg_width, result):
+    def draw_bg_vote_result(self, x1, bg_width, result, config):
         self.layer = '4'
         self.name = 'BG アンケート 結果'
 
-        style_bg = style['vote']['result']['bg']
+        style_bg = config.style['vote']['result']['bg']
         self.set_default_bg_style(style_bg)
 
         result = float(result[:-1]) / 100
@@ -232,228 +583,698 @@ class Dialogue:
         t2 = style_bg['animation']['time_end']
         accel = style_bg['animation']['accel']
 
-        self.tag.clip = rf"\clip(0,0,{x1},{HEIGHT})\t({t1},{t2},{accel}\clip(0,0,{x2},{HEIGHT})))"
+        self.tag.clip = rf"\clip(0,0,{x1},{config.height})\t({t1},{t2},{accel}\clip(0,0,{x2},{config.height})))"
 
     def string(self):
-        d_list = [self.layer, self.start, self.end, self.style, self.name, self.margin_l, self.margin_r, self.margin_v,
-                  self.effect, self.tag_and_text()]
+        return (f"Dialogue: {self.layer},{stamp_to_time(self.vpos_in)},{stamp_to_time(self.vpos_out)},{self.style},"
+                f"{self.name},{self.margin_l},{self.margin_r},{self.margin_v},{self.effect},{self.tag.string()}{self.text}")
 
-        return f"Dialogue: {','.join(d_list)}"
 
+class DuplicateFilter:
+    """
+    评论去重
+    用集合记录已经出现过的评论特征(精简后的评论信息或评论id)，并按平台统计被丢弃的重复评论数
+    """
 
-class Comment:
     def __init__(self):
-        self.ng_pattern = re.compile('(NGコメントです)')
+        self.seen = set()
+        self.dropped = Counter()
 
-        self.title = None
-        self.platform = None
-        self.source = None
-        self.data_raw = None
+    def is_new(self, key, platform):
+        """
+        :param key: 评论特征
+        :param platform: 评论所属平台，用于统计
+        :return: 是否为首次出现的评论
+        """
+        if key in self.seen:
+            self.dropped[platform] += 1
+            return False
+
+        self.seen.add(key)
+        return True
+
+
+class RawCommentCache:
+    """
+    原始评论的本地缓存
+    按平台和直播id以gzip压缩的json保存下载到的原始数据，有效期内再次处理同一直播时无需重新下载
+    """
+
+    def __init__(self, directory, ttl, refresh=False):
+        """
+        :param directory: 缓存目录
+        :param ttl: 缓存有效期(秒)
+        :param refresh: 是否忽略已有缓存重新下载
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.refresh = refresh
+
+    def path(self, platform, content_id):
+        return os.path.join(self.directory, platform, f'{fix_invalid_file_name(content_id)}.json.gz')
+
+    def load(self, platform, content_id):
+        """
+        :return: 缓存的数据，没有缓存、缓存已过期或需要重新下载时返回None
+        """
+        path = self.path(platform, content_id)
+        if self.refresh or not os.path.exists(path) or time.time() - os.path.getmtime(path) > self.ttl:
+            return None
+
+        with gzip.open(path, 'rt', encoding='utf-8') as f_cache:
+            print(f'使用缓存: {path}')
+            return json.load(f_cache)
+
+    def save(self, platform, content_id, data):
+        path = self.path(platform, content_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # 先写入临时文件，避免中断时留下不完整的缓存
+        with gzip.open(f'{path}.tmp', 'wt', encoding='utf-8', compresslevel=6) as f_cache:
+            json.dump(data, f_cache, ensure_ascii=False)
+        os.replace(f'{path}.tmp', path)
+
+
+class DownloadCheckpoint:
+    """
+    分段下载的断点记录
+    每获取一页评论就向jsonl文件追加一行，中断后再次运行时从记录中恢复各时间段的进度
+    第一行记录时间段的划分方式，划分方式不同时(如直播已经结束)旧记录作废
+    """
+
+    def __init__(self, path, slices):
+        self.path = path
+        self.lock = threading.Lock()
+        self.progress = {}  # 时间段序号: {'from': 下一页的起始时间, 'done': 是否已完成, 'chats': 已获取的评论}
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f_checkpoint:
+                lines = f_checkpoint.read().split('\n')
+
+            if lines[0] and json.loads(lines[0]).get('slices') == slices:
+                for line in lines[1:]:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 中断时没有写完的最后一行
+                        continue
+
+                    progress = self.progress.setdefault(record['slice'], {'chats': []})
+                    progress['from'] = record['from']
+                    progress['done'] = record['done']
+                    progress['chats'].extend(record['chats'])
+
+                print(f'从断点继续下载: {path}')
+            else:
+                os.remove(path)
+
+        if not os.path.exists(path):
+            with open(path, 'w', encoding='utf-8') as f_checkpoint:
+                f_checkpoint.write(json.dumps({'slices': slices}) + '\n')
 
+    def save(self, index, time_from, done, chats):
+        record = {'slice': index, 'from': datetime.datetime.strftime(time_from, '%Y-%m-%dT%H:%M:%S+09:00'),
+                  'done': bool(done), 'chats': chats}
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f_checkpoint:
+                f_checkpoint.write(line)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class NcvLog:
+    """
+    以流的方式读取NCV(NiconamaCommentViewer)保存的评论文件
+    逐条返回由评论内容和chat标签属性组成的dict，读取过的元素会被立即清除，内存占用不随文件大小增长
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.title = None
         self.open_time = None
-        self.official_name = None
 
-        self.save = False
+    def elements(self):
+        """
+        :return: 生成器，逐个返回已读取完毕的元素，返回后该元素从父元素中移除，避免整个文档树留在内存中
+        """
+        import xml.etree.ElementTree
 
-        self.normal = []
-        self.normal_still = []
-        self.official = []
-        self.vote = []
-        self.comment_art = []
-        self.other = []
+        parents = []
+        for event, elem in xml.etree.ElementTree.iterparse(self.source, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
 
-        self.cnt = 0
-        self.vote_cnt = 0
-        self.ca_cnt = 0
-        self.viewer_cnt = []
+            parents.pop()
+            yield elem
+            if parents:
+                parents[-1].remove(elem)
 
-        self.d_comment_art = []
-        self.d_official = []
-        self.d_vote = []
-        self.d_normal = []
-        self.d_bg = []
+    def read_info(self):
+        """
+        标题与开场时间不在评论之前时，单独扫描一遍文件获取，两者都找到后停止
+        """
+        with contextlib.closing(self.elements()) as elements:
+            for elem in elements:
+                if elem.tag == 'LiveTitle' and self.title is None:
+                    self.title = elem.text
+                elif elem.tag == 'OpenTime' and self.open_time is None:
+                    self.open_time = elem.text
+                if self.title is not None and self.open_time is not None:
+                    break
 
-        self.style_official = {'Name': '運営コメント',
-                               'Fontname': style['official']['font_name'],
-                               'Fontsize': str(style['official']['font_size']),
-                               'PrimaryColour': color(style['official']['color']),
-                               'SecondaryColour': '&H00B4FCFC',
-                               'OutlineColour': color(style['official']['outline_color']),
-                               'BackColour': '&H80000008',
-                               'Bold': '-1',
-                               'Italic': '0',
-                               'Underline': '0',
-                               'StrikeOut': '0',
-                               'ScaleX': '100',
-                               'ScaleY': '100',
-                               'Spacing': '0',
-                               'Angle': '0',
-                               'BorderStyle': '1',
-                               'Outline': str(style['official']['outline']),
-                               'Shadow': '0',
-                               'Alignment': '8',
-                               'MarginL': '0',
-                               'MarginR': '0',
-                               'MarginV': str(
-                                   style['official']['background']['marginV'] + style['official']['background'][
-                                       'paddingV']),
-                               'Encoding': '1'
-                               }
-        self.style_normal = {'Name': 'コメント',
-                             'Fontname': style['font_name'],
-                             'Fontsize': str(style['font_size']),
-                             'PrimaryColour': color(style['color']),
-                             'SecondaryColour': '&H00FFFFFF',
-                             'OutlineColour': color(style['outline_color']),
-                             'BackColour': '&H00000000',
-                             'Bold': '-1',
-                             'Italic': '0',
-                             'Underline': '0',
-                             'StrikeOut': '0',
-                             'ScaleX': '100',
-                             'ScaleY': '100',
-                             'Spacing': '0',
-                             'Angle': '0',
-                             'BorderStyle': '1',
-                             'Outline': str(style['outline']),
-                             'Shadow': '0',
-                             'Alignment': '7',
-                             'MarginL': '0',
-                             'MarginR': '0',
-                             'MarginV': '0',
-                             'Encoding': '1',
-                             }
-        self.style_comment_art = {'Name': 'コメントアート',
-                                  'Fontname': 'Yu Gothic',
-                                  'Fontsize': str(style['comment_art']['font_size']),
-                                  'PrimaryColour': color(style['comment_art']['color']),
-                                  'SecondaryColour': '&HFF0000FF',
-                                  'OutlineColour': color(style['comment_art']['outline_color']),
-                                  'BackColour': '&HFF000000',
-                                  'Bold': '-1',
-                                  'Italic': '0',
-                                  'Underline': '0',
-                                  'StrikeOut': '0',
-                                  'ScaleX': '128.5',
-                                  'ScaleY': '129',
-                                  'Spacing': '0',
-                                  'Angle': '0',
-                                  'BorderStyle': '1',
-                                  'Outline': str(style['comment_art']['outline']),
-                                  'Shadow': '0',
-                                  'Alignment': '7',
-                                  'MarginL': '0',
-                                  'MarginR': '0',
-                                  'MarginV': '0',
-                                  'Encoding': '1',
-                                  }
+    def __iter__(self):
+        for elem in self.elements():
+            if elem.tag == 'chat':
+                cmt_data = {'message': elem.text or ''}
+                cmt_data.update(elem.attrib)
+                yield cmt_data
+            elif elem.tag == 'LiveTitle' and self.title is None:
+                self.title = elem.text
+            elif elem.tag == 'OpenTime' and self.open_time is None:
+                self.open_time = elem.text
+
+
+class TrackAllocator:
+    """
+    弹幕轨道分配器
+    为每条轨道保存其最新弹幕的出现时间、文字长度、滚动速度以及"完全入镜"时间，
+    并用线段树维护各轨道这两个时间的最小值，从而在对数时间内找到编号最小的无碰撞轨道
+    """
+    # 线段树剪枝时允许的浮点误差(0.01s)，候选轨道最终仍会用与原先相同的公式精确判断
+    epsilon = 1e-3
+
+    def __init__(self, row_cnt, width, displayed_time):
+        """
+        :param row_cnt: 弹幕轨道总数
+        :param width: 画面宽度(像素)
+        :param displayed_time: 弹幕从右侧入镜到完全出镜所需时间(0.01s)
+        """
+        self.row_cnt = row_cnt
+        self.width = width
+        self.displayed_time = displayed_time
+
+        self.occupied = [False] * row_cnt
+        self.vpos = [0] * row_cnt  # 轨道内最新弹幕的出现时间
+        self.length = [0] * row_cnt  # 轨道内最新弹幕的文字长度(像素)
+        self.speed = [0] * row_cnt  # 轨道内最新弹幕的滚动速度(像素/0.01s)
+
+        self.size = 1
+        while self.size < row_cnt:
+            self.size *= 2
+
+        # 线段树：叶子为各轨道的 完全入镜时间(entry-clear) / 最新弹幕出现时间(决定exit-clear)，空轨道为-inf
+        self.tree_entry = [float('inf')] * (2 * self.size)
+        self.tree_vpos = [float('inf')] * (2 * self.size)
+        for i in range(row_cnt):
+            self._update(i, float('-inf'), float('-inf'))
+
+    def speed_of(self, length):
+        return (self.width + length) / self.displayed_time
+
+    def _update(self, row, entry, vpos):
+        node = row + self.size
+        self.tree_entry[node] = entry
+        self.tree_vpos[node] = vpos
+        node //= 2
+        while node:
+            self.tree_entry[node] = min(self.tree_entry[2 * node], self.tree_entry[2 * node + 1])
+            self.tree_vpos[node] = min(self.tree_vpos[2 * node], self.tree_vpos[2 * node + 1])
+            node //= 2
+
+    def collision(self, row, vpos, speed):
+        """
+        检测弹幕放入某条轨道时是否会与该轨道的最新弹幕发生碰撞，返回它们在滚动过程中重叠长度(像素）的最大值
+        若这个最大值<=0，说明它们不会发生碰撞
+        :param row: 轨道编号
+        :param vpos: 尚未分配轨道的当前弹幕的出现时间。要求其在轨道内最新弹幕之后，所以需要提前对所有评论按入镜时间排序
+        :param speed: 当前弹幕的滚动速度(像素/0.01s)
+        :return: 两者重叠长度的最大值
+        """
+        if not self.occupied[row]:
+            return 0
 
-    def ass(self):
-        def default_style():
-            return f"""[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: {','.join(self.style_official.values())}
-Style: {','.join(self.style_normal.values())}
-Style: {','.join(self.style_comment_art.values())}
+        # 后者入镜时与前者重叠的长度(像素）
+        collision_at_start = self.length[row] - self.speed[row] * (vpos - self.vpos[row])
+        # 前者出镜时与后者重叠的长度(像素）
+        collision_at_end = speed * (self.vpos[row] + self.displayed_time - vpos) - self.width
 
-"""
+        return max(collision_at_start, collision_at_end)
 
-        script_info = f'''[Script Info]
-; Script generated by Aegisub 3.2.2
-; http://www.aegisub.org/
-ScriptType: v4.00+
-PlayResX: {WIDTH}
-PlayResY: {HEIGHT}
-WrapStyle: 2
-ScaledBorderAndShadow: Yes
-Timing: 100.0000
+    def first_free_row(self, vpos, speed):
+        """
+        找出编号最小的无碰撞轨道
+        无碰撞的条件等价于：前者已完全入镜(entry-clear <= vpos)，且前者出镜时后者尚未到达画面左端
+        :return: 轨道编号，所有轨道都会发生碰撞时返回None
+        """
+        limit_entry = vpos + self.epsilon
+        limit_vpos = vpos - self.displayed_time + self.width / speed + self.epsilon
 
-[Aegisub Project Garbage]
+        stack = [1]
+        while stack:
+            node = stack.pop()
+            if self.tree_entry[node] > limit_entry or self.tree_vpos[node] > limit_vpos:
+                continue
+            if node >= self.size:
+                row = node - self.size
+                if self.collision(row, vpos, speed) <= 0:
+                    return row
+                continue
+            stack.append(2 * node + 1)
+            stack.append(2 * node)
 
-'''
+        return None
 
-        events_header = '''[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-'''
+    def allocate(self, vpos, length, speed=None, entry=None):
+        """
+        为弹幕分配轨道，结果与依次对每条轨道做碰撞检测的贪心算法一致：
+        优先选择编号最小的无碰撞轨道，否则选择最大重叠长度最小的轨道
+        :param vpos: 弹幕出现时间(0.01s)
+        :param length: 弹幕文字长度(像素)
+        :param speed: 已算好的滚动速度，默认由length计算
+        :param entry: 已算好的完全入镜时间，默认由speed计算
+        :return: 轨道编号
+        """
+        if speed is None:
+            speed = self.speed_of(length)
+        if entry is None:
+            entry = vpos + length / speed
+
+        row = self.first_free_row(vpos, speed)
+        if row is None:
+            # 所有轨道都已饱和，找出最大重叠长度最小的轨道
+            min_collision = float('inf')
+            for i in range(self.row_cnt):
+                c = self.collision(i, vpos, speed)
+                if c < min_collision:
+                    min_collision = c
+                    row = i
 
-        ass_block_list = [script_info, default_style(), events_header, self.dialouges()]
+        self.occupied[row] = True
+        self.vpos[row] = vpos
+        self.length[row] = length
+        self.speed[row] = speed
+        self._update(row, entry, vpos)
 
-        return ''.join(ass_block_list)
+        return row
 
-    def dialouges(self):
-        self.build_dialogues()
-        dialogue_list = [self.d_comment_art, self.d_official, self.d_vote, self.d_normal, self.d_bg]
-        dialogue_list_string = []
-        for dialogue in dialogue_list:
-            for d in dialogue:
-                dialogue_list_string.append(d.string())
 
-        return '\n'.join(dialogue_list_string)
+class IntervalIndex:
+    """
+    区间索引
+    将区间按左端点排序，并用线段树维护右端点的最大值，可在对数时间内找出与给定时间段重叠的所有区间
+    """
 
-    def build_dialogues(self):
-        self.reclassify_cmt()
+    def __init__(self, intervals):
+        """
+        :param intervals: [(端点, 端点), ...] 两个端点的先后顺序不限
+        """
+        self.order = sorted(range(len(intervals)), key=lambda k: min(intervals[k]))
+        self.lo = [min(intervals[k]) for k in self.order]
 
-        self.build_official()
-        self.build_vote()
-        self.build_comment_art()
-        self.build_normal()
+        self.size = 1
+        while self.size < len(intervals):
+            self.size *= 2
+
+        self.tree_hi = [float('-inf')] * (2 * self.size)
+        for i, k in enumerate(self.order):
+            self.tree_hi[self.size + i] = max(intervals[k])
+        for node in range(self.size - 1, 0, -1):
+            self.tree_hi[node] = max(self.tree_hi[2 * node], self.tree_hi[2 * node + 1])
+
+    def overlapping(self, start, end):
+        """
+        :return: 与开区间(start, end)有重叠的区间在原列表中的序号，按序号升序排列
+        """
+        cnt = bisect.bisect_left(self.lo, end)  # 左端点小于end的区间
+        result = []
+
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, left, right = stack.pop()
+            if left >= cnt or self.tree_hi[node] <= start:
+                continue
+            if node >= self.size:
+                result.append(self.order[left])
+                continue
+            mid = (left + right) // 2
+            stack.append((2 * node + 1, mid, right))
+            stack.append((2 * node, left, mid))
+
+        result.sort()
+        return result
+
+
+class StageProfiler:
+    """
+    记录处理流程中各阶段的用时、CPU时间、峰值内存与处理条数
+    阶段可以嵌套，如下载评论属于获取评论(get_data_raw)的一部分
+    peak_rss_mb是阶段结束时进程至今的峰值内存，不是该阶段单独的占用，最耗内存的阶段之后的各阶段都会显示相同的数值；
+    peak_rss_growth_mb是该阶段使进程峰值内存增长的量，为0说明该阶段没有超过之前的峰值
+    """
+
+    def __init__(self, cprofile=False):
+        """
+        :param cprofile: 同时用cProfile记录各函数的用时，可以用dump_stats保存
+        """
+        self.stages = []
+        self.depth = 0
+        if cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+        else:
+            self.cprofile = None
+
+    @staticmethod
+    def peak_rss():
+        """
+        :return: 进程至今的峰值内存(MB)，无法获取时(Windows)为None
+        """
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux的单位为KB，macOS为Byte
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        with profiler.stage('build_normal') as record:
+            ...
+            record['count'] = len(self.d_normal)
+        """
+        record = {'stage': name, 'depth': self.depth, 'count': None}
+        self.stages.append(record)
+        peak_rss = self.peak_rss()
+
+        if self.cprofile and not self.depth:
+            self.cprofile.enable()
+        self.depth += 1
+        t_wall = time.perf_counter()
+        t_cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - t_wall
+            record['cpu'] = time.process_time() - t_cpu
+            record['peak_rss_mb'] = self.peak_rss()
+            record['peak_rss_growth_mb'] = None if peak_rss is None else record['peak_rss_mb'] - peak_rss
+            self.depth -= 1
+            if self.cprofile and not self.depth:
+                self.cprofile.disable()
+
+    def print_table(self):
+        print()
+        # 表头中的汉字显示宽度为2
+        print(f"{'阶段':<44}{'用时(s)':>7}{'CPU(s)':>9}{'累计峰值(MB)':>9}{'峰值增长(MB)':>9}{'条数':>8}")
+        for r in self.stages:
+            peak_rss = '-' if r['peak_rss_mb'] is None else f"{r['peak_rss_mb']:.1f}"
+            growth = '-' if r['peak_rss_growth_mb'] is None else f"{r['peak_rss_growth_mb']:.1f}"
+            count = '-' if r['count'] is None else r['count']
+            print(f"{'  ' * r['depth'] + r['stage']:<46}{r['wall']:>9.3f}{r['cpu']:>9.3f}{peak_rss:>13}{growth:>13}"
+                  f"{count:>10}")
+
+    def dump_json(self, path, **info):
+        """
+        :param info: 一并写入的其他信息，如平台与标题
+        """
+        with open(path, 'w', encoding='utf-8') as f_json:
+            json.dump({**info, 'stages': self.stages}, f_json, ensure_ascii=False, indent=2)
+
+    def dump_stats(self, path):
+        """
+        保存cProfile的结果，可以用pstats或snakeviz等工具查看
+        """
+        if self.cprofile:
+            self.cprofile.dump_stats(path)
+
+
+class NormalColumns:
+    """
+    按列存放弹幕布局用到的逐条数值(需要numpy)
+    出现时间、文字长度、滚动速度、完全入镜时间和消失时间都用向量运算一次算出，
+    只有依赖前序结果的轨道分配仍需逐条进行
+    """
+
+    def __init__(self, comments, font_size, width, displayed_time):
+        """
+        :param comments: 已按出现时间排序的评论
+        :param font_size: 弹幕字号
+        :param width: 画面宽度(像素)
+        :param displayed_time: 弹幕从右侧入镜到完全出镜所需时间(0.01s)
+        """
+        import numpy
+
+        cnt = len(comments)
+        self.vpos = numpy.fromiter((c.vpos for c in comments), dtype=numpy.int64, count=cnt)
+        self.vpos_out = self.vpos + displayed_time
+        self.text_length = numpy.fromiter((len(c.message) for c in comments), dtype=numpy.int64,
+                                          count=cnt) * font_size
+        # 与TrackAllocator中的公式运算顺序相同，结果逐位一致
+        self.speed = (width + self.text_length) / displayed_time
+        self.entry = self.vpos + self.text_length / self.speed
+
+    def overlaps(self, intervals):
+        """
+        :param intervals: [(端点, 端点), ...] 运营评论的显示时间，两个端点的先后顺序不限
+        :return: 各条弹幕的显示时间是否与任意一个区间重叠(开区间)，判定与IntervalIndex.overlapping一致
+        """
+        import numpy
+
+        lo = numpy.array([min(interval) for interval in intervals], dtype=numpy.float64)
+        hi = numpy.array([max(interval) for interval in intervals], dtype=numpy.float64)
+        order = numpy.argsort(lo, kind='stable')
+        lo = lo[order]
+        hi_prefix_max = numpy.maximum.accumulate(hi[order])
+
+        # 左端点小于弹幕消失时间的区间个数，其中右端点的最大值大于弹幕出现时间即有重叠
+        cnt = numpy.searchsorted(lo, self.vpos_out, side='left')
+        mask = cnt > 0
+        mask[mask] = hi_prefix_max[cnt[mask] - 1] > self.vpos[mask]
+        return mask
+
+
+def intern_str(s):
+    """
+    :return: 字符串返回sys.intern后的同一个对象，其他值(None、数字id等)原样返回
+    """
+    return sys.intern(s) if type(s) is str else s
+
+
+class CommentRecord:
+    """
+    获取评论后统一使用的精简评论，只保留生成弹幕用到的字段，平台返回的原始dict在转换后即被释放
+    观众名与mail在大量评论之间重复，用sys.intern共用同一个字符串
+    评论在多次渲染之间共用，生成弹幕时不应修改
+    """
+    __slots__ = ('vpos', 'message', 'name', 'user_id', 'mail', 'premium', 'layer', 'end_time')
+
+    def __init__(self, vpos, message, name=None, user_id=None, mail=None, premium=None, layer=None, end_time=None):
+        """
+        :param vpos: 出现时间(0.01s)
+        :param message: 评论内容
+        :param name: 观众名
+        :param user_id: 没有观众名时显示的用户id(ニコニコ生放送)
+        :param mail: 以空格分隔的命令(ニコニコ生放送)
+        :param premium: 会员类型(ニコニコ生放送)
+        :param layer: CommentArt的图层
+        :param end_time: 运营评论的显示时长(秒)，为None时使用默认时长(ニコニコチャンネルプラス)
+        """
+        self.vpos = vpos
+        self.message = message
+        self.name = intern_str(name)
+        self.user_id = intern_str(user_id)
+        self.mail = intern_str(mail)
+        self.premium = intern_str(premium)
+        self.layer = layer
+        self.end_time = end_time
+
+    @classmethod
+    def from_dict(cls, c):
+        """
+        :param c: 平台适配器整理过的评论dict，已带有vpos与message
+        """
+        return cls(c['vpos'], c['message'], c.get('name'), c.get('user_id'), c.get('mail'), c.get('premium'),
+                   c.get('layer'), c.get('end_time_in_seconds'))
 
-    # 获取评论信息并转成dict形式
-    def get_data_raw(self):
-        if self.platform == 'ニコニコ生放送':
-            DOMTree = xml.dom.minidom.parse(self.source)
-            root = DOMTree.documentElement
-
-            if root.getElementsByTagName('LiveTitle'):
-                # 是使用NCV下载的弹幕，从文档内容中获取生放标题
-                self.title = root.getElementsByTagName('LiveTitle')[0].firstChild.data
-                # NCV下载的弹幕时间参数有错误，需要用openTime来校正
-                self.open_time = root.getElementsByTagName('OpenTime')[0].firstChild.data
-            else:
-                self.title = os.path.split(self.source)[1]
-                self.title = os.path.splitext(self.title)[0]
 
-            self.title = fix_invalid_file_name(self.title)
+class PlatformAdapter:
+    """
+    平台适配器的基类，每个平台一个子类，负责读取或下载评论并转成统一的CommentRecord
+    适配器只依赖构造时传入的参数而不依赖Comment，可以在各自的线程或进程中独立运行
+    只有部分平台用到的依赖(requests、xml解析等)在使用时才导入，转换本地评论文件时不需要加载它们
+    """
+    platform = None
 
-            chat = root.getElementsByTagName('chat')
-            self.data_raw = []
-            for c in chat:
-                cmt_data = {'message': c.firstChild.data}
-                for key, value in c.attributes.items():
-                    cmt_data[key] = value
+    def __init__(self, source, duplicate_filter=None, ng_pattern=NG_PATTERN, save=False, cache=None, anchor=None,
+                 profiler=None):
+        """
+        :param source: 评论源，直播链接或本地评论文件路径
+        :param duplicate_filter: 去重使用的DuplicateFilter，默认新建一个
+        :param ng_pattern: 屏蔽评论的正则表达式
+        :param save: 保存原始评论文件（Openrec/ニコニコチャンネルプラス）
+        :param cache: 原始评论的RawCommentCache，为None时不使用缓存
+        :param anchor: 对齐评论时间的依据(Zaiko/ASOBISTAGE)，包含anchor_index/anchor_time/offset，未指定的项为None
+        :param profiler: StageProfiler，为None时不做记录
+        """
+        self.source = source
+        self.duplicate_filter = duplicate_filter if duplicate_filter is not None else DuplicateFilter()
+        self.ng_pattern = ng_pattern
+        self.save = save
+        self.cache = cache
+        self.anchor = anchor or {}
+        self.profiler = profiler
+
+        # 读取完毕后可用
+        self.title = None
+        self.open_time = None
+        self.official_name = None
 
-                if self.open_time:
-                    cmt_data['vpos'] = (int(cmt_data['date']) - int(self.open_time)) * 100
+    def stage(self, name):
+        """
+        :return: 记录一个处理阶段的上下文，未设置profiler时不做任何记录
+        """
+        if self.profiler:
+            return self.profiler.stage(name)
+        return contextlib.nullcontext({})
 
-                if cmt_data.get('date_usec'):
-                    date_usec = cmt_data.get('date_usec')
+    def file_title(self):
+        """
+        :return: 以本地评论文件的文件名(不含扩展名)作为标题
+        """
+        title = os.path.splitext(os.path.split(self.source)[1])[0]
+        return fix_invalid_file_name(title)
+
+    def read_anchor(self, key):
+        """
+        获取对齐评论时间的依据，命令行参数优先，其次是评论文件旁的锚点文件，两者都没有时需要手动输入
+        只指定了其中一项时直接报错，不转为手动输入（批量模式下无法输入）
+        :param key: 作为依据的评论，anchor_index(Zaiko)或anchor_time(ASOBISTAGE)
+        :return: 可能包含key与offset的dict
+        """
+        anchor = {}
+        path = anchor_path(self.source)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f_anchor:
+                anchor = json.load(f_anchor)
+        anchor.update({k: v for k, v in self.anchor.items() if v is not None})
+
+        given = [k for k in (key, 'offset') if anchor.get(k) not in (None, '')]
+        if len(given) == 1:
+            missing = 'offset' if given[0] == key else key
+            raise ValueError(f'只指定了{given[0]}，{key}与offset需要同时指定，缺少{missing}')
+        return anchor
+
+    def comments(self):
+        """
+        :return: 生成器，逐条返回(分类, 评论)，分类为normal/normal_still/official/vote/comment_art/other之一
+                 同一分类中的评论按它们在该分类中应有的顺序返回
+                 投票的结构因平台而异且数量很少，保留原始dict，其他评论都转成CommentRecord
+        """
+        for category, c in self.read():
+            if category != 'vote':
+                c = CommentRecord.from_dict(c)
+            yield category, c
+
+    def read(self):
+        """
+        由各平台实现，逐条返回(分类, 已带有vpos、name与message的原始dict)
+        """
+        raise NotImplementedError
+
+
+class NcvAdapter(PlatformAdapter):
+    platform = 'ニコニコ生放送'
+
+    def read(self):
+        ncv_log = NcvLog(self.source)
+        for cmt_data in ncv_log:
+            if self.title is None:
+                # NCV保存的文件中标题与开场时间位于评论之前，其他顺序的文件先单独读取这两项，使vpos不受元素顺序影响
+                if ncv_log.title is None or ncv_log.open_time is None:
+                    ncv_log.read_info()
+                if ncv_log.title:
+                    # 是使用NCV下载的弹幕，从文档内容中获取生放标题
+                    self.title = fix_invalid_file_name(ncv_log.title)
+                    # NCV下载的弹幕时间参数有错误，需要用openTime来校正
+                    self.open_time = ncv_log.open_time
                 else:
-                    date_usec = 0
+                    self.title = self.file_title()
+
+            if self.open_time:
+                cmt_data['vpos'] = (int(cmt_data['date']) - int(self.open_time)) * 100
+
+            if cmt_data.get('date_usec'):
+                date_usec = cmt_data.get('date_usec')
+            else:
+                date_usec = 0
+
+            cmt_data['vpos'] = int(cmt_data['vpos']) + round(int(date_usec) / 10000)
 
-                cmt_data['vpos'] = int(cmt_data['vpos']) + round(int(date_usec) / 10000)
-                self.data_raw.append(cmt_data)
-        elif self.platform == 'Zaiko':
-            with open(source, 'r', encoding='utf-8') as f_source:
-                chat = f_source.read()
+            # 屏蔽弹幕
+            if self.ng_pattern.search(cmt_data['message']):
+                continue
+            if NICO_SYSTEM_COMMAND_PATTERN.search(cmt_data['message']):
+                yield 'other', cmt_data
+            elif cmt_data.get('premium') and NICO_OFFICIAL_PREMIUM_PATTERN.search(cmt_data.get('premium')):
+                yield 'official', cmt_data
+                if '/vote' in cmt_data['message']:
+                    yield 'vote', cmt_data
+            elif '\n' in cmt_data['message']:
+                cmt_data['layer'] = 10
+                yield 'comment_art', cmt_data
+            elif cmt_data.get('mail') and STILL_COMMAND_PATTERN.search(cmt_data.get('mail')):
+                yield 'normal_still', cmt_data
+            else:
+                yield 'normal', cmt_data
 
-            self.title = os.path.split(self.source)[1]
-            self.title = os.path.splitext(self.title)[0]
-            self.title = fix_invalid_file_name(self.title)
+        if self.title is None:
+            self.title = fix_invalid_file_name(ncv_log.title) if ncv_log.title else self.file_title()
 
-            self.data_raw = []
-            index = 0
 
-            non_duplicate_cmt_list = []
-            for c in chat.split('\n'):
+class ZaikoAdapter(PlatformAdapter):
+    platform = 'Zaiko'
+
+    def read(self):
+        @functools.lru_cache(maxsize=4096)
+        def jst_time(created_at):
+            """
+            :param created_at: UTC时间，精确到秒，同一秒内的评论共用缓存结果
+            :return: (日本时间, 时间戳(0.01s), 显示用的日本时间)
+            """
+            created_at_jst = parse_local_time(created_at) + datetime.timedelta(hours=9)
+            return created_at_jst, created_at_jst.timestamp() * 100, created_at_jst.strftime('%Y-%m-%d %H:%M:%S')
+
+        self.title = self.file_title()
+
+        normal = []
+        official = []
+        index = 0
+
+        anchor = self.read_anchor('anchor_index')
+        interactive = anchor.get('anchor_index') is None
+
+        # 逐行读取，不把整个文件读入内存
+        with open(self.source, 'r', encoding='utf-8') as f_source:
+            for c in f_source:
+                # 只有含text的chat事件需要解析，跳过ping等其他帧
+                if 'text' not in c:
+                    continue
+                start = c.find('{')
+                end = c.rfind('}')
+                if start < 0 or end < start:
+                    continue
                 try:
-                    message = re.search('\{.*\}', c).group(0)
-                    message = json.loads(message)
+                    message = fast_json_loads(c[start:end + 1])
                 except Exception as e:
                     continue
 
                 data = message.get('data')
                 if data:
-                    data = json.loads(data)
+                    data = fast_json_loads(data)
 
                     text = data.get('text')
                     if text:
@@ -462,459 +1283,1082 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                         if nickname == '':
                             nickname = data.get('member', {}).get('uuid')
 
-                        created_at = data.get('created_at')
-                        created_at = datetime.datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%S.000000Z')
-                        created_at += datetime.timedelta(hours=9)
+                        created_at, vpos, created_at_text = jst_time(data.get('created_at')[:19])
                         data['created_at_JST'] = created_at
 
                         data['name'] = nickname
                         data['message'] = text
-                        data['vpos'] = created_at.timestamp() * 100
+                        data['vpos'] = vpos
 
                         minimum_cmt_info = f"{data['vpos']}{nickname}{text}"
-                        if minimum_cmt_info not in non_duplicate_cmt_list and not self.ng_pattern.search(
-                                minimum_cmt_info):
-                            non_duplicate_cmt_list.append(minimum_cmt_info)
+                        if not self.ng_pattern.search(minimum_cmt_info) and self.duplicate_filter.is_new(
+                                minimum_cmt_info, self.platform):
                             if nickname == '(・D・)':
-                                self.official.append(data)
+                                official.append(data)
                             else:
-                                self.normal.append(data)
-                                print(
-                                    f"index：{index:5}|{datetime.datetime.strftime(created_at, '%Y-%m-%d %H:%M:%S')}|{text}")
+                                normal.append(data)
+                                if interactive:
+                                    print(f"index：{index:5}|{created_at_text}|{text}")
                                 index += 1
 
+        if interactive:
             print('\n请先选择一条评论，输入其index\n再输入希望它在视频中出现的时间点')
 
             while True:
-                sample_index = int(input(f'index(0~{len(self.normal)}) = '))
-                if 0 <= sample_index <= len(self.normal):
+                sample_index = int(input(f'index(0~{len(normal)}) = '))
+                if 0 <= sample_index <= len(normal):
                     break
                 else:
                     print('[错误]输入值不在范围之内，请重新输入')
 
             while True:
                 sample_time = input('时间(x:xx:xx.xxx) = ')
-                if re.search('\d{1,2}:\d{2}:\d{2}.\d{2,3}', sample_time):
+                if VIDEO_TIME_PATTERN.search(sample_time):
                     break
                 else:
                     print('[错误]时间格式错误，请重新输入')
 
-            vpos_time_delta = self.normal[sample_index]['vpos'] - time_to_stamp(sample_time)
+            print(f'下次可以使用 --anchor_index {sample_index} --offset {sample_time} 跳过输入')
+        else:
+            sample_index = int(anchor['anchor_index'])
+            sample_time = anchor['offset']
+            if not 0 <= sample_index < len(normal):
+                raise ValueError(f'anchor_index不在范围之内(0~{len(normal) - 1}): {sample_index}')
+            if not VIDEO_TIME_PATTERN.search(sample_time):
+                raise ValueError(f'offset的格式应为x:xx:xx.xxx: {sample_time}')
 
-            for c in self.normal:
-                c['vpos'] = round(c['vpos'] - vpos_time_delta)
-            for c in self.official:
-                c['vpos'] = round(c['vpos'] - vpos_time_delta)
+        vpos_time_delta = normal[sample_index]['vpos'] - time_to_stamp(sample_time)
 
-            self.normal.sort(key=lambda x: x['vpos'])
-            self.official.sort(key=lambda x: x['vpos'])
+        for c in normal:
+            c['vpos'] = round(c['vpos'] - vpos_time_delta)
+        for c in official:
+            c['vpos'] = round(c['vpos'] - vpos_time_delta)
 
-        elif self.platform == 'YouTube':
-            with open(source, 'r', encoding='utf-8') as f_source:
-                chat = json.load(f_source)
+        normal.sort(key=lambda x: x['vpos'])
+        official.sort(key=lambda x: x['vpos'])
 
-            self.title = os.path.split(self.source)[1]
-            self.title = os.path.splitext(self.title)[0]
-            self.title = fix_invalid_file_name(self.title)
+        for c in normal:
+            yield 'normal', c
+        for c in official:
+            yield 'official', c
 
-            for c in chat:
-                c['name'] = c.get('author', {}).get('name')
-                c['vpos'] = round(c.get('time_in_seconds') * 100)
-                c['message'] = re.sub(':\w+?:', '', c['message'])
 
-                badges = c.get('author', {}).get('badges')
-                if badges:
-                    for badge in badges:
-                        if badge['title'] == 'Owner':
-                            self.official.append(c)
-                            break
-                else:
-                    self.normal.append(c)
-        elif self.platform == 'ASOBISTAGE':
-            t_start = time.time()
-
-            def asobi_time_to_vpos(a_time):
-                vpos = datetime.datetime.strptime(a_time[:19], '%Y-%m-%d %H:%M:%S')
-                return round(vpos.timestamp() * 100 + (int(a_time[20:23]) / 10))
-
-            def extract_info(c_line):
-                line = json.loads(c_line)
-                c_data = line.get('data')
-                if not c_data:
-                    return
-                comment = c_data['comment']
-
-                c_time = line['time']
-                line['vpos'] = asobi_time_to_vpos(c_time) - vpos_time_delta
-                if line['vpos'] < 0:
-                    return
-
-                user_name = c_data.get('userName')
-                line['name'] = c_data['userName']
-
-                comment = ''.join(comment)
-                comment = re.sub(':\(.*\)?:', '', comment)
-                line['message'] = comment
-
-                c_type = c_data['type']
-
-                minimum_cmt_info = f"{round(line['vpos'] / 100)}{user_name}{comment}"
-                if minimum_cmt_info not in non_duplicate_cmt_list and not self.ng_pattern.search(minimum_cmt_info):
-                    non_duplicate_cmt_list.append(minimum_cmt_info)
-                    if c_type == "official/send-comment":
-                        self.official.append(line)
-                    else:
-                        self.normal.append(line)
+class YoutubeAdapter(PlatformAdapter):
+    platform = 'YouTube'
+
+    def read(self):
+        with open(self.source, 'r', encoding='utf-8') as f_source:
+            chat = json.load(f_source)
+
+        self.title = self.file_title()
+
+        for c in chat:
+            c['name'] = c.get('author', {}).get('name')
+            c['vpos'] = round(c.get('time_in_seconds') * 100)
+            c['message'] = YOUTUBE_EMOJI_PATTERN.sub('', c['message'])
+
+            badges = c.get('author', {}).get('badges')
+            if badges:
+                for badge in badges:
+                    if badge['title'] == 'Owner':
+                        yield 'official', c
+                        break
+            else:
+                yield 'normal', c
+
+
+class AsobiAdapter(PlatformAdapter):
+    platform = 'ASOBISTAGE'
+
+    def read(self):
+        normal = []
+        official = []
+
+        def extract_info(line):
+            c_data = line.get('data')
+            if not c_data:
+                return
+            comment = c_data['comment']
+
+            c_time = line['time']
+            line['vpos'] = asobi_time_to_vpos(c_time) - vpos_time_delta
+            if line['vpos'] < 0:
+                return
 
-            os.startfile(source)
-            print('已打开原始文件\n请先选择一条评论作为调整弹幕时间的依据，输入其time值\n再输入希望它在视频中出现的时间点')
+            user_name = c_data.get('userName')
+            line['name'] = c_data['userName']
+
+            comment = ''.join(comment)
+            comment = ASOBI_EMOJI_PATTERN.sub('', comment)
+            line['message'] = comment
+
+            c_type = c_data['type']
+
+            minimum_cmt_info = f"{round(line['vpos'] / 100)}{user_name}{comment}"
+            if not self.ng_pattern.search(minimum_cmt_info) and self.duplicate_filter.is_new(
+                    minimum_cmt_info, self.platform):
+                if c_type == "official/send-comment":
+                    official.append(line)
+                else:
+                    normal.append(line)
+
+        anchor = self.read_anchor('anchor_time')
+        if anchor.get('anchor_time'):
+            sample_time_asobi = anchor['anchor_time']
+            sample_time = anchor['offset']
+            if not ASOBI_TIME_PATTERN.search(sample_time_asobi):
+                raise ValueError(f'anchor_time的格式应为xxxx-xx-xx xx:xx:xx.xxxxxxxxx: {sample_time_asobi}')
+            if not VIDEO_TIME_PATTERN.search(sample_time):
+                raise ValueError(f'offset的格式应为x:xx:xx.xxx: {sample_time}')
+        else:
+            # os.startfile只在Windows下可用
+            if hasattr(os, 'startfile'):
+                os.startfile(self.source)
+                print('已打开原始文件')
+            print('请先选择一条评论作为调整弹幕时间的依据，输入其time值\n再输入希望它在视频中出现的时间点')
 
             while True:
                 sample_time_asobi = input(f'time(xxxx-xx-xx xx:xx:xx.xxxxxxxxx)\n>')
-                if re.search('\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}.\d{9}', sample_time_asobi):
+                if ASOBI_TIME_PATTERN.search(sample_time_asobi):
                     break
                 else:
                     print('[错误]时间格式错误，请重新输入')
 
             while True:
                 sample_time = input('时间(x:xx:xx.xxx)\n>')
-                if re.search('\d{1,2}:\d{2}:\d{2}.\d{2,3}', sample_time):
+                if VIDEO_TIME_PATTERN.search(sample_time):
                     break
                 else:
                     print('[错误]时间格式错误，请重新输入')
 
-            vpos_time_delta = asobi_time_to_vpos(sample_time_asobi) - time_to_stamp(sample_time)
-
-            with open(source, 'r', encoding='utf-8') as f_source:
-                chat = f_source.read()
-            self.title = os.path.split(self.source)[1]
-            self.title = os.path.splitext(self.title)[0]
-            self.title = fix_invalid_file_name(self.title)
+            print(f'下次可以使用 --anchor_time "{sample_time_asobi}" --offset {sample_time} 跳过输入')
 
-            non_duplicate_cmt_list = []
+        vpos_time_delta = asobi_time_to_vpos(sample_time_asobi) - time_to_stamp(sample_time)
 
-            chat = chat.split('\n')
-
-            for i, c in enumerate(chat):
+        self.title = self.file_title()
 
+        # 逐行读取，不把整个文件读入内存
+        with open(self.source, 'r', encoding='utf-8') as f_source:
+            for c in f_source:
+                # 既没有评论也没有历史评论的帧(ping等)不需要解析
+                if '"data"' not in c and '"all"' not in c:
+                    continue
                 try:
-                    data = json.loads(c)
+                    data = fast_json_loads(c)
                 except Exception as e:
                     continue
 
                 chat_history = data.get('all')
                 if chat_history:
-
                     for h_c in chat_history:
-                        extract_info(h_c)
+                        extract_info(fast_json_loads(h_c))
                 else:
-                    extract_info(c)
+                    extract_info(data)
 
-            self.normal.sort(key=lambda x: x['vpos'])
-            self.official.sort(key=lambda x: x['vpos'])
+        normal.sort(key=lambda x: x['vpos'])
+        official.sort(key=lambda x: x['vpos'])
 
-            print(f'out: {stamp_to_time(round((time.time() - t_start) * 100))}')
-            print(f"normal: {len(self.normal)}")
-            print(f"official: {len(self.official)}")
-        elif self.platform == 'ニコニコチャンネルプラス':
-            def nchp_time_to_vpos(time_nchp):
-                import datetime
-                return round(datetime.datetime.strptime(time_nchp, '%Y-%m-%dT%H:%M:%S.%fZ').timestamp() * 100)
+        print(f"normal: {len(normal)}")
+        print(f"official: {len(official)}")
 
-            chat, operator_broadcasts_list = self.download_comment_nchp()
+        for c in normal:
+            yield 'normal', c
+        for c in official:
+            yield 'official', c
 
-            non_duplicate_cmt_list = []
 
-            for c in chat:
-                created_at = c.get('created_at')
-                vpos = nchp_time_to_vpos(created_at) - self.open_time
-                if vpos < 0:
-                    continue
+class NchpAdapter(PlatformAdapter):
+    platform = 'ニコニコチャンネルプラス'
+
+    headers = {
+        'fc_use_device': 'null',
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/101.0.4951.67 Safari/537.36', }
+
+    def read(self):
+        with self.stage('download') as record:
+            chat, operator_broadcasts_list = self.download()
+            record['count'] = len(chat)
+
+        normal = []
+        official = []
+        vote = []
+
+        for c in chat:
+            created_at = c.get('created_at')
+            vpos = nchp_time_to_vpos(created_at) - self.open_time
+            if vpos < 0:
+                continue
+
+            c['vpos'] = vpos
+
+            c['name'] = c.get('nickname')
+
+            if c.get('nickname') == 'ゲスト':
+                c['name'] = c.get('id')
+
+            minimum_cmt_info = f"{round(c['vpos'] / 100)}{c['message']}"
+
+            if c.get('priority'):
+                if not self.official_name:
+                    self.official_name = c['name']
+                if self.duplicate_filter.is_new(minimum_cmt_info, self.platform):
+                    official.append(c)
+            else:
+                normal.append(c)
+
+        for c in operator_broadcasts_list:
+            if type(c) == list:
 
-                c['vpos'] = vpos
+                for q in c:
 
-                c['name'] = c.get('nickname')
+                    if not q['elapsed_show_time']:
+                        continue
+                    q['vpos'] = round(q['elapsed_show_time'] / 10)
+                    vote.append(q)
+                continue
+            created_at = c.get('created_at')
+            c['vpos'] = nchp_time_to_vpos(created_at) - self.open_time
+            c['name'] = self.official_name
 
-                if c.get('nickname') == 'ゲスト':
-                    c['name'] = c.get('id')
+            c_type = c.get('type')
 
+            if c_type == 'announcement':
+                # 精简信息，提高去重速度
                 minimum_cmt_info = f"{round(c['vpos'] / 100)}{c['message']}"
 
-                if c.get('priority'):
-                    if not self.official_name:
-                        self.official_name = c['name']
-                    if minimum_cmt_info not in non_duplicate_cmt_list:
-                        non_duplicate_cmt_list.append(minimum_cmt_info)
-                        self.official.append(c)
-                else:
-                    self.normal.append(c)
+                if self.duplicate_filter.is_new(minimum_cmt_info, self.platform):
+                    official.append(c)
+            elif c_type == 'questionnaire':
 
-            for c in operator_broadcasts_list:
-                if type(c) == list:
+                vote.append(c)
 
-                    for q in c:
+        normal.sort(key=lambda x: x['vpos'])
+        official.sort(key=lambda x: x['vpos'])
+        vote.sort(key=lambda x: x['vpos'])
 
-                        if not q['elapsed_show_time']:
-                            continue
-                        q['vpos'] = round(q['elapsed_show_time'] / 10)
-                        self.vote.append(q)
-                    continue
-                created_at = c.get('created_at')
-                c['vpos'] = nchp_time_to_vpos(created_at) - self.open_time
-                c['name'] = self.official_name
+        for c in normal:
+            yield 'normal', c
+        for c in official:
+            yield 'official', c
+        for c in vote:
+            yield 'vote', c
+
+    def download(self):
+        """
+        下载ニコニコチャンネルプラス的评论，同时确定标题与开场时间
+        :return: (评论列表, operator_broadcasts_list)，后者的最后一项是投票列表
+        """
+        content_code = self.source.split('/')[-1]
+
+        cached = self.cache.load('nchp', content_code) if self.cache else None
+        if cached:
+            video_pages = cached['video_pages']
+            comments = cached['comments']
+            operator_broadcasts_list = cached['operator_broadcasts_list']
+        else:
+            import asyncio
+
+            video_pages, comments, operator_broadcasts_list = asyncio.run(fetch_nchp(content_code, self.headers))
+
+            # 直播中获取到的评论并不完整，不写入缓存
+            if self.cache and video_pages['data']['video_page'].get('live_finished_at'):
+                self.cache.save('nchp', content_code, {'video_pages': video_pages, 'comments': comments,
+                                                       'operator_broadcasts_list': operator_broadcasts_list})
+
+        self.title = fix_invalid_file_name(video_pages['data']['video_page']['title'])
+        self.title = fix_invalid_file_name(self.title)
+        open_time = video_pages['data']['video_page']['live_started_at']
+        self.open_time = round(local_timestamp(open_time) * 100)
+
+        video_questionnaires = video_pages['data']['video_page']['video_questionnaires']
+
+        if self.save:
+            with open(f"{self.title} video pages.json", 'w', encoding='utf-8') as f_dl:
+                f_dl.write(json.dumps(video_pages, ensure_ascii=False))
 
-                c_type = c.get('type')
+            with open(f"{self.title}.json", 'w', encoding='utf-8') as f_dl:
+                f_dl.write(json.dumps(comments, ensure_ascii=False))
+
+            with open(f"{self.title} operator broadcasts list.json", 'w', encoding='utf-8') as f_dl_o:
+                f_dl_o.write(json.dumps(operator_broadcasts_list, ensure_ascii=False))
+
+        operator_broadcasts_list.append(video_questionnaires)
+
+        return comments, operator_broadcasts_list
+
+    def poll(self, interval, limit=500):
+        """
+        轮询直播中的ニコニコチャンネルプラス评论，直到被中断(Ctrl+C)
+        每次轮询从最新的评论开始分段向前获取，直到遇到上一次已获取的评论，第一次轮询获取全部已有评论
+        运营的通知(operator broadcasts)每次轮询都重新获取，已处理过的通知按内容去重
+        :param interval: 轮询间隔(秒)
+        :param limit: 每段获取的评论数
+        :return: 生成器，每次轮询返回新获取到的(普通评论, 运营评论)，均已按出现时间排序
+        """
+        import asyncio
+
+        content_code = self.source.split('/')[-1]
+        url_history = f'{SHEETA_API}/messages.history'
+        comments_id = set()  # 之前的轮询中已获取的评论
+
+        async def fetch_new_history():
+            fetched = {}
+            url = f'{url_history}?limit={limit}'
+            while True:
+                chunk = await request_json(session, 'post', url, json=json_data)
+                new_comments = [c for c in chunk if c['id'] not in comments_id and c['id'] not in fetched]
+                fetched.update((c['id'], c) for c in new_comments)
+                # 遇到上一次已获取的评论、已没有更早的评论或无法再向前推进时，新评论已全部获取
+                if not new_comments or len(chunk) < limit or any(c['id'] in comments_id for c in chunk):
+                    break
+                # 与fetch_nchp相同，下一段包含这一段中最早的时刻
+                url = f"{url_history}?limit={limit}&older_than={nchp_time_after(min(c['created_at'] for c in chunk))}"
+            comments_id.update(fetched)
+            return list(fetched.values())
+
+        async def fetch_new():
+            return await asyncio.gather(
+                fetch_new_history(),
+                request_json(session, 'post', f'{SHEETA_API}/groups.operator-broadcasts.list', json=json_data))
+
+        with create_session(self.headers, retry=False) as session:
+            video_pages, json_data = asyncio.run(fetch_nchp_page(session, content_code))
+
+            self.title = fix_invalid_file_name(video_pages['data']['video_page']['title'])
+            open_time = video_pages['data']['video_page']['live_started_at']
+            self.open_time = round(local_timestamp(open_time) * 100)
+
+            while True:
+                comments, operator_broadcasts_list = asyncio.run(fetch_new())
+
+                normal = []
+                official = []
+                for c in comments:
+                    vpos = nchp_time_to_vpos(c.get('created_at')) - self.open_time
+                    if vpos < 0:
+                        continue
+                    c['vpos'] = vpos
+
+                    c['name'] = c.get('nickname')
+                    if c.get('nickname') == 'ゲスト':
+                        c['name'] = c.get('id')
+
+                    if c.get('priority'):
+                        if not self.official_name:
+                            self.official_name = c['name']
+                        # 与read相同，按出现时间与内容去重
+                        if self.duplicate_filter.is_new(f"{round(vpos / 100)}{c['message']}", self.platform):
+                            official.append(CommentRecord.from_dict(c))
+                    else:
+                        normal.append(CommentRecord.from_dict(c))
 
-                if c_type == 'announcement':
-                    # 精简信息，提高去重速度
-                    minimum_cmt_info = f"{round(c['vpos'] / 100)}{c['message']}"
+                for c in operator_broadcasts_list:
+                    if c.get('type') != 'announcement':
+                        continue
+                    c['vpos'] = nchp_time_to_vpos(c.get('created_at')) - self.open_time
+                    c['name'] = self.official_name
+                    # 每次轮询都会重新获取全部通知，已处理过的通知在这里被去除
+                    if self.duplicate_filter.is_new(f"{round(c['vpos'] / 100)}{c['message']}", self.platform):
+                        official.append(CommentRecord.from_dict(c))
+
+                normal.sort(key=lambda x: x.vpos)
+                official.sort(key=lambda x: x.vpos)
+                yield normal, official
 
-                    if minimum_cmt_info not in non_duplicate_cmt_list:
-                        non_duplicate_cmt_list.append(minimum_cmt_info)
-                        self.official.append(c)
-                elif c_type == 'questionnaire':
+                time.sleep(interval)
 
-                    self.vote.append(c)
 
-            self.normal.sort(key=lambda x: x['vpos'])
-            self.official.sort(key=lambda x: x['vpos'])
-            self.vote.sort(key=lambda x: x['vpos'])
-        elif self.platform == 'Openrec':
+class OpenrecAdapter(PlatformAdapter):
+    platform = 'Openrec'
+
+    headers = {
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.5005.63 Safari/537.36'
+    }
+
+    def read(self):
+        with self.stage('download') as record:
+            chats = self.download()
+            record['count'] = len(chats)
+
+        for c in chats:
+            c['name'] = c.get('user', {}).get('nickname')
+            if c['user']['is_official']:
+                yield 'official', c
+            else:
+                yield 'normal', c
 
-            chats = self.download_comment_openrec()
+    def download(self, slice_minutes=10, max_workers=8):
+        """
+        下载Openrec的评论
+        已结束的直播按时间分成若干段并发下载，每获取一页评论都会记录断点，中断后再次运行时从断点继续
+        :param slice_minutes: 每个时间段的长度(分钟)
+        :param max_workers: 同时下载的时间段数
+        """
+
+        def download_slice(index):
+            """
+            从时间段的起点开始逐页获取评论，直到获取到的评论超出该时间段
+            :return: 该时间段内的评论
+            """
+            slice_start, slice_end = slices[index]
+            progress = checkpoint.progress.get(index)
+            if progress:
+                get_from_created_at = parse_time_openrec(progress['from'])
+                if progress['done']:
+                    return progress['chats']
+                chats = progress['chats']
+            else:
+                get_from_created_at = slice_start
+                chats = []
+
+            comments_id = {c['id'] for c in chats}  # 存放评论id，用于去重
+            while True:
+                url_comment_from = f'{OPENREC_API}/movies/{live_id}/chats?from_created_at={format_time_openrec(get_from_created_at)}'
+
+                res_comments_from = session.get(url_comment_from, timeout=30)
+                res_comments_from.raise_for_status()
+                comments_ori = json.loads(res_comments_from.content)
+                if not comments_ori:
+                    checkpoint.save(index, get_from_created_at, True, [])
+                    return chats
+
+                # 找到这一次获取评论中时间最晚的那一条的时间，用作下一次获取评论的起始时间
+                latest_post_time = get_from_created_at
+
+                found_new_comment = False
+                new_chats = []
+                for c in comments_ori:
+                    posted_at = parse_time_openrec(c['posted_at'])  # 评论发布时间
+                    latest_post_time = max(posted_at, latest_post_time)
+
+                    # 属于下一个时间段的评论由下一个时间段负责获取
+                    if slice_end and posted_at >= slice_end:
+                        continue
+
+                    cmt_id = c['id']  # 评论id，用于去重
+                    if cmt_id not in comments_id:
+                        found_new_comment = True
+                        comments_id.add(cmt_id)
+                        new_chats.append(c)
+
+                chats.extend(new_chats)
+
+                # 没有新评论且起始时间无法再向后推进时也停止获取，避免同一秒内的评论超过一页时陷入死循环
+                done = (slice_end and latest_post_time >= slice_end) or (not found_new_comment and (
+                        len(comments_ori) < 5 or latest_post_time <= get_from_created_at))
+                get_from_created_at = latest_post_time
+                checkpoint.save(index, get_from_created_at, done, new_chats)
+                if done:
+                    return chats
+
+        live_id = self.source.split('/')[-1]
+
+        cached = self.cache.load('openrec', live_id) if self.cache else None
+        if cached:
+            page = cached['page']
+            chats_in_slices = cached['chats_in_slices']
+        else:
+            import concurrent.futures
+
+            # 某个时间段下载失败时同样关闭连接，已获取的进度保留在断点记录中
+            with create_session(self.headers, max_workers) as session:
+                response = session.get(f'{OPENREC_API}/movies/{live_id}', timeout=30)
+                response.raise_for_status()
+                page = json.loads(response.content)
+
+                # 以直播创建时间作为第一个获取评论的起始时间，直播已结束时按时间分段，最后一段不设终点
+                slices = []
+                slice_start = parse_time_openrec(page['created_at'])  # 直播创建时间
+                if page.get('ended_at'):  # 直播结束时间，直播中为空
+                    slice_length = datetime.timedelta(minutes=slice_minutes)
+                    time_end = parse_time_openrec(page['ended_at'])
+                    while slice_start + slice_length < time_end:
+                        slices.append((slice_start, slice_start + slice_length))
+                        slice_start += slice_length
+                slices.append((slice_start, None))
+
+                checkpoint = DownloadCheckpoint(f'openrec {fix_invalid_file_name(live_id)} checkpoint.jsonl',
+                                                [[format_time_openrec(t) if t else None for t in s] for s in slices])
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    chats_in_slices = list(executor.map(download_slice, range(len(slices))))
+
+            # 直播中获取到的评论并不完整，不写入缓存
+            if self.cache and page.get('ended_at'):
+                self.cache.save('openrec', live_id, {'page': page, 'chats_in_slices': chats_in_slices})
+            checkpoint.remove()
+
+        started_at = naive_seconds(page['started_at'])  # 直播实际开始时间
+
+        self.title = page['title']
+        self.title = fix_invalid_file_name(self.title)
 
+        comments = []  # 存放完整评论
+        for chats in chats_in_slices:
             for c in chats:
-                c['name'] = c.get('user', {}).get('nickname')
-                if c['user']['is_official']:
-                    self.official.append(c)
-                else:
-                    self.normal.append(c)
-
-    def download_comment_nchp(self):
+                # 相邻时间段的评论可能重复
+                if self.duplicate_filter.is_new(c['id'], self.platform):
+                    vpos = openrec_time_to_vpos(c['posted_at'], started_at)
+                    c['vpos'] = vpos if vpos > 0 else 0
+                    comments.append(c)
 
-        headers = {
-            'fc_use_device': 'null',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/101.0.4951.67 Safari/537.36', }
+        comments.sort(key=lambda x: x['vpos'])
 
-        content_code = self.source.split('/')[-1]
-        url_page = f'https://nfc-api.nicochannel.jp/fc/video_pages/{content_code}'
-        url_token = f'https://nfc-api.nicochannel.jp/fc/video_pages/{content_code}/comments_user_token'
+        if self.save:
+            with open(f"{self.title}.json", 'w', encoding='utf-8') as f_dl:
+                f_dl.write(json.dumps(comments, ensure_ascii=False))
 
-        token = json.loads(requests.get(url_token, headers=headers).text)['data']['access_token']
+        return comments
 
-        response_video_pages = requests.get(url_page, headers=headers)
-        video_pages = json.loads(response_video_pages.text)
+    def poll(self, interval):
+        """
+        轮询直播中的Openrec评论，直播结束后停止
+        :param interval: 轮询间隔(秒)
+        :return: 生成器，每次轮询返回新获取到的(普通评论, 运营评论)，均已按出现时间排序
+        """
+        live_id = self.source.split('/')[-1]
 
-        group_id = video_pages['data']['video_page']['video_comment_setting']['comment_group_id']
+        # 请求失败或轮询被中断时都会关闭连接
+        with create_session(self.headers) as session:
+            response = session.get(f'{OPENREC_API}/movies/{live_id}', timeout=30)
+            response.raise_for_status()
+            page = json.loads(response.content)
 
-        json_data = {'token': token, 'group_id': group_id}
+            self.title = fix_invalid_file_name(page['title'])
+            # 直播开始前started_at为空，以直播创建时间代替
+            time_start = naive_seconds(page.get('started_at') or page['created_at'])
 
-        self.title = fix_invalid_file_name(video_pages['data']['video_page']['title'])
-        self.title = fix_invalid_file_name(self.title)
-        open_time = video_pages['data']['video_page']['live_started_at']
-        self.open_time = round(datetime.datetime.strptime(open_time, '%Y-%m-%d %H:%M:%S').timestamp() * 100)
+            get_from_created_at = parse_time_openrec(page['created_at'])
+            posted_at_by_id = {}  # 起始时间之后已获取的评论，用于去重
 
-        number_of_comments = video_pages['data']['video_page']['video_aggregate_info']['number_of_comments']
-        number_of_comments_for_dl = number_of_comments + 500
+            while True:
+                new_chats = []
+                while True:
+                    url_comment_from = f'{OPENREC_API}/movies/{live_id}/chats?from_created_at={format_time_openrec(get_from_created_at)}'
+                    res_comments_from = session.get(url_comment_from, timeout=30)
+                    res_comments_from.raise_for_status()
+                    comments_ori = json.loads(res_comments_from.content)
+
+                    latest_post_time = get_from_created_at
+                    for c in comments_ori:
+                        posted_at = parse_time_openrec(c['posted_at'])
+                        latest_post_time = max(posted_at, latest_post_time)
+                        if c['id'] not in posted_at_by_id:
+                            posted_at_by_id[c['id']] = posted_at
+                            new_chats.append(c)
+
+                    # 起始时间无法再向后推进时，这一次轮询已获取到全部新评论
+                    if latest_post_time <= get_from_created_at:
+                        break
+                    get_from_created_at = latest_post_time
+                    posted_at_by_id = {cmt_id: posted_at for cmt_id, posted_at in posted_at_by_id.items()
+                                       if posted_at >= get_from_created_at}
+
+                normal = []
+                official = []
+                for c in new_chats:
+                    c['name'] = c.get('user', {}).get('nickname')
+                    c['vpos'] = max(openrec_time_to_vpos(c['posted_at'], time_start), 0)
+                    if c['user']['is_official']:
+                        official.append(CommentRecord.from_dict(c))
+                    else:
+                        normal.append(CommentRecord.from_dict(c))
 
-        video_questionnaires = video_pages['data']['video_page']['video_questionnaires']
+                normal.sort(key=lambda x: x.vpos)
+                official.sort(key=lambda x: x.vpos)
+                yield normal, official
 
-        url_comment = f'https://comm-api.sheeta.com/messages.history?limit={number_of_comments_for_dl}'
+                if not new_chats:
+                    response = session.get(f'{OPENREC_API}/movies/{live_id}', timeout=30)
+                    response.raise_for_status()
+                    if json.loads(response.content).get('ended_at'):
+                        return
+                time.sleep(interval)
 
-        comments = json.loads(requests.post(url_comment, headers=headers, json=json_data).text)
 
-        operator_broadcasts_list = json.loads(
-            requests.post('https://comm-api.sheeta.com/groups.operator-broadcasts.list', headers=headers,
-                          json=json_data).text)
+# 平台名 -> 平台适配器
+PLATFORM_ADAPTERS = {adapter.platform: adapter for adapter in (NcvAdapter, ZaikoAdapter, YoutubeAdapter, AsobiAdapter,
+                                                               NchpAdapter, OpenrecAdapter)}
 
-        if self.save:
-            with open(f"{self.title} video pages.json", 'w', encoding='utf-8') as f_dl:
-                f_dl.write(json.dumps(video_pages, ensure_ascii=False))
 
-            with open(f"{self.title}.json", 'w', encoding='utf-8') as f_dl:
-                f_dl.write(json.dumps(comments, ensure_ascii=False))
+class Comment:
+    def __init__(self, config=None):
+        """
+        :param config: 本次渲染使用的RenderConfig，只获取评论不生成弹幕时可以为None
+        """
+        self.config = None
+        self.style = None
+        self.width = None
+        self.height = None
 
-            with open(f"{self.title} operator broadcasts list.json", 'w', encoding='utf-8') as f_dl_o:
-                f_dl_o.write(json.dumps(operator_broadcasts_list, ensure_ascii=False))
+        self.ng_pattern = NG_PATTERN
+        self.duplicate_filter = DuplicateFilter()
 
-        operator_broadcasts_list.append(video_questionnaires)
+        self.title = None
+        self.platform = None
+        self.source = None
 
-        return comments, operator_broadcasts_list
+        self.open_time = None
+        self.official_name = None
 
-    def download_comment_openrec(self):
-        def reformat_time_openrec(time):
-            time_struct = datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S+09:00')
-            tdelta = datetime.timedelta(hours=9)
-            res = time_struct - tdelta
-            return datetime.datetime.strftime(res, '%Y-%m-%dT%H:%M:%S.000Z')
+        self.save = False
+        self.cache = None
+        self.profiler = None
+        # 对齐评论时间的依据(Zaiko/ASOBISTAGE)，包含anchor_index/anchor_time/offset，未指定的项为None
+        self.anchor = {}
+        # 安装了numpy时使用按列的向量运算计算弹幕布局，结果与逐条计算一致
+        self.columnar = HAS_NUMPY
 
-        def cal_vpos(time, time_start):
-            time = datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S+09:00')
-            time_start = datetime.datetime.strptime(time_start, '%Y-%m-%dT%H:%M:%S+09:00')
-            return int((time - time_start).total_seconds() * 100)
+        self.normal = []
+        self.normal_still = []
+        self.official = []
+        self.vote = []
+        self.comment_art = []
+        self.other = []
 
-        headers = {
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.5005.63 Safari/537.36'
-        }
+        self.cnt = 0
+        self.vote_cnt = 0
+        self.ca_cnt = 0
+        self.viewer_cnt = []
 
-        live_id = self.source.split('/')[-1]
+        self.d_comment_art = []
+        self.d_official = []
+        self.d_vote = []
+        self.d_normal = []
+        self.d_bg = []
 
-        response = requests.get(f'https://public.openrec.tv/external/api/v5/movies/{live_id}', headers=headers)
-        page = json.loads(response.content)
-        created_at = page['created_at']  # 直播创建时间
-        started_at = page['started_at']  # 直播实际开始时间
+        if config is not None:
+            self.set_config(config)
 
-        self.title = page['title']
-        self.title = fix_invalid_file_name(self.title)
+    def set_config(self, config):
+        """
+        :param config: 生成弹幕时使用的RenderConfig
+        """
+        self.config = config
+        self.style = config.style
+        self.width = config.width
+        self.height = config.height
+        # mail -> 其中的命令对应的ass标签字段，很多评论使用相同的mail，每种mail只解析一次
+        self.mail_cache = {}
 
-        # 获取评论时用到的时间时UTC+0的时间，需要把从page页获取到的时间从UTC+9转成UTC+0再用
-        # 以直播创建时间作为第一个获取评论的起始时间
-        get_from_created_at = reformat_time_openrec(created_at)
+        self.style_official = {'Name': '運営コメント',
+                               'Fontname': self.style['official']['font_name'],
+                               'Fontsize': str(self.style['official']['font_size']),
+                               'PrimaryColour': color(self.style['official']['color']),
+                               'SecondaryColour': '&H00B4FCFC',
+                               'OutlineColour': color(self.style['official']['outline_color']),
+                               'BackColour': '&H80000008',
+                               'Bold': '-1',
+                               'Italic': '0',
+                               'Underline': '0',
+                               'StrikeOut': '0',
+                               'ScaleX': '100',
+                               'ScaleY': '100',
+                               'Spacing': '0',
+                               'Angle': '0',
+                               'BorderStyle': '1',
+                               'Outline': str(self.style['official']['outline']),
+                               'Shadow': '0',
+                               'Alignment': '8',
+                               'MarginL': '0',
+                               'MarginR': '0',
+                               'MarginV': str(
+                                   self.style['official']['background']['marginV'] + self.style['official']['background'][
+                                       'paddingV']),
+                               'Encoding': '1'
+                               }
+        self.style_normal = {'Name': 'コメント',
+                             'Fontname': self.style['font_name'],
+                             'Fontsize': str(self.style['font_size']),
+                             'PrimaryColour': color(self.style['color']),
+                             'SecondaryColour': '&H00FFFFFF',
+                             'OutlineColour': color(self.style['outline_color']),
+                             'BackColour': '&H00000000',
+                             'Bold': '-1',
+                             'Italic': '0',
+                             'Underline': '0',
+                             'StrikeOut': '0',
+                             'ScaleX': '100',
+                             'ScaleY': '100',
+                             'Spacing': '0',
+                             'Angle': '0',
+                             'BorderStyle': '1',
+                             'Outline': str(self.style['outline']),
+                             'Shadow': '0',
+                             'Alignment': '7',
+                             'MarginL': '0',
+                             'MarginR': '0',
+                             'MarginV': '0',
+                             'Encoding': '1',
+                             }
+        self.style_comment_art = {'Name': 'コメントアート',
+                                  'Fontname': 'Yu Gothic',
+                                  'Fontsize': str(self.style['comment_art']['font_size']),
+                                  'PrimaryColour': color(self.style['comment_art']['color']),
+                                  'SecondaryColour': '&HFF0000FF',
+                                  'OutlineColour': color(self.style['comment_art']['outline_color']),
+                                  'BackColour': '&HFF000000',
+                                  'Bold': '-1',
+                                  'Italic': '0',
+                                  'Underline': '0',
+                                  'StrikeOut': '0',
+                                  'ScaleX': '128.5',
+                                  'ScaleY': '129',
+                                  'Spacing': '0',
+                                  'Angle': '0',
+                                  'BorderStyle': '1',
+                                  'Outline': str(self.style['comment_art']['outline']),
+                                  'Shadow': '0',
+                                  'Alignment': '7',
+                                  'MarginL': '0',
+                                  'MarginR': '0',
+                                  'MarginV': '0',
+                                  'Encoding': '1',
+                                  }
 
-        comments_id = []  # 存放评论id，用于去重
-        comments = []  # 存放完整评论
-        keep_get = True
-        while keep_get:
-            url_comment_from = f'https://public.openrec.tv/external/api/v5/movies/{live_id}/chats?from_created_at={get_from_created_at}'
+    def ass(self):
+        self.build_dialogues()
 
-            res_comments_from = requests.get(url_comment_from, headers=headers)
-            comments_ori = json.loads(res_comments_from.content)
+        f_out = io.StringIO()
+        self.write_ass(f_out)
+        return f_out.getvalue()
 
-            # 找到这一次获取评论中时间最晚的那一条的时间，用作下一次获取评论的起始时间
-            latest_post_time = datetime.datetime.strptime(comments_ori[0]['posted_at'], '%Y-%m-%dT%H:%M:%S+09:00')
+    def write_ass(self, f_out):
+        """
+        以流的方式写出ass文件，各条弹幕逐条写入，不在内存中拼接整个文件
+        需要先调用build_dialogues生成弹幕
+        :param f_out: 可写入文本的文件对象，如open()打开的文件或sys.stdout
+        """
+        self.write_header(f_out)
 
-            found_new_comment = False
-            for c in comments_ori:
-                posted_at = c['posted_at']  # 评论发布时间
-                latest_post_time = max(datetime.datetime.strptime(posted_at, '%Y-%m-%dT%H:%M:%S+09:00'),
-                                       latest_post_time)
-                vpos = cal_vpos(posted_at, started_at)
+        with self.stage('write_ass') as record:
+            for i, dialogue in enumerate(self.dialouges()):
+                if i:
+                    f_out.write('\n')
+                f_out.write(dialogue)
+            record['count'] = sum(len(d_list) for d_list in (self.d_comment_art, self.d_official, self.d_vote,
+                                                             self.d_normal, self.d_bg))
 
-                cmt_id = c['id']  # 评论id，用于去重
+    def write_header(self, f_out):
+        """
+        写出ass文件中弹幕之前的部分
+        """
+        f_out.write(f'''[Script Info]
+; Script generated by Aegisub 3.2.2
+; http://www.aegisub.org/
+ScriptType: v4.00+
+PlayResX: {self.width}
+PlayResY: {self.height}
+WrapStyle: 2
+ScaledBorderAndShadow: Yes
+Timing: 100.0000
 
-                if cmt_id not in comments_id:
-                    found_new_comment = True
-                    c['vpos'] = vpos if vpos > 0 else 0
-                    comments_id.append(cmt_id)
-                    comments.append(c)
+[Aegisub Project Garbage]
 
-            get_from_created_at = latest_post_time - datetime.timedelta(hours=9)
-            get_from_created_at = datetime.datetime.strftime(get_from_created_at, '%Y-%m-%dT%H:%M:%S.000Z')
+''')
 
-            if not found_new_comment and len(comments_ori) < 5:
-                keep_get = False
+        f_out.write(f"""[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: {','.join(self.style_official.values())}
+Style: {','.join(self.style_normal.values())}
+Style: {','.join(self.style_comment_art.values())}
 
-        comments.sort(key=lambda x: x['vpos'])
+""")
 
-        if self.save:
-            with open(f"{self.title}.json", 'w', encoding='utf-8') as f_dl:
-                f_dl.write(json.dumps(comments, ensure_ascii=False))
+        f_out.write('''[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+''')
 
-        return comments
+    def stage(self, name):
+        """
+        :return: 记录一个处理阶段的上下文，未设置profiler时不做任何记录
+        """
+        if self.profiler:
+            return self.profiler.stage(name)
+        return contextlib.nullcontext({})
 
-    # 评论分类
-    def reclassify_cmt(self):
-        self.get_data_raw()
-
-        if self.platform == 'ニコニコ生放送':
-            for c in self.data_raw:
-                # 屏蔽弹幕
-                if not self.ng_pattern.search(c['message']):
-                    if re.search(
-                            '(/trialpanel|/nicoad|/info|/disconnect|/play |/commentlock|/gift|/jump|/redirect|/spi)',
-                            c['message']):
-                        self.other.append(c)
-                    elif c.get('premium') and re.search('([37])', c.get('premium')):
-                        self.official.append(c)
-                        if '/vote' in c['message']:
-                            self.vote.append(c)
-
-                    elif re.search('\n', c['message']):
-                        c['layer'] = 10
-                        self.comment_art.append(c)
-                    elif c.get('mail') and re.search(r'(\bue|\bshita)', c.get('mail')):
-                        self.normal_still.append(c)
-                    else:
-                        self.normal.append(c)
+    def dialouges(self):
+        dialogue_list = [self.d_comment_art, self.d_official, self.d_vote, self.d_normal, self.d_bg]
+        for dialogue in dialogue_list:
+            for d in dialogue:
+                yield d.string()
 
-    def build_official(self):
-        default_time_delta = 15 * 100  # 15s
+    def build_dialogues(self):
+        self.reclassify_cmt()
+        self.layout()
 
-        for i, c in enumerate(self.official):
-            if not c['message']:
-                continue
+    def layout(self):
+        """
+        按照config生成弹幕，只读取已分类的评论而不修改它们
+        """
+        with self.stage('build_official') as record:
+            self.build_official()
+            record['count'] = len(self.d_official)
+        with self.stage('build_vote') as record:
+            self.build_vote()
+            record['count'] = self.vote_cnt
+        with self.stage('build_comment_art') as record:
+            self.build_comment_art()
+            record['count'] = len(self.d_comment_art)
+        with self.stage('build_normal') as record:
+            self.build_normal()
+            record['count'] = len(self.d_normal)
+
+    def timeline(self):
+        """
+        :return: 已分类评论的CommentTimeline，需要先调用reclassify_cmt
+        """
+        return CommentTimeline(self.platform, self.title, tuple(self.normal), tuple(self.normal_still),
+                               tuple(self.official), tuple(self.vote), tuple(self.comment_art), tuple(self.other),
+                               dict(self.duplicate_filter.dropped))
 
-            d = Dialogue()
-            d.layer = '6'
-            d.style = self.style_official['Name']
+    @classmethod
+    def from_timeline(cls, timeline, config):
+        """
+        :param timeline: ingest得到的CommentTimeline
+        :param config: 生成弹幕时使用的RenderConfig
+        :return: 可以直接调用layout的Comment，各分类直接引用timeline中的评论
+        """
+        cmt = cls(config)
+        cmt.platform = timeline.platform
+        cmt.title = timeline.title
+        cmt.normal = timeline.normal
+        cmt.normal_still = timeline.normal_still
+        cmt.official = timeline.official
+        cmt.vote = timeline.vote
+        cmt.comment_art = timeline.comment_art
+        cmt.other = timeline.other
+        cmt.duplicate_filter.dropped.update(timeline.dropped)
+        return cmt
+
+    def new_adapter(self):
+        """
+        :return: 读取当前评论源的平台适配器，与Comment共用去重与缓存等设置
+        """
+        return PLATFORM_ADAPTERS[self.platform](self.source, self.duplicate_filter, self.ng_pattern, self.save,
+                                                self.cache, self.anchor, self.profiler)
 
-            if '/clear' in c['message'] or '/vote' in c['message']:
-                continue
+    def get_data_raw(self):
+        """
+        用平台适配器获取评论，按分类加入各评论列表
+        :return: 获取到的评论数
+        """
+        adapter = self.new_adapter()
+        append = {'normal': self.normal.append, 'normal_still': self.normal_still.append,
+                  'official': self.official.append, 'vote': self.vote.append,
+                  'comment_art': self.comment_art.append, 'other': self.other.append}
+        cnt = 0
+        for category, c in adapter.comments():
+            append[category](c)
+            cnt += 1
+
+        self.title = adapter.title
+        self.open_time = adapter.open_time
+        self.official_name = adapter.official_name
+        return cnt
+
+    def write_live(self, interval=10, output_dir='.'):
+        """
+        实时模式：轮询直播中的评论，将显示时间已经结束的弹幕逐条追加写入ass文件
+        轨道分配器在整个直播期间持续使用，已写出的弹幕不会再被处理；直播结束或被中断(Ctrl+C)时写出剩余的弹幕
+        只处理普通评论与运营评论
+        :param interval: 轮询间隔(秒)
+        :param output_dir: ass文件的输出目录
+        :return: ass文件的路径
+        """
+        adapter = self.new_adapter()
+        if not hasattr(adapter, 'poll'):
+            raise ValueError(f'实时模式只支持Openrec/ニコニコチャンネルプラス: {self.platform}')
+        batches = adapter.poll(interval)
+
+        track_allocator = self.new_track_allocator()
+        pending_normal = []  # 尚未写出的弹幕，按出现时间排序
+        pending_official = None  # 消失时间还取决于下一条运营评论的运营评论
+        d_official = []  # 已写出、仍可能与尚未写出的弹幕重叠的运营评论
+        latest_vpos = 0  # 已获取到的评论中最晚的出现时间
+        normal_vpos = 0  # 最后一条弹幕的出现时间，之后的弹幕不会早于它
+        written_cnt = 0
+        path = None
+
+        def write(dialogues):
+            nonlocal written_cnt
+            for d in dialogues:
+                if written_cnt:
+                    f_out.write('\n')
+                f_out.write(d.string())
+                written_cnt += 1
+
+        def finalize_official(c_next):
+            nonlocal pending_official
+            dialogues = self.official_dialogue(pending_official, c_next)
+            pending_official = None
+            if dialogues:
+                d_official.append(dialogues[0])
+                self.d_official.append(dialogues[0])
+                write(dialogues)
+
+        def flush(vpos_limit):
+            """
+            写出在vpos_limit之前就已消失的弹幕
+            弹幕消失后15s(运营评论的默认显示时长)之内出现的运营评论都已确定显示时间，之后出现的运营评论不会与其重叠
+            """
+            nonlocal pending_normal
+            ready_cnt = 0
+            while ready_cnt < len(pending_normal) and \
+                    pending_normal[ready_cnt].vpos_out + self.official_time_delta <= vpos_limit:
+                ready_cnt += 1
+            if not ready_cnt:
+                return
+
+            d_official_all = self.d_official
+            self.d_normal = pending_normal[:ready_cnt]
+            pending_normal = pending_normal[ready_cnt:]
+            self.d_official = d_official
+            self.avoid_overlapping_with_official_comment()
+            write(self.d_normal)
+            self.cnt += len(self.d_normal)
+            self.d_normal = []
+            self.d_official = d_official_all
+
+            # 运营评论已不会与之后的弹幕重叠时不再保留
+            vpos_next = pending_normal[0].vpos_in if pending_normal else normal_vpos
+            d_official[:] = [d for d in d_official if d.vpos_out > vpos_next]
+
+        f_out = None
+        try:
+            for normal, official in batches:
+                if f_out is None:
+                    self.title = adapter.title
+                    path = os.path.join(output_dir, f'{self.title}.ass')
+                    f_out = open(path, 'w', encoding='utf_8_sig')
+                    self.write_header(f_out)
+
+                for c in official:
+                    self.official.append(c)
+                    if pending_official:
+                        finalize_official(c)
+                    pending_official = c
+                    latest_vpos = max(latest_vpos, c.vpos)
 
-            d.start = stamp_to_time(c['vpos'])
-            d.end = stamp_to_time(int(c['vpos']) + default_time_delta)
-            if self.platform == 'ニコニコチャンネルプラス':
+                for c in normal:
+                    self.normal.append(c)
+                    if not c.message:
+                        continue
+                    # 轨道分配要求按出现时间的顺序，迟到的评论从上一条弹幕的时间开始显示
+                    normal_vpos = max(c.vpos, normal_vpos)
+                    latest_vpos = max(latest_vpos, normal_vpos)
+                    pending_normal.append(self.normal_dialogue(c, track_allocator, vpos=normal_vpos))
+
+                if pending_official and pending_official.vpos + self.official_time_delta <= latest_vpos:
+                    finalize_official(None)
+                flush(latest_vpos)
+                f_out.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if f_out:
+                if pending_official:
+                    finalize_official(None)
+                flush(float('inf'))
+                f_out.close()
+
+        return path
 
-                if c.get('end_time_in_seconds'):
-                    d.end = stamp_to_time(int(c['vpos']) + c.get('end_time_in_seconds') * 100)
+    # 评论分类
+    def reclassify_cmt(self):
+        with self.stage('get_data_raw') as record:
+            record['count'] = self.get_data_raw()
 
-            if i < len(self.official) - 2:
-                c_next = self.official[i + 1]
-                # /clear: 手动清除命令 /perm: 不会经过一定时间后自动消失
-                if '/clear' in c_next['message'] or '/perm' in c['message'] or (
-                        int(c_next['vpos']) - int(c['vpos'])) < default_time_delta:
-                    d.end = stamp_to_time(c_next['vpos'])
+    # 运营评论的默认显示时长(0.01s)
+    official_time_delta = 15 * 100
 
-            d.vpos_in = c['vpos']
-            d.vpos_out = time_to_stamp(d.end)
+    def official_dialogue(self, c, c_next):
+        """
+        为一条运营评论生成弹幕及其背景
+        :param c: 运营评论
+        :param c_next: 下一条运营评论，它可能会令当前运营评论提前消失，为None时显示默认时长
+        :return: (弹幕, 背景)，不需要显示时返回None
+        """
+        if not c.message:
+            return None
 
-            c['message'] = re.sub('/perm ', '', c['message'])
+        d = Dialogue()
+        d.layer = '6'
+        d.style = self.style_official['Name']
 
-            text_length = len(c['message'])
-            if 'href' in c['message']:
-                msg = re.search('<.*>', c['message']).group(0)
-                msg = msg.replace('&', '&amp;')
-                doc = xml.dom.minidom.parseString(msg)
-                text = doc.getElementsByTagName('u')[0].firstChild.data
-                href = doc.getElementsByTagName('a')[0].getAttribute('href')
-                text_length = max(len(text), round(len(href) / 2))
+        if '/clear' in c.message or '/vote' in c.message:
+            return None
 
-                c['message'] = f'{text}\\N{href}'
+        d.vpos_in = c.vpos
+        d.vpos_out = int(c.vpos) + self.official_time_delta
+        if self.platform == 'ニコニコチャンネルプラス':
 
-            d.text = c['message']
+            if c.end_time:
+                d.vpos_out = int(c.vpos) + c.end_time * 100
+
+        if c_next:
+            # /clear: 手动清除命令 /perm: 不会经过一定时间后自动消失
+            if '/clear' in c_next.message or '/perm' in c.message or (
+                    int(c_next.vpos) - int(c.vpos)) < self.official_time_delta:
+                d.vpos_out = c_next.vpos
+
+        # 评论在多次渲染之间共用，不修改原评论
+        message = re.sub('/perm ', '', c.message)
+
+        text_length = len(message)
+        if 'href' in message:
+            msg = re.search('<.*>', message).group(0)
+            msg = msg.replace('&', '&amp;')
+            import xml.dom.minidom
+            doc = xml.dom.minidom.parseString(msg)
+            text = doc.getElementsByTagName('u')[0].firstChild.data
+            href = doc.getElementsByTagName('a')[0].getAttribute('href')
+            text_length = max(len(text), round(len(href) / 2))
+
+            message = f'{text}\\N{href}'
+
+        d.text = message
+
+        name = c.name
+        if name and self.platform != 'ニコニコチャンネルプラス':
+            d.name = name
+            if not self.platform != 'ニコニコチャンネルプラス':
+                d.text = f"{name}「{message}」"
+                text_length += len(f"{name}「」")
+        else:
+            d.name = '運営'
 
-            name = c.get('name')
-            if name and self.platform != 'ニコニコチャンネルプラス':
-                d.name = name
-                if not self.platform != 'ニコニコチャンネルプラス':
-                    d.text = f"{name}「{c['message']}」"
-                    text_length += len(f"{name}「」")
-            else:
-                d.name = '運営'
+        max_text_width_available = self.width - 2 * (
+                self.style['official']['background']['marginH'] + self.style['official']['background']['paddingH'])
+        max_font_size_available = math.floor(max_text_width_available / text_length)
 
-            max_text_width_available = WIDTH - 2 * (
-                    style['official']['background']['marginH'] + style['official']['background']['paddingH'])
-            max_font_size_available = math.floor(max_text_width_available / text_length)
+        font_size = self.style['official']['font_size']
+        if font_size > max_font_size_available:
+            font_size = max_font_size_available
+            d.tag.set_font_size(font_size)
 
-            font_size = style['official']['font_size']
-            if font_size > max_font_size_available:
-                font_size = max_font_size_available
-                d.tag.set_font_size(font_size)
+        d.font_size = font_size
 
-            d.font_size = font_size
+        print(f"[OFFICIAL] {d.start} {d.end} {stamp_to_time(d.vpos_out - d.vpos_in)} {d.text}")
 
-            self.d_official.append(d)
-            print(f"[OFFICIAL] {d.start} {d.end} {stamp_to_time(d.vpos_out - d.vpos_in)} {d.text}")
+        # 生成背景
+        row_cnt = len(re.findall(r'\\N', d.text)) + 1
+        d.text_row_cnt = row_cnt
 
-            # 生成背景
-            row_cnt = len(re.findall(r'\\N', d.text)) + 1
-            d.text_row_cnt = row_cnt
+        d_bg = d.clone()
+        d_bg.tag.set_pos(round(self.width / 2), self.style['official']['background']['marginV'])
+        d_bg.draw_bg_official(font_size, self.config)
 
-            d_bg = deepcopy(d)
-            d_bg.tag.set_pos(round(WIDTH / 2), style['official']['background']['marginV'])
-            d_bg.draw_bg_official(font_size)
+        return d, d_bg
 
-            self.d_bg.append(d_bg)
+    def build_official(self):
+        for i, c in enumerate(self.official):
+            c_next = self.official[i + 1] if i < len(self.official) - 1 else None
+            dialogues = self.official_dialogue(c, c_next)
+            if dialogues:
+                d, d_bg = dialogues
+                self.d_official.append(d)
+                self.d_bg.append(d_bg)
 
     def build_vote(self):
         if not self.vote:
@@ -965,13 +2409,13 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 
                     question = payload.get('question')
                     choices = payload.get('video_questionnaire_options')
-                choices.sort(key=lambda x: x['id'])
+                choices = sorted(choices, key=lambda x: x['id'])
 
             self.vote_cnt += 1
 
             d_question = Dialogue()
             d_question.layer = '7'
-            d_question.start = stamp_to_time(cmt['vpos'])
+            d_question.vpos_in = cmt['vpos']
 
             d_question.name = 'アンケート 問題'
             d_question.text = question
@@ -992,40 +2436,40 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                             elif cmt_search['payload']['type'] == 'questionnaire_hide_result':
                                 cmt_stop = cmt_search
                                 break
-                d_question.end = stamp_to_time(cmt_stop['vpos'])
+                d_question.vpos_out = cmt_stop['vpos']
             else:
-                d_question.end = stamp_to_time(round(cmt['elapsed_hide_result_time'] / 10))
+                d_question.vpos_out = round(cmt['elapsed_hide_result_time'] / 10)
                 cmt_result = True
 
-            width_text_question = len(question) * style['vote']['question']['font_size']
+            width_text_question = len(question) * self.style['vote']['question']['font_size']
 
-            height_bg_question = style['vote']['question']['font_size'] + style['vote']['question']['bg'][
+            height_bg_question = self.style['vote']['question']['font_size'] + self.style['vote']['question']['bg'][
                 'paddingV'] * 2
-            height_bg_choice = style['vote']['choice']['font_size'] + style['vote']['choice']['bg']['paddingV'] * 2
+            height_bg_choice = self.style['vote']['choice']['font_size'] + self.style['vote']['choice']['bg']['paddingV'] * 2
 
-            height_choices_section = height_bg_choice * len(choices) + style['vote']['choice']['bg']['marginV'] * (
+            height_choices_section = height_bg_choice * len(choices) + self.style['vote']['choice']['bg']['marginV'] * (
                     len(choices) - 1)
 
-            x_bottom_left_question = style['vote']['container']['marginH'] + style['vote']['container'][
-                'padding_left'] + style['vote']['question']['bg']['paddingH']
-            y_bottom_left_question = style['vote']['container']['marginV'] + style['vote']['container'][
+            x_bottom_left_question = self.style['vote']['container']['marginH'] + self.style['vote']['container'][
+                'padding_left'] + self.style['vote']['question']['bg']['paddingH']
+            y_bottom_left_question = self.style['vote']['container']['marginV'] + self.style['vote']['container'][
                 'padding_bottom'] \
-                                     + height_choices_section + style['vote']['question']['bg']['margin_bottom'] + \
-                                     style['vote']['question']['bg']['paddingV']
+                                     + height_choices_section + self.style['vote']['question']['bg']['margin_bottom'] + \
+                                     self.style['vote']['question']['bg']['paddingV']
 
             x_question = x_bottom_left_question
-            y_question = HEIGHT - y_bottom_left_question
+            y_question = self.height - y_bottom_left_question
 
             # 令投票区域不超出画面左半边的，问题的最大长度
-            max_width_text_question_available = math.floor((WIDTH / 2) - (x_question * 2))
+            max_width_text_question_available = math.floor((self.width / 2) - (x_question * 2))
             if width_text_question > max_width_text_question_available:
                 width_text_question = max_width_text_question_available
                 max_font_size_question_available = math.floor(max_width_text_question_available / len(question))
-                fscx_value = round(max_font_size_question_available / style['vote']['question']['font_size'] * 100)
+                fscx_value = round(max_font_size_question_available / self.style['vote']['question']['font_size'] * 100)
                 d_question.tag.other += rf'\fscx{fscx_value}'
 
-            d_question.tag.set_font_name(style['vote']['question']['font_name'])
-            d_question.tag.set_font_size(style['vote']['question']['font_size'])
+            d_question.tag.set_font_name(self.style['vote']['question']['font_name'])
+            d_question.tag.set_font_size(self.style['vote']['question']['font_size'])
 
             d_question.tag.set_alignment(1)
             d_question.tag.set_pos(x_question, y_question)
@@ -1038,38 +2482,38 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
             for i, choice in enumerate(choices):
                 if self.platform != 'ニコニコチャンネルプラス':
                     max_width_text_choice = max(max_width_text_choice,
-                                                len(choice) * style['vote']['choice']['font_size'])
+                                                len(choice) * self.style['vote']['choice']['font_size'])
                 else:
                     max_width_text_choice = max(max_width_text_choice,
-                                                len(choice['text']) * style['vote']['choice']['font_size'])
+                                                len(choice['text']) * self.style['vote']['choice']['font_size'])
 
             if self.platform != 'ニコニコチャンネルプラス':
-                width_text_total = max_width_text_choice + style['vote']['result']['margin_left'] + len('100.0%') * \
-                                   style['vote']['choice']['font_size']
+                width_text_total = max_width_text_choice + self.style['vote']['result']['margin_left'] + len('100.0%') * \
+                                   self.style['vote']['choice']['font_size']
             else:
-                width_text_total = max_width_text_choice + style['vote']['result']['margin_left'] + 7 * \
-                                   style['vote']['choice']['font_size']
+                width_text_total = max_width_text_choice + self.style['vote']['result']['margin_left'] + 7 * \
+                                   self.style['vote']['choice']['font_size']
 
             width_text_total = max(width_text_total, width_text_question)
-            width_bg_total = width_text_total + style['vote']['question']['bg']['paddingH'] * 2
+            width_bg_total = width_text_total + self.style['vote']['question']['bg']['paddingH'] * 2
 
             # 添加背景
-            d_bg_question = deepcopy(d_question)
+            d_bg_question = d_question.clone()
             d_bg_question.tag.other = ''
 
-            x_bg_question = x_question - style['vote']['question']['bg']['paddingH']
-            y_bg_bottom_left_question = y_bottom_left_question - style['vote']['question']['bg']['paddingV']
-            y_bg_question = HEIGHT - y_bg_bottom_left_question
+            x_bg_question = x_question - self.style['vote']['question']['bg']['paddingH']
+            y_bg_bottom_left_question = y_bottom_left_question - self.style['vote']['question']['bg']['paddingV']
+            y_bg_question = self.height - y_bg_bottom_left_question
             d_bg_question.tag.set_pos(x_bg_question, y_bg_question)
 
-            d_bg_question.draw_bg_vote_question(width_bg_total, height_bg_question)
+            d_bg_question.draw_bg_vote_question(width_bg_total, height_bg_question, self.config)
 
             self.d_bg.append(d_bg_question)
 
             d_bgs_result = []
             # 处理选项
             for i, choice in enumerate(choices):
-                d_choice = deepcopy(d_question)
+                d_choice = d_question.clone()
                 d_choice.tag.other = ''
 
                 d_choice.name = 'アンケート 選択肢'
@@ -1079,16 +2523,16 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                 else:
                     d_choice.text = choice['text']
 
-                d_choice.tag.set_font_name(style['vote']['choice']['font_name'])
-                d_choice.tag.set_font_size(style['vote']['choice']['font_size'])
+                d_choice.tag.set_font_name(self.style['vote']['choice']['font_name'])
+                d_choice.tag.set_font_size(self.style['vote']['choice']['font_size'])
 
                 x_choice = x_question
-                y_bottom_left_choice = style['vote']['container']['marginV'] + style['vote']['container'][
+                y_bottom_left_choice = self.style['vote']['container']['marginV'] + self.style['vote']['container'][
                     'padding_bottom'] \
                                        + (len(choices) - 1 - i) * (
-                                               height_bg_choice + style['vote']['choice']['bg']['marginV']) + \
-                                       style['vote']['choice']['bg']['paddingV']
-                y_choice = HEIGHT - y_bottom_left_choice
+                                               height_bg_choice + self.style['vote']['choice']['bg']['marginV']) + \
+                                       self.style['vote']['choice']['bg']['paddingV']
+                y_choice = self.height - y_bottom_left_choice
 
                 d_choice.tag.set_alignment(1)
                 d_choice.tag.set_pos(x_choice, y_choice)
@@ -1098,15 +2542,15 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                 print(f'[VOTE]  [CHOICE] {d_choice.start} {d_choice.end} {d_choice.text}')
 
                 # 添加背景
-                d_bg_choice = deepcopy(d_choice)
+                d_bg_choice = d_choice.clone()
 
                 x_bg_choice = x_bg_question
-                y_bg_choice = y_choice + style['vote']['choice']['bg']['paddingV']
+                y_bg_choice = y_choice + self.style['vote']['choice']['bg']['paddingV']
                 d_bg_choice.tag.set_pos(x_bg_choice, y_bg_choice)
 
-                d_bg_choice.draw_bg_vote_choice(width_bg_total, height_bg_choice)
+                d_bg_choice.draw_bg_vote_choice(width_bg_total, height_bg_choice, self.config)
 
-                d_bgs_result.append(deepcopy(d_bg_choice))
+                d_bgs_result.append(d_bg_choice.clone())
                 self.d_bg.append(d_bg_choice)
 
             # 处理结果
@@ -1118,11 +2562,11 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                 d_result_base.name = 'アンケート 結果'
 
                 if not cmt.get('question'):
-                    d_result_base.start = stamp_to_time(cmt_result['vpos'])
-                    d_result_base.end = stamp_to_time(cmt_stop['vpos'])
+                    d_result_base.vpos_in = cmt_result['vpos']
+                    d_result_base.vpos_out = cmt_stop['vpos']
                 else:
-                    d_result_base.start = stamp_to_time(round(cmt['elapsed_result_time'] / 10))
-                    d_result_base.end = stamp_to_time(round(cmt['elapsed_hide_result_time'] / 10))
+                    d_result_base.vpos_in = round(cmt['elapsed_result_time'] / 10)
+                    d_result_base.vpos_out = round(cmt['elapsed_hide_result_time'] / 10)
 
                 # 添加投票倒计时
 
@@ -1130,14 +2574,14 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                     results = cmt_result['message'].split(' ')[3:]
                 else:
                     if not cmt.get('question'):
-                        results = cmt_result['payload']['video_questionnaire_results']
+                        results = list(cmt_result['payload']['video_questionnaire_results'])
 
                         if len(results) != len(choices):
                             option_id_list = [r['id'] for r in results]
 
                             for choice in choices:
                                 if choice['id'] not in option_id_list:
-                                    res_add = deepcopy(results[0])
+                                    res_add = dict(results[0])
                                     option_id_list.append(choice['id'])
                                     if res_add.get('count_video_questionnaire_user_answers') is not None:
                                         res_add['count_video_questionnaire_user_answers'] = 0
@@ -1150,7 +2594,7 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 
                 sum_result_value = 0
                 for i, result_value in enumerate(results):
-                    d_result = deepcopy(d_result_base)
+                    d_result = d_result_base.clone()
 
                     if self.platform != 'ニコニコチャンネルプラス':
                         result_value = int(result_value) / 10
@@ -1181,17 +2625,17 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                                 result_value = '0%'
                             d_result.text = result_value
 
-                    d_result.tag.set_font_size(style['vote']['choice']['font_size'])
+                    d_result.tag.set_font_size(self.style['vote']['choice']['font_size'])
 
                     x_result = x_question + width_text_total
 
-                    y_bottom_left_result = style['vote']['container']['marginV'] + style['vote']['container'][
+                    y_bottom_left_result = self.style['vote']['container']['marginV'] + self.style['vote']['container'][
                         'padding_bottom'] \
                                            + (len(choices) - 1 - i) * (
-                                                   height_bg_choice + style['vote']['choice']['bg']['marginV'
+                                                   height_bg_choice + self.style['vote']['choice']['bg']['marginV'
                                                                                                     '']) + \
-                                           style['vote']['choice']['bg']['paddingV']
-                    y_result = HEIGHT - y_bottom_left_result
+                                           self.style['vote']['choice']['bg']['paddingV']
+                    y_result = self.height - y_bottom_left_result
 
                     d_result.tag.set_alignment(3)
                     d_result.tag.set_pos(x_result, y_result)
@@ -1200,38 +2644,43 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                     print(f'[VOTE]  [RESULT] {d_result.start} {d_result.end} {d_result.text}')
 
                     d_bg_result = d_bgs_result[i]
-                    d_bg_result.start = d_result.start
-                    d_bg_result.end = d_result.end
-                    d_bg_result.draw_bg_vote_result(x_bg_question, width_bg_total, result_value)
+                    d_bg_result.vpos_in = d_result.vpos_in
+                    d_bg_result.vpos_out = d_result.vpos_out
+                    d_bg_result.draw_bg_vote_result(x_bg_question, width_bg_total, result_value, self.config)
 
                     self.d_bg.append(d_bg_result)
 
                 # 投票截至倒计时
-                d_countdown = deepcopy(d_bg_question)
+                d_countdown = d_bg_question.clone()
                 d_countdown.tag.other = ''
                 d_countdown.layer = '6'
-                d_countdown.start = stamp_to_time(cmt['vpos'])
+                d_countdown.vpos_in = cmt['vpos']
 
                 d_countdown.name = 'アンケート countdown'
 
                 if not cmt.get('question'):
-                    d_countdown.end = stamp_to_time(cmt_result['vpos'])
+                    d_countdown.vpos_out = cmt_result['vpos']
                 else:
-                    d_countdown.end = stamp_to_time(round(cmt['elapsed_result_time'] / 10))
+                    d_countdown.vpos_out = round(cmt['elapsed_result_time'] / 10)
 
-                d_countdown.set_default_bg_style(style['vote']['countdown'])
-                d_countdown.tag.clip = rf"\clip(0, 0, {x_bg_question + width_bg_total}, {HEIGHT})\t(\clip(0, 0, {x_bg_question}, {HEIGHT}))"
+                d_countdown.set_default_bg_style(self.style['vote']['countdown'])
+                d_countdown.tag.clip = rf"\clip(0, 0, {x_bg_question + width_bg_total}, {self.height})\t(\clip(0, 0, {x_bg_question}, {self.height}))"
                 self.d_bg.append(d_countdown)
 
     def build_comment_art(self):
         if not self.comment_art:
             return
 
+        # 评论在多次渲染之间共用，合并CA时调整后的时间、图层与宽度记录在这里，不修改原评论
+        vpos_list = [c.vpos for c in self.comment_art]
+        layer_list = [c.layer for c in self.comment_art]
+        total_length_list = [0] * len(self.comment_art)
+
         single_c_art_index_list = []
         total_length = 0
         for i in range(len(self.comment_art)):
             max_length = 0
-            for line in self.comment_art[i]['message'].split('\n'):
+            for line in self.comment_art[i].message.split('\n'):
                 max_length = max(max_length, len(line))
 
             if i == 0:
@@ -1239,52 +2688,52 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 
                 single_c_art_index_list.append(0)
                 total_length = max(total_length, max_length)
-                self.comment_art[i]['total_length'] = total_length
-            elif abs(int(self.comment_art[i]['vpos']) - int(self.comment_art[i - 1]['vpos'])) < 100:
+                total_length_list[i] = total_length
+            elif abs(int(vpos_list[i]) - int(vpos_list[i - 1])) < 100:
                 # ca由多段弹幕组成，当前弹幕与上一条同属于一个CA
-                self.comment_art[i]['vpos'] = self.comment_art[i - 1]['vpos']
-                self.comment_art[i]['layer'] = self.comment_art[i]['layer'] + 1
+                vpos_list[i] = vpos_list[i - 1]
+                layer_list[i] = layer_list[i] + 1
                 if max_length > total_length:
                     total_length = max_length
                     for index in single_c_art_index_list:
-                        self.comment_art[index]['total_length'] = total_length
-                self.comment_art[i]['total_length'] = total_length
+                        total_length_list[index] = total_length
+                total_length_list[i] = total_length
                 single_c_art_index_list.append(i)
-            elif abs(int(self.comment_art[i]['vpos']) - int(self.comment_art[i - 1]['vpos'])) >= 100:
+            elif abs(int(vpos_list[i]) - int(vpos_list[i - 1])) >= 100:
 
                 self.ca_cnt += 1
 
                 total_length = max_length
-                self.comment_art[i]['total_length'] = total_length
+                total_length_list[i] = total_length
                 single_c_art_index_list = [i]
 
         for i, c_art in enumerate(self.comment_art):
             max_length = 0
-            for line in c_art['message'].split('\n'):
+            for line in c_art.message.split('\n'):
                 max_length = max(max_length, len(line))
 
         for i, cmt in enumerate(self.comment_art):
             d = Dialogue()
 
-            d.layer = str(cmt['layer'])
+            d.layer = str(layer_list[i])
 
-            d.start = stamp_to_time(cmt['vpos'])
-            d.end = stamp_to_time((int(cmt['vpos']) + style['displayed_time'] * 100))
+            d.vpos_in = vpos_list[i]
+            d.vpos_out = int(vpos_list[i]) + self.style['displayed_time'] * 100
             d.style = self.style_comment_art['Name']
 
-            if cmt.get('name'):
-                d.name = cmt.get('name')
+            if cmt.name:
+                d.name = cmt.name
             else:
-                d.name = cmt.get('user_id')
+                d.name = cmt.user_id
 
-            line_height = style['comment_art']['font_size']
+            line_height = self.style['comment_art']['font_size']
             command_list = []
-            if cmt.get('mail'):
-                command_list = cmt.get('mail').split(' ')
+            if cmt.mail:
+                command_list = cmt.mail.split(' ')
                 for command in command_list:
                     if command in d.tag.color_command:
                         d.tag.set_color(d.tag.color_command[command])
-                    elif re.search('#.{6}', command):
+                    elif COLOR_CODE_PATTERN.search(command):
                         d.tag.set_color(command)
                     elif command == 'small':
                         line_height = round(line_height * 0.6)
@@ -1297,305 +2746,791 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                     elif command == 'gothic':
                         d.tag.set_font_name('Yu Gothic')
 
-            c_art = cmt['message'].split('\n')
+            c_art = cmt.message.split('\n')
 
             width_c_art_total = 0
             for line in c_art:
-                width_c_art_total = max(len(line) * style['comment_art']['font_size'], width_c_art_total)
+                width_c_art_total = max(len(line) * self.style['comment_art']['font_size'], width_c_art_total)
 
             for j, line in enumerate(c_art):
 
-                d_art_line = deepcopy(d)
+                d_art_line = d.clone()
                 d_art_line.text = line
 
                 if 'ue' in command_list:
-                    x = round((WIDTH - cmt['total_length'] * line_height) / 2)
+                    x = round((self.width - total_length_list[i] * line_height) / 2)
                     y = j * line_height
                     d_art_line.tag.set_pos(x, y)
                 else:
-                    x1 = WIDTH
-                    x2 = -(cmt['total_length'] * style['comment_art']['font_size'])
+                    x1 = self.width
+                    x2 = -(total_length_list[i] * self.style['comment_art']['font_size'])
                     y = j * line_height
                     d_art_line.tag.set_move(x1, x2, y)
 
                 self.d_comment_art.append(d_art_line)
 
-    def build_normal(self):
-        line_height = style['font_size'] + style['spacing']
+    def new_track_allocator(self):
+        """
+        :return: 与当前画面尺寸和轨道数对应的空TrackAllocator
+        """
+        line_height = self.style['font_size'] + self.style['spacing']
 
-        row_cnt_base = style['row_cnt_base']
+        row_cnt_base = self.style['row_cnt_base']
 
-        ans = HEIGHT + style['spacing'] - line_height / 2
+        ans = self.height + self.style['spacing'] - line_height / 2
         ans = ans / line_height
         row_cnt_inserted = math.floor(ans)
 
         row_cnt = row_cnt_base + row_cnt_inserted
 
-        # 创建一个长度等于弹幕总轨道数的列表，存放各轨道的最新弹幕
-        cmt_in_row = [None for _ in range(row_cnt)]
-
-        for cmt in self.normal:
-            if not cmt['message']:
-                continue
-            d = Dialogue()
-            d.has_been_moved_down = False
-            d.raw = cmt
-            d.start = stamp_to_time(cmt['vpos'])
-            d.end = stamp_to_time((int(cmt['vpos']) + style['displayed_time'] * 100))
-            d.style = self.style_normal['Name']
-
-            name = cmt.get('name')
-            if name:
-                d.name = name
-            else:
-                d.name = cmt.get('user_id')
-
-            self.viewer_cnt.append(d.name)
-
-            d.text = cmt['message']
-
-            text_length = len(cmt['message']) * style['font_size']
-            speed = (text_length + WIDTH) / (style['displayed_time'] * 100)
-            d.speed = speed
-
-            # 调整非会员弹幕的透明度
-            if cmt.get('premium') and re.search('(24|25)', cmt.get('premium')):
-                d.tag.set_opacity(1 - style['color']['a'] * 0.6)
-                d.tag.set_outline_opacity(1 - style['outline_color']['a'] * 0.6)
-                # print(cmt)
-
-            # 分配轨道
-            row = None
-            min_collision = float('inf')  # 无穷大
-            # 依次与每条轨道上的最新弹幕进行碰撞检测，找出最大重叠长度最小的轨道作为当前评论的最优轨道
-            for i in range(row_cnt):
-                c = self.collision(cmt_in_row[i], cmt)  # 与该轨道最新弹幕的最大重叠长度
-                # 不会发生碰撞，立即退出检测
-                if c <= 0:
-                    row = i
-                    break
-                elif c < min_collision:
-                    min_collision = c
-                    row = i
-            cmt_in_row[row] = cmt
-
-            x1 = WIDTH
-            x2 = -text_length
-            if row < row_cnt_base:
-                y = (style['font_size'] + style['spacing']) * row
-            else:
-                y = (style['font_size'] + style['spacing']) * (row - row_cnt_base + (1 / 2))
-
-            y = round(y)
-
-            d.tag.set_move(x1, x2, y)
-
-            # 处理command
-            if cmt.get('mail'):
-                command_list = cmt.get('mail').split(' ')
-                d.tag.translate_command(command_list)
-
-            self.d_normal.append(d)
-
-        self.cnt += len(self.d_normal)
-
-        self.avoid_overlapping_with_official_comment()
-
-    def avoid_overlapping_with_official_comment(self):
-        if self.d_official:
-            for i, d in enumerate(self.d_normal):
-                d.vpos_in = time_to_stamp(d.start)
-                d.vpos_out = time_to_stamp(d.end)
-                speed = d.speed
-
-                x1 = d.tag.x1
-                x2 = d.tag.x2
-                y = d.tag.y
-
-                if d.vpos_out <= self.d_official[0].vpos_in or d.vpos_in >= self.d_official[-1].vpos_out:
-                    continue
-                else:
-                    for j, d_official in enumerate(self.d_official):
-                        ans = d_official.font_size * d_official.text_row_cnt + \
-                              style['official']['background'][
-                                  'paddingV'] * 2  # 运营评论背景高度
-                        height_move_down = ans + style['official']['background']['marginV'] * 2
-
-                        if (y + height_move_down + style['font_size']) > HEIGHT:
-                            continue
-
-                        if d.vpos_in < d_official.vpos_in < d.vpos_out or d.vpos_in < d_official.vpos_out < d.vpos_out:
-                            d_split_1 = deepcopy(d)
-                            if d.vpos_in < d_official.vpos_in < d.vpos_out:
-                                """
-                                    |運営コメント|
-                                |コメント|
-                                """
-
-                                d.end = d_official.start
-                                d_split_1.start = d_official.start
-
-                                d_distance_traveled_when_official_frame_in = speed * (d_official.vpos_in - d.vpos_in)
-                                d_pos_when_official_frame_in = x1 - d_distance_traveled_when_official_frame_in
-                                d_pos_when_official_frame_in = round(d_pos_when_official_frame_in)
-
-                                d.tag.set_move(x1, d_pos_when_official_frame_in, y)
-                                d_split_1.tag.set_move(d_pos_when_official_frame_in, x2, y + height_move_down)
-                                d_split_1.has_been_moved_down = True
-                            elif d.vpos_in < d_official.vpos_out < d.vpos_out:
-                                """
-                                |運営コメント|
-                                      |コメント|
-                                """
-
-                                d.end = d_official.end
-                                d_split_1.start = d_official.end
-
-                                d_distance_traveled_when_official_frame_out = speed * (d_official.vpos_out - d.vpos_in)
-                                d_pos_when_official_frame_out = x1 - d_distance_traveled_when_official_frame_out
-                                d_pos_when_official_frame_out = round(d_pos_when_official_frame_out)
-
-                                d.tag.set_move(x1, d_pos_when_official_frame_out, y + height_move_down)
-                                d_split_1.tag.set_move(d_pos_when_official_frame_out, x2, y)
-
-                                d.has_been_moved_down = True
-
-                            self.d_normal.insert(i + 1, d_split_1)
-                            break
-                        elif d_official.vpos_in <= d.vpos_in and d.vpos_out <= d_official.vpos_out:
-                            """
-                            |   運営コメント   |
-                                |コメント|
-                            """
-
-                            if not d.has_been_moved_down:
-                                d.tag.set_move(x1, x2, y + height_move_down)
-                            break
+        return TrackAllocator(row_cnt, self.width, self.style['displayed_time'] * 100)
 
-    def collision(self, first, second):
+    def mail_tag(self, mail):
         """
-        检测两条弹幕处于统一轨道时是否会发生碰撞，返回它们在滚动过程中重叠长度(像素）的最大值
-        若这个最大值<=0，说明它们不会发生碰撞
-        :param first: 轨道内的最新弹幕
-        :param second: 尚未分配轨道的当前弹幕。要求其入镜时间在前者之后，所以需要提前对所有评论按入镜时间排序
-        :return: 两者重叠长度的最大值
+        :param mail: 评论的mail，包含以空格分隔的命令
+        :return: 命令设置的ass标签字段，(属性名, 值)的元组，用AssTag.apply设置到弹幕上
         """
+        fields = self.mail_cache.get(mail)
+        if fields is None:
+            tag = AssTag()
+            tag.translate_command(mail.split(' '), self.config)
+            fields = tuple((attr, getattr(tag, attr)) for attr in AssTag.__slots__
+                           if attr != 'static' and getattr(tag, attr) != '')
+            self.mail_cache[mail] = fields
+        return fields
+
+    def normal_dialogue(self, cmt, track_allocator, text_length=None, speed=None, entry=None, vpos=None):
+        """
+        为一条普通评论生成弹幕并分配轨道
+        :param cmt: 评论，需要按出现时间的顺序依次传入
+        :param track_allocator: 记录各轨道最新弹幕的轨道分配器
+        :param text_length: 已算好的文字长度(像素)，为None时与speed、entry一起在这里计算
+        :param vpos: 弹幕的出现时间，为None时使用评论的出现时间，评论本身不会被修改
+        :return: Dialogue
+        """
+        row_cnt_base = self.style['row_cnt_base']
+        if vpos is None:
+            vpos = cmt.vpos
+
+        d = Dialogue()
+        d.raw = cmt
+        d.vpos_in = vpos
+        d.vpos_out = int(vpos) + self.style['displayed_time'] * 100
+        d.style = self.style_normal['Name']
+
+        name = cmt.name
+        if name:
+            d.name = name
+        else:
+            d.name = cmt.user_id
 
-        def collision_at_start():
-            """
-            :return: 后者入镜时与前者重叠的长度(像素）
-            """
-            length_first = len(first['message']) * style['font_size']  # 前者文字长度
-
-            speed_first = (WIDTH + length_first) / (style['displayed_time'] * 100)  # 弹幕滚动速度(像素/0.01s)
-            time_delta = second['vpos'] - first['vpos']  # 两条弹幕出现时间点的时间差
-            distance_traveled_first = speed_first * time_delta  # 后者开始出现时前者走过的距离(像素）
+        self.viewer_cnt.append(d.name)
 
-            return length_first - distance_traveled_first
+        d.text = cmt.message
 
-        def collision_at_end():
-            """
-            :return: 前者出镜时与后者重叠的长度(像素）
-            """
+        if text_length is None:
+            text_length = len(cmt.message) * self.style['font_size']
+            speed = track_allocator.speed_of(text_length)
+        d.speed = speed
 
-            first_vpos_frame_out = first['vpos'] + style['displayed_time'] * 100
-            length_second = len(second['message']) * style['font_size']
+        # 调整非会员弹幕的透明度
+        if cmt.premium and NON_MEMBER_PREMIUM_PATTERN.search(cmt.premium):
+            d.tag.set_opacity(1 - self.style['color']['a'] * 0.6)
+            d.tag.set_outline_opacity(1 - self.style['outline_color']['a'] * 0.6)
+            # print(cmt)
 
-            speed_second = (WIDTH + length_second) / (style['displayed_time'] * 100)
-            time_delta = first_vpos_frame_out - second['vpos']
-            distance_traveled_second = speed_second * time_delta
-            return distance_traveled_second - WIDTH
+        # 分配轨道：优先选择编号最小的无碰撞轨道，否则选择最大重叠长度最小的轨道
+        row = track_allocator.allocate(vpos, text_length, speed, entry)
 
-        # 如果当前轨道有过弹幕
-        if first:
-            return max(collision_at_start(), collision_at_end())
+        x1 = self.width
+        x2 = -text_length
+        if row < row_cnt_base:
+            y = (self.style['font_size'] + self.style['spacing']) * row
         else:
-            return 0
-
-
-script_path = os.path.split(os.path.realpath(__file__))[0]
-
-with open(f'{script_path}\style.json', 'r', encoding='utf-8') as f_style:
-    style = json.load(f_style)
+            y = (self.style['font_size'] + self.style['spacing']) * (row - row_cnt_base + (1 / 2))
 
-row_cnt_base = style['row_cnt_base']
+        y = round(y)
 
-WIDTH = style['video_width']
-HEIGHT = style['video_height']
+        d.tag.set_move(x1, x2, y)
 
-parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+        # 处理command
+        if cmt.mail:
+            d.tag.apply(self.mail_tag(cmt.mail))
 
-parser.add_argument('-p', '--platform', type=str, required=True,
-                    help='''指定直播平台
-                    a: ASOBISTAGE
-                    n: ニコニコ生放送
-                    nchp: ニコニコチャンネルプラス
-                    o: Openrec
-                    y: YouTube
-                    z: Zaiko''')
+        return d
 
-parser.add_argument('source', type=str,
-                    help='''指定评论源
-                    输入直播链接 ニコニコチャンネルプラス/Openrec
-                    输入本地评论文件路径 ASOBISTAGE/ニコニコ生放送/YouTube/Zaiko''')
+    def build_normal(self):
+        # 记录各轨道最新弹幕的轨道分配器
+        track_allocator = self.new_track_allocator()
+
+        if self.columnar:
+            columns = NormalColumns(self.normal, self.style['font_size'], self.width,
+                                    self.style['displayed_time'] * 100)
+            text_length_list = columns.text_length.tolist()
+            speed_list = columns.speed.tolist()
+            entry_list = columns.entry.tolist()
+        normal_index = []  # 各条弹幕对应的评论在self.normal中的序号
+
+        for i, cmt in enumerate(self.normal):
+            if not cmt.message:
+                continue
+            normal_index.append(i)
 
-parser.add_argument('-mr', '--max_row_cnt', type=int, default=11, help='指定画面中能容纳的最多弹幕轨道数 [默认为11]')
-parser.add_argument('-s', '--save', action='store_true', help='保存原始评论文件（Openrec/ニコニコチャンネルプラス） [默认为否]')
-parser.add_argument('-t', '--top_viewer', type=int, default=0, help='显示发送弹幕数Top n的观众 [默认n为0 即不显示]')
+            if self.columnar:
+                d = self.normal_dialogue(cmt, track_allocator, text_length_list[i], speed_list[i], entry_list[i])
+            else:
+                d = self.normal_dialogue(cmt, track_allocator)
 
-args = parser.parse_args()
+            self.d_normal.append(d)
 
-platform = args.platform
-if platform == 'a':
-    platform = 'ASOBISTAGE'
-elif platform == 'n':
-    platform = 'ニコニコ生放送'
-elif platform == 'nchp':
-    platform = 'ニコニコチャンネルプラス'
-elif platform == 'o':
-    platform = 'Openrec'
-elif platform == 'y':
-    platform = 'YouTube'
-elif platform == 'z':
-    platform = 'Zaiko'
+        self.cnt += len(self.d_normal)
 
-source = args.source
-row_cnt_base = args.max_row_cnt
-style['row_cnt_base'] = row_cnt_base
+        candidates = None
+        if self.columnar and self.d_official:
+            intervals = [(d_official.vpos_in, d_official.vpos_out) for d_official in self.d_official]
+            candidates = columns.overlaps(intervals)[normal_index].tolist()
 
-style['font_size'] = math.floor((HEIGHT + style['spacing']) / style['row_cnt_base'] - style['spacing'])
-style['comment_art']['font_size'] = math.floor((HEIGHT / 38) / 0.63)
+        with self.stage('avoid_overlapping_with_official_comment') as record:
+            self.avoid_overlapping_with_official_comment(candidates)
+            record['count'] = len(self.d_normal)
 
-cmt = Comment()
+    def avoid_overlapping_with_official_comment(self, candidates=None):
+        """
+        :param candidates: 与self.d_normal一一对应，为False的弹幕与所有运营评论都不重叠，可以直接跳过
+        """
+        if not self.d_official:
+            return
 
-cmt.save = args.save
+        official_index = IntervalIndex([(d_official.vpos_in, d_official.vpos_out) for d_official in self.d_official])
 
-cmt.platform = platform
-cmt.source = source
+        style_bg = self.style['official']['background']
+        # 运营评论背景高度加上下边距，即与之重叠的弹幕需要下移的距离
+        height_move_down_list = [d_official.font_size * d_official.text_row_cnt + style_bg['paddingV'] * 2
+                                 + style_bg['marginV'] * 2 for d_official in self.d_official]
 
-ass = cmt.ass()
+        vpos_first_official_in = self.d_official[0].vpos_in
+        vpos_last_official_out = self.d_official[-1].vpos_out
 
-keep_building = False
+        def split_or_move_down(d):
+            """
+            :return: 弹幕被运营评论分割时返回分割出的后半段，否则返回None
+            """
+            speed = d.speed
 
-print()
-print(f"        平台: {cmt.platform}")
-print(f"        标题: {cmt.title}")
+            x1 = d.tag.x1
+            x2 = d.tag.x2
+            y = d.tag.y
 
-print(f"      弹幕数: {len(cmt.normal)}")
-print(f"  运营评论数: {len(cmt.d_official)}")
-print(f"      投票数: {cmt.vote_cnt}")
-print(f"CommentArt数: {cmt.ca_cnt}")
+            if d.vpos_out <= vpos_first_official_in or d.vpos_in >= vpos_last_official_out:
+                return None
 
-viewer_counter = Counter(cmt.viewer_cnt)
-print()
-print(f"发过弹幕的观众数: {len(viewer_counter)}")
-print(f"平均每人发送弹幕: {round(len(cmt.normal) / len(viewer_counter), 1)}条")
+            for j in official_index.overlapping(d.vpos_in, d.vpos_out):
+                d_official = self.d_official[j]
+                height_move_down = height_move_down_list[j]
 
-top_cnt = args.top_viewer
-if top_cnt:
-    print(f"发送弹幕数前{top_cnt}的观众:")
-    for name, c_cnt in viewer_counter.most_common(top_cnt):
-        print(f"{c_cnt:4}条 {name}")
+                if (y + height_move_down + self.style['font_size']) > self.height:
+                    continue
 
-with open(f"{cmt.title}.ass", 'w', encoding='utf_8_sig') as f_out:
-    f_out.write(ass)
+                if d.vpos_in < d_official.vpos_in < d.vpos_out or d.vpos_in < d_official.vpos_out < d.vpos_out:
+                    d_split_1 = d.clone()
+                    if d.vpos_in < d_official.vpos_in < d.vpos_out:
+                        """
+                            |運営コメント|
+                        |コメント|
+                        """
+
+                        d.vpos_out = d_official.vpos_in
+                        d_split_1.vpos_in = d_official.vpos_in
+
+                        d_distance_traveled_when_official_frame_in = speed * (d_official.vpos_in - d.vpos_in)
+                        d_pos_when_official_frame_in = x1 - d_distance_traveled_when_official_frame_in
+                        d_pos_when_official_frame_in = round(d_pos_when_official_frame_in)
+
+                        d.tag.set_move(x1, d_pos_when_official_frame_in, y)
+                        d_split_1.tag.set_move(d_pos_when_official_frame_in, x2, y + height_move_down)
+                        d_split_1.has_been_moved_down = True
+                    elif d.vpos_in < d_official.vpos_out < d.vpos_out:
+                        """
+                        |運営コメント|
+                              |コメント|
+                        """
+
+                        d.vpos_out = d_official.vpos_out
+                        d_split_1.vpos_in = d_official.vpos_out
+
+                        d_distance_traveled_when_official_frame_out = speed * (d_official.vpos_out - d.vpos_in)
+                        d_pos_when_official_frame_out = x1 - d_distance_traveled_when_official_frame_out
+                        d_pos_when_official_frame_out = round(d_pos_when_official_frame_out)
+
+                        d.tag.set_move(x1, d_pos_when_official_frame_out, y + height_move_down)
+                        d_split_1.tag.set_move(d_pos_when_official_frame_out, x2, y)
+
+                        d.has_been_moved_down = True
+
+                    return d_split_1
+                elif d_official.vpos_in <= d.vpos_in and d.vpos_out <= d_official.vpos_out:
+                    """
+                    |   運営コメント   |
+                        |コメント|
+                    """
+
+                    if not d.has_been_moved_down:
+                        d.tag.set_move(x1, x2, y + height_move_down)
+                    return None
+
+            return None
+
+        # 分割出的后半段紧跟在原弹幕之后，并且同样需要与运营评论做重叠检测
+        d_normal = []
+        for i, d in enumerate(self.d_normal):
+            if candidates is not None and not candidates[i]:
+                d_normal.append(d)
+                continue
+            while d:
+                d_normal.append(d)
+                d = split_or_move_down(d)
+
+        self.d_normal = d_normal
+
+
+@dataclasses.dataclass(frozen=True)
+class CommentTimeline:
+    """
+    获取并分类后的评论，与画面尺寸和样式无关
+    生成弹幕时只读取其中的评论，同一份CommentTimeline可以用于多次不同配置的渲染
+    """
+    platform: str
+    title: str
+    normal: tuple
+    normal_still: tuple
+    official: tuple
+    vote: tuple
+    comment_art: tuple
+    other: tuple
+    dropped: dict  # 各平台被去重的评论数
+
+
+def freeze_style(value):
+    """
+    :return: 只读的样式，dict转为MappingProxyType，list转为tuple
+    """
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return types.MappingProxyType({k: freeze_style(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_style(v) for v in value)
+    return value
+
+
+def thaw_style(value):
+    """
+    :return: 可以修改的样式的副本，与json.load读取的结构相同
+    """
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return {k: thaw_style(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw_style(v) for v in value]
+    return value
+
+
+@dataclasses.dataclass(frozen=True)
+class RenderConfig:
+    """
+    一次渲染使用的样式与画面尺寸
+    style中已填入由轨道数推算出的字号，创建时转为只读，可以在多次渲染之间共用
+    """
+    style: types.MappingProxyType
+    width: int
+    height: int
+
+    def __post_init__(self):
+        object.__setattr__(self, 'style', freeze_style(self.style))
+
+    def __reduce__(self):
+        # MappingProxyType不能pickle，传给子进程(render_variants)时转回dict
+        return type(self), (thaw_style(self.style), self.width, self.height)
+
+    @classmethod
+    def create(cls, style=None, max_row_cnt=None, resolution=None):
+        """
+        :param style: style.json的路径、已读取的dict或另一个RenderConfig的style，默认使用脚本所在目录的style.json
+        :param max_row_cnt: 画面中能容纳的最多弹幕轨道数，默认使用style中的row_cnt_base
+        :param resolution: 画面尺寸(宽, 高)，默认使用style中的video_width与video_height
+        """
+        if style is None:
+            style = os.path.join(script_path, 'style.json')
+        if isinstance(style, str):
+            with open(style, 'r', encoding='utf-8') as f_style:
+                style = json.load(f_style)
+        else:
+            style = thaw_style(style)
+
+        if resolution:
+            style['video_width'], style['video_height'] = resolution
+
+        width = style['video_width']
+        height = style['video_height']
+
+        if max_row_cnt:
+            style['row_cnt_base'] = max_row_cnt
+
+        style['font_size'] = math.floor((height + style['spacing']) / style['row_cnt_base'] - style['spacing'])
+        style['comment_art']['font_size'] = math.floor((height / 38) / 0.63)
+
+        return cls(style, width, height)
+
+
+@dataclasses.dataclass(frozen=True)
+class RenderOptions:
+    """
+    获取评论时的选项
+    """
+    max_row_cnt: int = None  # 画面中能容纳的最多弹幕轨道数，默认使用style中的row_cnt_base
+    save: bool = False  # 保存原始评论文件（Openrec/ニコニコチャンネルプラス）
+    cache_dir: str = os.path.join(script_path, 'cache')  # 原始评论的缓存目录，为None时不使用缓存
+    cache_ttl: float = 24  # 缓存的有效小时数
+    refresh: bool = False  # 忽略缓存重新下载
+    profiler: StageProfiler = None  # 记录各阶段用时的StageProfiler，为None时不记录
+    # 对齐评论时间的依据（Zaiko/ASOBISTAGE），未指定时使用锚点文件或手动输入
+    anchor_index: int = None  # 作为依据的评论的index（Zaiko）
+    anchor_time: str = None  # 作为依据的评论的time值（ASOBISTAGE）
+    offset: str = None  # 作为依据的评论在视频中出现的时间(x:xx:xx.xxx)
+
+
+def ingest(source, platform, options=None):
+    """
+    获取评论并分类，不生成弹幕
+    :param source: 评论源，直播链接或本地评论文件路径
+    :param platform: 直播平台，可以使用命令行参数中的简称
+    :param options: RenderOptions，其中的max_row_cnt不会被使用
+    :return: CommentTimeline
+    """
+    if options is None:
+        options = RenderOptions()
+
+    cmt = Comment()
+
+    cmt.profiler = options.profiler
+    cmt.save = options.save
+    cmt.anchor = {'anchor_index': options.anchor_index, 'anchor_time': options.anchor_time, 'offset': options.offset}
+    if options.cache_dir and options.cache_ttl > 0:
+        cmt.cache = RawCommentCache(options.cache_dir, options.cache_ttl * 3600, options.refresh)
+
+    cmt.platform = PLATFORMS.get(platform, platform)
+    cmt.source = source
+
+    cmt.reclassify_cmt()
+
+    return cmt.timeline()
+
+
+def render_timeline(timeline, config, profiler=None):
+    """
+    :param timeline: ingest得到的CommentTimeline
+    :param config: RenderConfig
+    :param profiler: 记录各阶段用时的StageProfiler，写出ass文件时也会记录
+    :return: 已生成弹幕的Comment，用write_ass写出ass文件
+    """
+    cmt = Comment.from_timeline(timeline, config)
+    cmt.profiler = profiler
+    cmt.layout()
+    return cmt
+
+
+def render(source, platform, style=None, options=None):
+    """
+    获取评论并生成弹幕
+    :param source: 评论源，直播链接或本地评论文件路径
+    :param platform: 直播平台，可以使用命令行参数中的简称
+    :param style: style.json的路径、已读取的dict或RenderConfig，默认使用脚本所在目录的style.json
+    :param options: RenderOptions
+    :return: 已生成弹幕的Comment，用write_ass写出ass文件
+    """
+    if options is None:
+        options = RenderOptions()
+
+    if isinstance(style, RenderConfig):
+        config = style
+    else:
+        config = RenderConfig.create(style, options.max_row_cnt)
+
+    return render_timeline(ingest(source, platform, options), config, options.profiler)
+
+
+def render_live(source, platform, style=None, options=None, interval=10, output_dir='.'):
+    """
+    实时模式：直播进行中持续获取评论，并将已确定的弹幕逐条追加写入ass文件
+    :param source: 直播链接（Openrec/ニコニコチャンネルプラス）
+    :param platform: 直播平台，可以使用命令行参数中的简称
+    :param style: style.json的路径、已读取的dict或RenderConfig，默认使用脚本所在目录的style.json
+    :param options: RenderOptions，只使用max_row_cnt
+    :param interval: 轮询间隔(秒)
+    :param output_dir: ass文件的输出目录
+    :return: 已写出弹幕的Comment与ass文件的路径
+    """
+    if options is None:
+        options = RenderOptions()
+
+    if isinstance(style, RenderConfig):
+        config = style
+    else:
+        config = RenderConfig.create(style, options.max_row_cnt)
+
+    cmt = Comment(config)
+    cmt.platform = PLATFORMS.get(platform, platform)
+    cmt.source = source
+
+    path = cmt.write_live(interval, output_dir)
+    return cmt, path
+
+
+# render_variants的子进程中使用的评论，fork出的子进程直接继承父进程中的这份评论
+_variant_timeline = None
+
+
+def _init_variant_worker(timeline):
+    global _variant_timeline
+    if timeline is not None:
+        _variant_timeline = timeline
+
+
+def _render_variant(config, output):
+    t_start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        cmt = render_timeline(_variant_timeline, config)
+    with open(output, 'w', encoding='utf_8_sig') as f_out:
+        cmt.write_ass(f_out)
+
+    result = summarize(cmt)
+    result['output'] = output
+    result['elapsed'] = time.perf_counter() - t_start
+    return result
+
+
+def render_variants(timeline, configs, output_dir='.', max_workers=None):
+    """
+    用同一份评论生成多个不同画面尺寸/轨道数的ass文件，各配置在多个进程中并行生成
+    支持fork的系统上子进程直接继承timeline，否则每个子进程只接收一次timeline
+    :param timeline: ingest得到的CommentTimeline
+    :param configs: RenderConfig的列表
+    :param output_dir: ass文件的输出目录
+    :param max_workers: 进程数，默认为CPU核数
+    :return: 与configs顺序一致的统计信息，另含output(输出文件)与elapsed(用时，秒)
+    """
+    global _variant_timeline
+    import concurrent.futures
+    import multiprocessing
+
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = [os.path.join(output_dir, f"{timeline.title} {config.width}x{config.height} "
+                                        f"mr{config.style['row_cnt_base']}.ass") for config in configs]
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        _variant_timeline = timeline
+        mp_context = multiprocessing.get_context('fork')
+        initargs = (None,)
+    else:
+        mp_context = None
+        initargs = (timeline,)
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context,
+                                                    initializer=_init_variant_worker, initargs=initargs) as executor:
+            return list(executor.map(_render_variant, configs, outputs))
+    finally:
+        _variant_timeline = None
+
+
+def summarize(cmt):
+    """
+    :param cmt: 已生成弹幕的Comment
+    :return: 生成结果的统计信息
+    """
+    return {'platform': cmt.platform,
+            'title': cmt.title,
+            'normal': len(cmt.normal),
+            'official': len(cmt.d_official),
+            'vote': cmt.vote_cnt,
+            'comment_art': cmt.ca_cnt,
+            'viewer': len(set(cmt.viewer_cnt)),
+            'duplicate': dict(cmt.duplicate_filter.dropped)}
+
+
+def load_batch_jobs(batch=None, manifest=None, platform=None, **defaults):
+    """
+    生成批量模式的任务列表，每个任务是包含platform、source及RenderOptions字段的dict
+    :param batch: 匹配本地评论文件的通配符，所有文件都使用platform指定的平台
+    :param manifest: 任务清单(json)的路径，内容为任务dict的列表，未指定的字段使用platform与defaults中的值
+    :param platform: 默认的直播平台
+    :param defaults: 默认的RenderOptions字段
+    """
+    jobs = []
+    if batch:
+        jobs += [{'platform': platform, 'source': source, **defaults} for source in sorted(glob.glob(batch))]
+    if manifest:
+        with open(manifest, 'r', encoding='utf-8') as f_manifest:
+            jobs += [{'platform': platform, **defaults, **job} for job in json.load(f_manifest)]
+
+    for job in jobs:
+        if not job.get('platform') or not job.get('source'):
+            raise ValueError(f'任务缺少platform或source: {job}')
+    return jobs
+
+
+def _init_batch_worker():
+    # 子进程中无法交互，没有指定对齐依据的Zaiko/ASOBISTAGE任务会直接报错而不是卡住
+    sys.stdin = open(os.devnull, 'r')
+
+
+def render_job(job, output):
+    """
+    执行一个批量任务并写出ass文件，任务中的异常不会向外抛出
+    :param job: load_batch_jobs生成的任务
+    :param output: ass文件的输出路径
+    :return: 统计信息，另含source、output(输出文件)、elapsed(用时，秒)与error(错误信息，成功时为None)
+    """
+    t_start = time.perf_counter()
+    result = {'platform': PLATFORMS.get(job['platform'], job['platform']), 'source': job['source'], 'output': None,
+              'error': None}
+    try:
+        options = RenderOptions(**{k: v for k, v in job.items() if k not in ('platform', 'source', 'style')})
+        # 各任务的逐条输出会交错在一起，批量模式下只保留汇总表
+        with contextlib.redirect_stdout(io.StringIO()):
+            cmt = render(job['source'], job['platform'], job.get('style'), options)
+
+        result.update(summarize(cmt))
+        with open(output, 'w', encoding='utf_8_sig') as f_out:
+            cmt.write_ass(f_out)
+        result['output'] = output
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+
+    result['elapsed'] = time.perf_counter() - t_start
+    return result
+
+
+def render_batch(jobs, output_dir='.', max_workers=None):
+    """
+    使用多进程并行执行批量任务，每个任务独立进行，一个任务失败不影响其他任务
+    标题要等任务完成后才能确定，各任务先写入以序号命名的临时文件，全部完成后再按任务顺序改名为 标题.ass
+    标题相同的任务(如YouTube的评论文件都叫chat.json)依次命名为 标题.ass、标题 (2).ass ……
+    :param jobs: load_batch_jobs生成的任务列表
+    :param output_dir: ass文件的输出目录
+    :param max_workers: 进程数，默认为CPU核数
+    :return: 与jobs顺序一致的render_job结果列表，output为改名后的输出文件
+    """
+    import concurrent.futures
+
+    os.makedirs(output_dir, exist_ok=True)
+    results = [None] * len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_batch_worker) as executor:
+        futures = {executor.submit(render_job, job, os.path.join(output_dir, f'.batch {i}.ass.tmp')): i
+                   for i, job in enumerate(jobs)}
+        for done_cnt, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            i = futures[future]
+            results[i] = future.result()
+            status = '失败' if results[i]['error'] else '完成'
+            print(f"[{done_cnt}/{len(jobs)}] {status} {results[i]['elapsed']:7.1f}s {jobs[i]['source']}")
+
+    used = set()
+    for i, result in enumerate(results):
+        tmp = os.path.join(output_dir, f'.batch {i}.ass.tmp')
+        if result['error']:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            continue
+
+        output = os.path.join(output_dir, f"{result['title']}.ass")
+        n = 1
+        while os.path.normcase(output) in used:
+            n += 1
+            output = os.path.join(output_dir, f"{result['title']} ({n}).ass")
+        used.add(os.path.normcase(output))
+        os.replace(tmp, output)
+        result['output'] = output
+    return results
+
+
+def print_batch_summary(results):
+    row_format = '{:<4}{:>9}{:>8}{:>7}{:>5}{:>5}{:>7}  {:<14}{}'
+    print()
+    print(row_format.format('状态', '用时', '弹幕数', '运营评论', '投票', 'CA', '观众数', '平台', '标题'))
+    for r in results:
+        elapsed = f"{r['elapsed']:.1f}s"
+        if r['error']:
+            print(row_format.format('失败', elapsed, '-', '-', '-', '-', '-', r['platform'], f"{r['source']} {r['error']}"))
+        else:
+            print(row_format.format('完成', elapsed, r['normal'], r['official'], r['vote'], r['comment_art'], r['viewer'],
+                                    r['platform'], r['title']))
+
+    failed_cnt = sum(1 for r in results if r['error'])
+    print()
+    print(f"共{len(results)}个任务 成功{len(results) - failed_cnt}个 失败{failed_cnt}个")
+
+
+def parse_variant(value):
+    """
+    :param value: 命令行中的 宽x高 或 宽x高:轨道数
+    :return: (宽, 高, 轨道数)，未指定轨道数时为None
+    """
+    m = re.fullmatch(r'(\d+)x(\d+)(?::(\d+))?', value)
+    if not m:
+        raise argparse.ArgumentTypeError(f'格式应为 宽x高 或 宽x高:轨道数: {value}')
+    return int(m.group(1)), int(m.group(2)), int(m.group(3)) if m.group(3) else None
+
+
+def output_profile(profiler, args, **info):
+    """
+    按命令行参数输出各处理阶段的统计与cProfile的结果
+    :param info: 写入json的其他信息，如平台与标题
+    """
+    if args.profile:
+        profiler.print_table()
+    if args.profile_json:
+        profiler.dump_json(args.profile_json, **info)
+    if args.profile_stats:
+        profiler.dump_stats(args.profile_stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-p', '--platform', type=str,
+                        help='''指定直播平台
+                        a: ASOBISTAGE
+                        n: ニコニコ生放送
+                        nchp: ニコニコチャンネルプラス
+                        o: Openrec
+                        y: YouTube
+                        z: Zaiko''')
+
+    parser.add_argument('source', type=str, nargs='?',
+                        help='''指定评论源
+                        输入直播链接 ニコニコチャンネルプラス/Openrec
+                        输入本地评论文件路径 ASOBISTAGE/ニコニコ生放送/YouTube/Zaiko''')
+
+    parser.add_argument('-mr', '--max_row_cnt', type=int, default=11, help='指定画面中能容纳的最多弹幕轨道数 [默认为11]')
+    parser.add_argument('-s', '--save', action='store_true', help='保存原始评论文件（Openrec/ニコニコチャンネルプラス） [默认为否]')
+    parser.add_argument('-t', '--top_viewer', type=int, default=0, help='显示发送弹幕数Top n的观众 [默认n为0 即不显示]')
+    parser.add_argument('--cache_ttl', type=float, default=24,
+                        help='下载的原始评论在本地缓存的有效小时数（Openrec/ニコニコチャンネルプラス，直播中的评论不缓存） [默认为24 设为0时不使用缓存]')
+    parser.add_argument('--refresh', action='store_true', help='忽略本地缓存，重新下载评论 [默认为否]')
+    parser.add_argument('--anchor_index', type=int,
+                        help='Zaiko：作为对齐时间依据的评论的index，与--offset一起指定时不需要手动输入')
+    parser.add_argument('--anchor_time', type=str,
+                        help='ASOBISTAGE：作为对齐时间依据的评论的time值(xxxx-xx-xx xx:xx:xx.xxxxxxxxx)，与--offset一起指定时不需要手动输入')
+    parser.add_argument('--offset', type=str,
+                        help='作为对齐时间依据的评论在视频中出现的时间(x:xx:xx.xxx)（Zaiko/ASOBISTAGE）\n'
+                             '未指定时使用评论文件旁的锚点文件(评论文件名.anchor.json)，都没有时需要手动输入')
+    parser.add_argument('--batch', type=str, help='批量模式，转换匹配该通配符的所有本地评论文件，平台由-p指定')
+    parser.add_argument('--manifest', type=str,
+                        help='批量模式，按任务清单(json)进行转换，清单内容为任务的列表\n'
+                             '如 [{"platform": "n", "source": "a.xml", "max_row_cnt": 15}]，未指定的字段使用命令行参数的值')
+    parser.add_argument('--profile', action='store_true', help='输出各处理阶段的用时、CPU时间、峰值内存及其增长与处理条数 [默认为否]')
+    parser.add_argument('--profile_json', type=str, help='将各处理阶段的统计以json格式保存到指定文件')
+    parser.add_argument('--profile_stats', type=str, help='用cProfile记录各函数的用时，并将pstats格式的结果保存到指定文件')
+    parser.add_argument('--variant', type=parse_variant, action='append',
+                        help='只获取一次评论，生成多个画面尺寸/轨道数的ass文件，可重复指定\n'
+                             '如 --variant 1920x1080 --variant 3840x2160:15，未指定轨道数时使用-mr的值')
+    parser.add_argument('--live', action='store_true',
+                        help='实时模式，直播进行中持续获取评论并追加写入ass文件（Openrec/ニコニコチャンネルプラス）\n'
+                             '直播结束或按Ctrl+C时停止，只处理弹幕与运营评论 [默认为否]')
+    parser.add_argument('--interval', type=float, default=10, help='实时模式下获取评论的间隔秒数 [默认为10]')
+    parser.add_argument('-j', '--jobs', type=int, help='批量模式/--variant下同时进行转换的进程数 [默认为CPU核数]')
+    parser.add_argument('-o', '--output_dir', type=str, default='.',
+                        help='批量模式/--variant/实时模式下ass文件的输出目录 [默认为当前目录]')
+
+    args = parser.parse_args()
+
+    profile = args.profile or args.profile_json or args.profile_stats
+    if profile and (args.batch or args.manifest or args.live):
+        # 批量模式的转换在子进程中进行，实时模式不会正常结束，都无法输出统计
+        parser.error('--profile/--profile_json/--profile_stats不能用于批量模式与实时模式')
+
+    if args.batch or args.manifest:
+        if args.batch and not args.platform:
+            parser.error('--batch需要使用-p指定直播平台')
+        try:
+            jobs = load_batch_jobs(args.batch, args.manifest, args.platform, max_row_cnt=args.max_row_cnt,
+                                   save=args.save, cache_ttl=args.cache_ttl, refresh=args.refresh)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
+        results = render_batch(jobs, args.output_dir, args.jobs)
+        print_batch_summary(results)
+        sys.exit(1 if any(r['error'] for r in results) else 0)
+
+    if not args.platform or not args.source:
+        parser.error('需要指定直播平台与评论源')
+
+    if args.live:
+        if PLATFORMS.get(args.platform, args.platform) not in ('Openrec', 'ニコニコチャンネルプラス'):
+            parser.error('实时模式只支持Openrec/ニコニコチャンネルプラス')
+        os.makedirs(args.output_dir, exist_ok=True)
+        cmt, path = render_live(args.source, args.platform, options=RenderOptions(max_row_cnt=args.max_row_cnt),
+                                interval=args.interval, output_dir=args.output_dir)
+        print()
+        print(f"        标题: {cmt.title}")
+        print(f"      弹幕数: {cmt.cnt}")
+        print(f"  运营评论数: {len(cmt.d_official)}")
+        print(f"    输出文件: {path}")
+        return
+
+    profiler = None
+    if profile:
+        profiler = StageProfiler(cprofile=bool(args.profile_stats))
+
+    options = RenderOptions(max_row_cnt=args.max_row_cnt, save=args.save, cache_ttl=args.cache_ttl,
+                            refresh=args.refresh, profiler=profiler, anchor_index=args.anchor_index,
+                            anchor_time=args.anchor_time, offset=args.offset)
+
+    if args.variant:
+        configs = [RenderConfig.create(max_row_cnt=max_row_cnt or args.max_row_cnt, resolution=(width, height))
+                   for width, height, max_row_cnt in args.variant]
+        timeline = ingest(args.source, args.platform, options)
+        print()
+        # 各配置在子进程中生成，只记录总用时
+        with profiler.stage('render_variants') if profiler else contextlib.nullcontext({}) as record:
+            for result in render_variants(timeline, configs, args.output_dir, args.jobs):
+                print(f"{result['elapsed']:6.1f}s {result['output']}")
+            record['count'] = len(configs)
+
+        if profiler:
+            output_profile(profiler, args, platform=timeline.platform, title=timeline.title, source=args.source,
+                           variants=[f'{c.width}x{c.height}:{c.style["row_cnt_base"]}' for c in configs])
+        return
+
+    cmt = render(args.source, args.platform, options=options)
+    stats = summarize(cmt)
+
+    print()
+    print(f"        平台: {stats['platform']}")
+    print(f"        标题: {stats['title']}")
+
+    print(f"      弹幕数: {stats['normal']}")
+    print(f"  运营评论数: {stats['official']}")
+    print(f"      投票数: {stats['vote']}")
+    print(f"CommentArt数: {stats['comment_art']}")
+    for dropped_platform, dropped_cnt in stats['duplicate'].items():
+        print(f"  重复评论数: {dropped_cnt} ({dropped_platform})")
+
+    viewer_counter = Counter(cmt.viewer_cnt)
+    print()
+    print(f"发过弹幕的观众数: {stats['viewer']}")
+    print(f"平均每人发送弹幕: {round(stats['normal'] / stats['viewer'], 1)}条")
+
+    top_cnt = args.top_viewer
+    if top_cnt:
+        print(f"发送弹幕数前{top_cnt}的观众:")
+        for name, c_cnt in viewer_counter.most_common(top_cnt):
+            print(f"{c_cnt:4}条 {name}")
+
+    with open(f"{cmt.title}.ass", 'w', encoding='utf_8_sig') as f_out:
+        cmt.write_ass(f_out)
+
+    if profiler:
+        output_profile(profiler, args, platform=stats['platform'], title=stats['title'], source=args.source,
+                       max_row_cnt=args.max_row_cnt)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+代替Openrec/ニコニコチャンネルプラス接口的本地HTTP服务器，供tests中的测试与benchmark.py使用
+"""
+import json
+import threading
+import http.server
+import urllib.parse
+
+
+class StubServer:
+    """
+    在本地线程中运行的HTTP服务器，代替Openrec/ニコニコチャンネルプラス的接口
+    收到的请求都记录在requests中，由route决定返回内容
+    """
+
+    def __init__(self, route):
+        """
+        :param route: route(method, path, query, body) -> (状态码, 可以转成json的返回内容)
+                      query为parse_qs的结果，body为POST提交的json
+        """
+        self.route = route
+        self.requests = []
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def handle_request(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                with stub.lock:
+                    stub.requests.append((method, url.path, query))
+                status, obj = stub.route(method, url.path, query, body)
+
+                data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def paths(self, method=None):
+        """
+        :return: 已收到的请求路径，可以只返回指定方法的请求
+        """
+        with self.lock:
+            return [path for m, path, query in self.requests if method is None or m == method]
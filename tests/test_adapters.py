@@ -0,0 +1,98 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comechi
+
+NCV_LIVE_INFO = '<LiveInfo><LiveTitle>テスト/生放送</LiveTitle><OpenTime>1650000000</OpenTime></LiveInfo>'
+NCV_CHATS = ('<Chats>'
+             '<chat thread="1" no="0" vpos="0" date="1650000001" date_usec="250000" user_id="u1">一</chat>'
+             '<chat thread="1" no="1" vpos="0" date="1650000012" date_usec="0" user_id="u2" mail="184 red">二</chat>'
+             '<chat thread="1" no="2" vpos="0" date="1650000030" date_usec="990000" premium="3">お知らせ</chat>'
+             '</Chats>')
+
+
+class NcvAdapterTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp = tmp_dir.name
+
+    def read(self, body, name='ncv.xml'):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w', encoding='utf-8') as f_xml:
+            f_xml.write(f'<?xml version="1.0" encoding="utf-8"?>\n<NiconamaCommentViewer>{body}</NiconamaCommentViewer>')
+        adapter = comechi.NcvAdapter(path)
+        return adapter, [(category, c.vpos, c.message) for category, c in adapter.comments()]
+
+    def test_live_info_first(self):
+        adapter, comments = self.read(NCV_LIVE_INFO + NCV_CHATS)
+        self.assertEqual(adapter.title, 'テスト_生放送')
+        self.assertEqual(comments, [('normal', 125, '一'), ('normal', 1200, '二'), ('official', 3099, 'お知らせ')])
+
+    def test_live_info_after_chats(self):
+        # vpos不应依赖LiveInfo与评论的先后顺序
+        adapter, comments = self.read(NCV_CHATS + NCV_LIVE_INFO)
+        self.assertEqual(adapter.title, 'テスト_生放送')
+        self.assertEqual([vpos for category, vpos, message in comments], [125, 1200, 3099])
+
+    def test_without_live_info(self):
+        # 不是NCV保存的文件时使用文件名作为标题，使用chat标签中的vpos
+        adapter, comments = self.read(NCV_CHATS.replace('vpos="0"', 'vpos="500"'), name='other.xml')
+        self.assertEqual(adapter.title, 'other')
+        self.assertEqual([vpos for category, vpos, message in comments], [525, 500, 599])
+
+
+class CommentRecordTest(unittest.TestCase):
+    def test_from_dict(self):
+        c = comechi.CommentRecord.from_dict({'vpos': 125, 'message': '一', 'name': 'n1', 'user_id': 'u1',
+                                             'mail': '184 red', 'premium': '1', 'layer': 2,
+                                             'end_time_in_seconds': 8, 'other': 'x'})
+        self.assertEqual([getattr(c, field) for field in comechi.CommentRecord.__slots__],
+                         [125, '一', 'n1', 'u1', '184 red', '1', 2, 8])
+        c = comechi.CommentRecord.from_dict({'vpos': 0, 'message': ''})
+        self.assertEqual([getattr(c, field) for field in comechi.CommentRecord.__slots__],
+                         [0, ''] + [None] * 6)
+        with self.assertRaises(AttributeError):
+            c.other = 'x'
+
+    def test_intern(self):
+        # 内容相同的观众名等字符串共用同一个对象，不是字符串的值原样保留
+        names = [''.join(['n', str(i % 2)]) for i in range(4)]
+        records = [comechi.CommentRecord(i, 'x', name=name, user_id=100, mail=' '.join(['184', 'red'])) for i, name in
+                   enumerate(names)]
+        self.assertIsNot(names[0], names[2])
+        self.assertIs(records[0].name, records[2].name)
+        self.assertIs(records[0].mail, records[1].mail)
+        self.assertEqual(records[0].user_id, 100)
+
+    def test_adapter_records(self):
+        # 各平台转换后的评论保留了原始dict中生成弹幕用到的全部字段，投票仍是原始dict
+        data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'render')
+        cases = [(comechi.NcvAdapter, 'ncv.xml', {}),
+                 (comechi.YoutubeAdapter, 'yt.json', {}),
+                 (comechi.ZaikoAdapter, 'zaiko.txt', {'anchor_index': 5, 'offset': '0:10:00.00'}),
+                 (comechi.AsobiAdapter, 'asobi.jsonl',
+                  {'anchor_time': '2022-05-01 10:00:20.000000000', 'offset': '0:00:30.00'})]
+        fields = {'vpos': 'vpos', 'message': 'message', 'name': 'name', 'user_id': 'user_id', 'mail': 'mail',
+                  'premium': 'premium', 'layer': 'layer', 'end_time_in_seconds': 'end_time'}
+        for adapter_class, source, anchor in cases:
+            path = os.path.join(data_dir, source)
+            raw = list(adapter_class(path, anchor=anchor).read())
+            records = list(adapter_class(path, anchor=anchor).comments())
+            with self.subTest(platform=adapter_class.platform):
+                self.assertEqual([category for category, c in records], [category for category, c in raw])
+                for (category, c), (_, record) in zip(raw, records):
+                    if category == 'vote':
+                        self.assertEqual(record, c)
+                        continue
+                    self.assertIsInstance(record, comechi.CommentRecord)
+                    self.assertEqual({key: getattr(record, field) for key, field in fields.items()},
+                                     {key: c.get(key) for key in fields})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comechi
+
+
+def write_zaiko_log(path, cnt):
+    with open(path, 'w', encoding='utf-8') as f_log:
+        for i in range(cnt):
+            data = {'text': f'comment {i}', 'member': {'nickname': f'z{i}', 'uuid': f'uuid-{i}'},
+                    'created_at': f'2022-05-01T10:00:{i:02d}.000000Z'}
+            f_log.write('recv ' + json.dumps({'event': 'chat', 'data': json.dumps(data)}) + '\n')
+
+
+def write_asobi_log(path, cnt):
+    with open(path, 'w', encoding='utf-8') as f_log:
+        for i in range(cnt):
+            f_log.write(json.dumps({'time': f'2022-05-01 19:00:{i:02d}.000000000',
+                                    'data': {'comment': [f'comment {i}', ''], 'userName': f'a{i}',
+                                             'type': 'user/send-comment'}}) + '\n')
+
+
+class AnchorTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.zaiko = os.path.join(tmp_dir.name, 'zaiko.txt')
+        write_zaiko_log(self.zaiko, 5)
+        self.asobi = os.path.join(tmp_dir.name, 'asobi.jsonl')
+        write_asobi_log(self.asobi, 5)
+
+    @staticmethod
+    def read(adapter_class, source, **anchor):
+        return list(adapter_class(source, anchor=anchor).comments())
+
+    def test_zaiko(self):
+        comments = self.read(comechi.ZaikoAdapter, self.zaiko, anchor_index=2, offset='0:00:10.00')
+        self.assertEqual([c.vpos for category, c in comments if category == 'normal'],
+                         [800, 900, 1000, 1100, 1200])
+
+    def test_zaiko_partial(self):
+        # 只指定一项时不应转为手动输入
+        for anchor in ({'anchor_index': 0}, {'offset': '0:00:10.00'}):
+            with self.subTest(anchor=anchor), self.assertRaisesRegex(ValueError, '同时指定'):
+                self.read(comechi.ZaikoAdapter, self.zaiko, **anchor)
+
+    def test_anchor_file(self):
+        # 命令行参数只指定一项时，另一项可以来自锚点文件
+        with open(comechi.anchor_path(self.zaiko), 'w', encoding='utf-8') as f_anchor:
+            json.dump({'offset': '0:00:10.00'}, f_anchor)
+        comments = self.read(comechi.ZaikoAdapter, self.zaiko, anchor_index=0)
+        self.assertEqual(comments[0][1].vpos, 1000)
+
+    def test_asobi_partial(self):
+        for anchor in ({'anchor_time': '2022-05-01 19:00:00.000000000'}, {'offset': '0:00:10.00'}):
+            with self.subTest(anchor=anchor), self.assertRaisesRegex(ValueError, '同时指定'):
+                self.read(comechi.AsobiAdapter, self.asobi, **anchor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comechi
+
+
+def write_youtube_chat(path, messages):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    chat = [{'message': message, 'time_in_seconds': i * 2.5, 'author': {'name': f'user{i}'}}
+            for i, message in enumerate(messages)]
+    with open(path, 'w', encoding='utf-8') as f_chat:
+        json.dump(chat, f_chat, ensure_ascii=False)
+
+
+class RenderBatchTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp = tmp_dir.name
+
+    def test_same_title(self):
+        # YouTube评论文件都叫chat.json，标题相同的任务不能写入同一个文件
+        for name in ('a', 'b', 'c'):
+            write_youtube_chat(os.path.join(self.tmp, 'logs', name, 'chat.json'), [f'{name} {i}' for i in range(5)])
+        output_dir = os.path.join(self.tmp, 'ass')
+
+        jobs = comechi.load_batch_jobs(os.path.join(self.tmp, 'logs', '*', 'chat.json'), platform='y', cache_dir=None)
+        results = comechi.render_batch(jobs, output_dir, max_workers=3)
+
+        outputs = [r['output'] for r in results]
+        self.assertEqual([r['error'] for r in results], [None] * 3)
+        self.assertEqual([os.path.basename(output) for output in outputs], ['chat.ass', 'chat (2).ass', 'chat (3).ass'])
+        self.assertEqual(sorted(os.listdir(output_dir)), sorted(os.path.basename(output) for output in outputs))
+        for name, output in zip(('a', 'b', 'c'), outputs):
+            with open(output, 'r', encoding='utf_8_sig') as f_ass:
+                self.assertIn(f'{name} 0', f_ass.read())
+
+    def test_failed_job(self):
+        write_youtube_chat(os.path.join(self.tmp, 'logs', 'chat.json'), ['ok'])
+        output_dir = os.path.join(self.tmp, 'ass')
+
+        jobs = [{'platform': 'y', 'source': os.path.join(self.tmp, 'logs', 'chat.json'), 'cache_dir': None},
+                {'platform': 'y', 'source': os.path.join(self.tmp, 'logs', 'missing.json'), 'cache_dir': None}]
+        results = comechi.render_batch(jobs, output_dir, max_workers=2)
+
+        self.assertIsNone(results[0]['error'])
+        self.assertIsNotNone(results[1]['error'])
+        self.assertIsNone(results[1]['output'])
+        self.assertEqual(os.listdir(output_dir), ['chat.ass'])
+
+
+if __name__ == '__main__':
+    unittest.main()
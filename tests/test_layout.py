@@ -0,0 +1,283 @@
+import io
+import os
+import sys
+import random
+import tempfile
+import unittest
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comechi
+
+WIDTH = 1920
+DISPLAYED_TIME = 700
+
+
+def linear_collision(first, second, width, displayed_time):
+    """
+    原先逐条轨道做碰撞检测时使用的公式
+    :param first: 轨道内的最新弹幕(出现时间, 文字长度)，空轨道为None
+    :param second: 尚未分配轨道的当前弹幕(出现时间, 文字长度)
+    :return: 两者重叠长度的最大值
+    """
+    if not first:
+        return 0
+    vpos_first, length_first = first
+    vpos_second, length_second = second
+
+    speed_first = (width + length_first) / displayed_time
+    collision_at_start = length_first - speed_first * (vpos_second - vpos_first)
+
+    speed_second = (width + length_second) / displayed_time
+    collision_at_end = speed_second * (vpos_first + displayed_time - vpos_second) - width
+    return max(collision_at_start, collision_at_end)
+
+
+def linear_allocate(comments, row_cnt, width=WIDTH, displayed_time=DISPLAYED_TIME):
+    """
+    原先的贪心算法：依次与每条轨道上的最新弹幕做碰撞检测
+    :return: 各条弹幕的轨道编号，以及因所有轨道都会碰撞而选择最大重叠长度最小的轨道的次数
+    """
+    latest = [None] * row_cnt
+    rows = []
+    fallback_cnt = 0
+    for cmt in comments:
+        row = None
+        min_collision = float('inf')
+        for i in range(row_cnt):
+            c = linear_collision(latest[i], cmt, width, displayed_time)
+            if c <= 0:
+                row = i
+                break
+            elif c < min_collision:
+                min_collision = c
+                row = i
+        else:
+            fallback_cnt += 1
+        latest[row] = cmt
+        rows.append(row)
+    return rows, fallback_cnt
+
+
+def allocate(comments, row_cnt, width=WIDTH, displayed_time=DISPLAYED_TIME):
+    track_allocator = comechi.TrackAllocator(row_cnt, width, displayed_time)
+    return [track_allocator.allocate(vpos, length) for vpos, length in comments]
+
+
+def random_comments(rnd, cnt, font_size, vpos=0):
+    """
+    :return: [(出现时间, 文字长度), ...] 按出现时间排序，包含同一时刻的多条弹幕与弹幕高峰
+    """
+    comments = []
+    for _ in range(cnt):
+        vpos += rnd.choice([0, 0, 1, 3, 10, 50, 120, 0.5])
+        comments.append((vpos, rnd.randint(1, 40) * font_size))
+    return comments
+
+
+class TrackAllocatorTest(unittest.TestCase):
+    def assertSameRows(self, rows, expected):
+        # 只报告第一处不同，较长的列表用difflib输出差异非常慢
+        mismatch = next((i for i, (row, row_expected) in enumerate(zip(rows, expected)) if row != row_expected), None)
+        self.assertIsNone(mismatch, f'第{mismatch}条弹幕的轨道不同')
+        self.assertEqual(len(rows), len(expected))
+
+    def test_random(self):
+        fallback_cnt = 0
+        for seed in range(100):
+            rnd = random.Random(seed)
+            font_size = rnd.choice([34, 50, 88])
+            row_cnt = rnd.randint(1, 40)
+            # 出现时间很大时浮点误差更明显
+            comments = random_comments(rnd, 1000, font_size, vpos=rnd.choice([0, 1.5e9]))
+            with self.subTest(seed=seed, row_cnt=row_cnt):
+                expected, cnt = linear_allocate(comments, row_cnt)
+                self.assertSameRows(allocate(comments, row_cnt), expected)
+            fallback_cnt += cnt
+        # 确认用例覆盖了所有轨道都已饱和的情况
+        self.assertGreater(fallback_cnt, 1000)
+
+    def test_least_overlap(self):
+        # 同一时刻的弹幕多于轨道数，之后的弹幕都要选择最大重叠长度最小的轨道
+        rnd = random.Random(0)
+        comments = [(0, rnd.randint(1, 40) * 50) for _ in range(30)] + [(5, 50 * i) for i in range(1, 30)]
+        expected, fallback_cnt = linear_allocate(comments, 11)
+        self.assertEqual(fallback_cnt, len(comments) - 11)
+        self.assertEqual(allocate(comments, 11), expected)
+
+    def test_exact_entry(self):
+        # 宽度与显示时间使完全入镜时间为整数，后一条弹幕恰好在前者完全入镜时出现，重叠长度恰好为0
+        comments = [(0, 100), (50, 100), (99, 100), (100, 100)]
+        self.assertEqual(linear_allocate(comments, 3, 100, 100)[0], [0, 0, 1, 0])
+        self.assertEqual(allocate(comments, 3, 100, 100), [0, 0, 1, 0])
+
+    def test_epsilon(self):
+        # 与完全入镜时间相差不到epsilon的弹幕能通过线段树的剪枝，但仍需按原公式判断是否碰撞
+        epsilon = comechi.TrackAllocator.epsilon
+        for vpos_first in (0, 1.5e9):
+            for delta in (-epsilon * 0.9, -epsilon * 0.1, 0, epsilon * 0.1, epsilon * 0.9, -epsilon * 1.1):
+                comments = [(vpos_first, 100), (vpos_first + 50 + delta, 100)]
+                with self.subTest(vpos_first=vpos_first, delta=delta):
+                    self.assertEqual(allocate(comments, 2, 100, 100), linear_allocate(comments, 2, 100, 100)[0])
+
+    def test_epsilon_exit(self):
+        # 后一条弹幕恰好在前者出镜时到达画面左端，重叠长度为0，但由浮点运算得出的剪枝界限比它的出现时间略小
+        speed = (WIDTH + 600) / 1000
+        for vpos_first in (0, 0.5, 1.5):
+            comments = [(vpos_first, 600), (vpos_first + 1000 - WIDTH / speed, 600)]
+            with self.subTest(vpos_first=vpos_first):
+                self.assertEqual(linear_allocate(comments, 2, WIDTH, 1000)[0], [0, 0])
+                self.assertEqual(allocate(comments, 2, WIDTH, 1000), [0, 0])
+
+    def test_epsilon_random(self):
+        # 后一条弹幕出现在之前某条弹幕完全入镜的时刻附近，该时刻由与TrackAllocator相同的浮点运算得出
+        for seed in range(50):
+            rnd = random.Random(seed)
+            row_cnt = rnd.randint(1, 13)
+            comments = [(rnd.choice([0, 1.5e9]), rnd.randint(1, 40) * 34)]
+            for _ in range(500):
+                vpos, length = rnd.choice(comments[-row_cnt * 2:])
+                entry = vpos + length / ((WIDTH + length) / DISPLAYED_TIME)
+                offset = rnd.choice([0, 0, 1e-4, -1e-4, 2e-3, -2e-3])
+                comments.append((max(entry + offset, comments[-1][0]), rnd.randint(1, 40) * 34))
+            with self.subTest(seed=seed, row_cnt=row_cnt):
+                self.assertSameRows(allocate(comments, row_cnt), linear_allocate(comments, row_cnt)[0])
+
+
+def linear_overlapping(intervals, start, end):
+    """
+    :return: 与开区间(start, end)有重叠的区间的序号，依次检查每个区间
+    """
+    return [k for k, interval in enumerate(intervals) if min(interval) < end and max(interval) > start]
+
+
+def random_intervals(rnd, cnt):
+    """
+    :return: 端点为较小整数的区间，包含端点相接、长度为0以及两个端点顺序相反的区间
+    """
+    intervals = []
+    for _ in range(cnt):
+        start = rnd.randint(0, 100)
+        end = start + rnd.choice([0, 1, 5, 20, 60])
+        intervals.append((end, start) if rnd.random() < 0.2 else (start, end))
+    return intervals
+
+
+class IntervalIndexTest(unittest.TestCase):
+    def test_random(self):
+        for seed in range(200):
+            rnd = random.Random(seed)
+            intervals = random_intervals(rnd, rnd.randint(0, 40))
+            index = comechi.IntervalIndex(intervals)
+            with self.subTest(seed=seed):
+                for _ in range(50):
+                    start = rnd.randint(-10, 110)
+                    end = start + rnd.choice([0, 1, 5, 30])
+                    self.assertEqual(index.overlapping(start, end), linear_overlapping(intervals, start, end),
+                                     (start, end))
+
+    def test_endpoints(self):
+        # 只在端点相接时不算重叠
+        intervals = [(0, 10), (10, 20), (20, 30), (15, 15), (30, 20)]
+        index = comechi.IntervalIndex(intervals)
+        self.assertEqual(index.overlapping(10, 20), [1, 3])
+        self.assertEqual(index.overlapping(20, 30), [2, 4])
+        self.assertEqual(index.overlapping(9, 21), [0, 1, 2, 3, 4])
+        self.assertEqual(index.overlapping(30, 40), [])
+        self.assertEqual(comechi.IntervalIndex([]).overlapping(0, 10), [])
+
+    def test_official_conditions(self):
+        # 原先逐条检查运营评论时会被处理(分割或下移)的，都在返回结果中
+        for seed in range(200):
+            rnd = random.Random(seed)
+            intervals = sorted(random_intervals(rnd, rnd.randint(1, 20)), key=min)
+            intervals = [(min(interval), max(interval)) for interval in intervals]
+            index = comechi.IntervalIndex(intervals)
+            with self.subTest(seed=seed):
+                for _ in range(50):
+                    vpos_in = rnd.randint(-10, 110)
+                    vpos_out = vpos_in + rnd.choice([1, 5, 30])
+                    handled = [j for j, (official_in, official_out) in enumerate(intervals)
+                               if vpos_in < official_in < vpos_out or vpos_in < official_out < vpos_out
+                               or official_in <= vpos_in and vpos_out <= official_out]
+                    result = index.overlapping(vpos_in, vpos_out)
+                    self.assertEqual([j for j in result if j in handled], handled, (vpos_in, vpos_out))
+
+
+def write_ncv_log(path, rnd, cnt):
+    """
+    写出带有运营评论的NCV评论文件，普通评论集中在几段弹幕高峰中
+    """
+    chats = []
+    date = 1650000000
+    for i in range(cnt):
+        date += rnd.choice([0, 0, 0, 1, 2, 5])
+        if rnd.random() < 0.03:
+            chats.append(f'<chat thread="1" no="{i}" vpos="0" date="{date}" date_usec="0" premium="3">'
+                         f'お知らせ{i}</chat>')
+        else:
+            message = 'w' * rnd.randint(1, 40)
+            chats.append(f'<chat thread="1" no="{i}" vpos="0" date="{date}" date_usec="{rnd.randint(0, 999999)}" '
+                         f'user_id="u{i}">{message}</chat>')
+    with open(path, 'w', encoding='utf-8') as f_xml:
+        f_xml.write('<?xml version="1.0" encoding="utf-8"?>\n<NiconamaCommentViewer>'
+                    '<LiveInfo><LiveTitle>layout</LiveTitle><OpenTime>1650000000</OpenTime></LiveInfo>'
+                    f'<Chats>{"".join(chats)}</Chats></NiconamaCommentViewer>')
+
+
+@unittest.skipUnless(comechi.HAS_NUMPY, '需要numpy')
+class NormalColumnsTest(unittest.TestCase):
+    def test_columns(self):
+        # 向量运算的结果与TrackAllocator逐条计算的结果逐位一致，评论的出现时间都是整数
+        rnd = random.Random(0)
+        comments = [comechi.CommentRecord(round(vpos), 'w' * (length // 34)) for vpos, length in
+                    random_comments(rnd, 2000, 34, vpos=rnd.randint(0, 10 ** 9))]
+        columns = comechi.NormalColumns(comments, 34, WIDTH, DISPLAYED_TIME)
+        track_allocator = comechi.TrackAllocator(11, WIDTH, DISPLAYED_TIME)
+
+        text_length = [len(c.message) * 34 for c in comments]
+        speed = [track_allocator.speed_of(length) for length in text_length]
+        self.assertEqual(columns.text_length.tolist(), text_length)
+        self.assertEqual(columns.speed.tolist(), speed)
+        self.assertEqual(columns.entry.tolist(),
+                         [c.vpos + length / v for c, length, v in zip(comments, text_length, speed)])
+        self.assertEqual(columns.vpos_out.tolist(), [c.vpos + DISPLAYED_TIME for c in comments])
+
+    def test_overlaps(self):
+        for seed in range(100):
+            rnd = random.Random(seed)
+            comments = [comechi.CommentRecord(rnd.randint(-10, 110), 'w') for _ in range(200)]
+            comments.sort(key=lambda c: c.vpos)
+            columns = comechi.NormalColumns(comments, 34, WIDTH, rnd.choice([1, 5, 30]))
+            intervals = random_intervals(rnd, rnd.randint(1, 20))
+            with self.subTest(seed=seed):
+                self.assertEqual(columns.overlaps(intervals).tolist(),
+                                 [bool(linear_overlapping(intervals, vpos_in, vpos_out)) for vpos_in, vpos_out in
+                                  zip(columns.vpos.tolist(), columns.vpos_out.tolist())])
+
+    def test_layout(self):
+        # 按列计算与逐条计算生成的弹幕完全相同
+        with tempfile.TemporaryDirectory() as tmp:
+            for seed in range(5):
+                path = os.path.join(tmp, f'{seed}.xml')
+                write_ncv_log(path, random.Random(seed), 3000)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    timeline = comechi.ingest(path, 'n', comechi.RenderOptions(cache_dir=None))
+                config = comechi.RenderConfig.create(max_row_cnt=(8, 11, 20)[seed % 3])
+
+                outputs = []
+                for columnar in (True, False):
+                    cmt = comechi.Comment.from_timeline(timeline, config)
+                    cmt.columnar = columnar
+                    cmt.layout()
+                    f_ass = io.StringIO()
+                    cmt.write_ass(f_ass)
+                    outputs.append(f_ass.getvalue())
+                with self.subTest(seed=seed):
+                    self.assertTrue(cmt.d_official)
+                    self.assertEqual(outputs[0].splitlines(), outputs[1].splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
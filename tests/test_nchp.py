@@ -0,0 +1,249 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_server import StubServer
+import comechi
+
+
+def make_chats(cnt, per_second=1):
+    """
+    :param per_second: 同一时刻的评论数
+    :return: 从新到旧排列的评论
+    """
+    chats = []
+    for i in range(cnt):
+        second = i // per_second
+        chats.append({'id': f'c{i}', 'created_at': f'2022-05-01T10:{second // 60:02d}:{second % 60:02d}.000Z',
+                      'nickname': f'user{i % 7}', 'message': f'comment {i}'})
+    return chats[::-1]
+
+
+class NchpApi:
+    """
+    ニコニコチャンネルプラス接口的stub
+    """
+
+    def __init__(self, chats, number_of_comments=None, cursor=True, fail_history=0):
+        """
+        :param chats: 从新到旧排列的评论
+        :param number_of_comments: video_pages中的评论总数，默认为len(chats)
+        :param cursor: 是否支持older_than分段，为False时忽略older_than，总是返回最新的评论
+        :param fail_history: 获取评论的前n次请求返回503
+        """
+        self.chats = chats
+        self.number_of_comments = len(chats) if number_of_comments is None else number_of_comments
+        self.cursor = cursor
+        self.fail_history = fail_history
+        self.live_finished_at = '2022-05-01 12:00:00'
+
+    def video_pages(self):
+        return {'data': {'video_page': {
+            'title': 'テスト/生放送', 'live_started_at': '2022-05-01 10:00:00',
+            'live_finished_at': self.live_finished_at,
+            'video_comment_setting': {'comment_group_id': 'g1'},
+            'video_aggregate_info': {'number_of_comments': self.number_of_comments},
+            'video_questionnaires': []}}}
+
+    def route(self, method, path, query, body):
+        if path == '/fc/video_pages/sm1/comments_user_token':
+            return 200, {'data': {'access_token': 'token'}}
+        if path == '/fc/video_pages/sm1':
+            return 200, self.video_pages()
+        if path == '/messages.history':
+            if body != {'token': 'token', 'group_id': 'g1'}:
+                return 403, {}
+            if self.fail_history:
+                self.fail_history -= 1
+                return 503, {}
+            chats = self.chats
+            if self.cursor and 'older_than' in query:
+                chats = [c for c in chats if c['created_at'] < query['older_than'][0]]
+            return 200, chats[:int(query['limit'][0])]
+        if path == '/groups.operator-broadcasts.list':
+            return 200, [{'created_at': '2022-05-01T10:00:30.000Z', 'type': 'announcement', 'message': 'お知らせ'}]
+        return 404, {}
+
+
+class NchpStubTestCase(unittest.TestCase):
+    def start(self, api):
+        """
+        启动stub并令comechi的接口地址指向它
+        """
+        stub = StubServer(api.route).__enter__()
+        self.addCleanup(stub.__exit__, None, None, None)
+        for name, url in (('NCHP_API', f'{stub.url}/fc'), ('SHEETA_API', stub.url)):
+            patcher = mock.patch.object(comechi, name, url)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return stub
+
+    @staticmethod
+    def history_requests(stub):
+        return [query for method, path, query in stub.requests if path == '/messages.history']
+
+
+class FetchNchpTest(NchpStubTestCase):
+    def fetch(self, chunk_size):
+        return asyncio.run(comechi.fetch_nchp('sm1', {}, chunk_size=chunk_size))
+
+    def test_cursor(self):
+        api = NchpApi(make_chats(35))
+        stub = self.start(api)
+
+        video_pages, comments, operator_broadcasts_list = self.fetch(10)
+
+        self.assertEqual([c['id'] for c in comments], [c['id'] for c in api.chats])
+        self.assertEqual(len(operator_broadcasts_list), 1)
+        # 10 + 10 + 10 + 5，最后一次没有新评论
+        self.assertEqual(len(self.history_requests(stub)), 5)
+        self.assertNotIn('older_than', self.history_requests(stub)[0])
+
+    def test_cursor_same_timestamp(self):
+        # 每3条评论同一时刻，每段的边界都落在同一时刻的评论之间
+        api = NchpApi(make_chats(35, per_second=3))
+        self.start(api)
+
+        video_pages, comments, operator_broadcasts_list = self.fetch(10)
+
+        self.assertEqual(sorted(c['id'] for c in comments), sorted(c['id'] for c in api.chats))
+        self.assertEqual(len(comments), 35)
+
+    def test_cursor_timestamp_longer_than_chunk(self):
+        # 同一时刻的评论多于一段时跳过该时刻剩余的评论，不会停止获取更早的评论
+        api = NchpApi(make_chats(30, per_second=12))
+        self.start(api)
+
+        video_pages, comments, operator_broadcasts_list = self.fetch(10)
+
+        ids = {c['id'] for c in comments}
+        self.assertTrue({f'c{i}' for i in range(14, 30)} <= ids)
+        self.assertIn('c2', ids)
+
+    def test_cursor_with_deleted_comments(self):
+        # 评论总数包含已删除的评论，能获取到的评论比总数少时不应再全部重新获取一次
+        api = NchpApi(make_chats(35), number_of_comments=50)
+        stub = self.start(api)
+
+        video_pages, comments, operator_broadcasts_list = self.fetch(10)
+
+        self.assertEqual(len(comments), 35)
+        self.assertEqual(len(self.history_requests(stub)), 5)
+        self.assertTrue(all(query['limit'] == ['10'] for query in self.history_requests(stub)))
+
+    def test_no_cursor(self):
+        api = NchpApi(make_chats(35), cursor=False)
+        stub = self.start(api)
+
+        video_pages, comments, operator_broadcasts_list = self.fetch(10)
+
+        self.assertEqual(len({c['id'] for c in comments}), 35)
+        # 第一段、确认接口不支持分段的第二段、一次获取全部评论
+        limits = [query['limit'][0] for query in self.history_requests(stub)]
+        self.assertEqual(limits, ['10', '10', '535'])
+
+    def test_no_cursor_first_chunk_complete(self):
+        api = NchpApi(make_chats(5), cursor=False)
+        stub = self.start(api)
+
+        video_pages, comments, operator_broadcasts_list = self.fetch(10)
+
+        self.assertEqual(len(comments), 5)
+        self.assertEqual(len(self.history_requests(stub)), 2)
+
+    def test_retry(self):
+        api = NchpApi(make_chats(5), fail_history=1)
+        stub = self.start(api)
+
+        video_pages, comments, operator_broadcasts_list = self.fetch(10)
+
+        self.assertEqual(len(comments), 5)
+        self.assertEqual(len(self.history_requests(stub)), 3)
+
+    def test_single_retry_layer(self):
+        # 持续的服务器错误只由request_json重试，Session本身不再重试
+        api = NchpApi(make_chats(5), fail_history=100)
+        stub = self.start(api)
+
+        async def request():
+            with comechi.create_session({}, retry=False) as session:
+                return await comechi.request_json(session, 'post', f'{stub.url}/messages.history?limit=10',
+                                                  max_attempts=2, json={'token': 'token', 'group_id': 'g1'})
+
+        with self.assertRaises(Exception):
+            asyncio.run(request())
+        self.assertEqual(len(self.history_requests(stub)), 2)
+
+
+class NchpTimeTest(unittest.TestCase):
+    def test_time_after(self):
+        self.assertEqual(comechi.nchp_time_after('2022-05-01T10:00:01.300Z'), '2022-05-01T10:00:01.301Z')
+        self.assertEqual(comechi.nchp_time_after('2022-05-01T10:00:01.999999Z'), '2022-05-01T10:00:02.000000Z')
+        self.assertEqual(comechi.nchp_time_after('2022-05-01T23:59:59Z'), '2022-05-02T00:00:00Z')
+
+
+class PollNchpTest(NchpStubTestCase):
+    def test_poll(self):
+        api = NchpApi(make_chats(20), fail_history=1)
+        stub = self.start(api)
+        adapter = comechi.NchpAdapter('https://nicochannel.jp/foo/live/sm1')
+        batches = adapter.poll(0)
+
+        normal, official = next(batches)
+        self.assertEqual(adapter.title, 'テスト_生放送')
+        self.assertEqual([c.message for c in normal], [f'comment {i}' for i in range(20)])
+        self.assertEqual([c.vpos for c in normal], [i * 100 for i in range(20)])
+
+        # 之后的轮询只返回新评论
+        api.chats = make_chats(25)
+        normal, official = next(batches)
+        self.assertEqual([c.message for c in normal], [f'comment {i}' for i in range(20, 25)])
+        batches.close()
+
+        self.assertTrue(all(query['limit'] == ['500'] for query in self.history_requests(stub)))
+
+    def test_poll_pages(self):
+        # 一次轮询之间的新评论多于一段时，分段获取到上一次已获取的评论为止
+        api = NchpApi(make_chats(25, per_second=2))
+        self.start(api)
+        batches = comechi.NchpAdapter('https://nicochannel.jp/foo/live/sm1').poll(0, limit=10)
+
+        normal, official = next(batches)
+        # 同一时刻的评论顺序不定
+        self.assertEqual(sorted(c.message for c in normal), sorted(f'comment {i}' for i in range(25)))
+        self.assertEqual([c.message for c in official], ['お知らせ'])
+
+        api.chats = make_chats(48, per_second=2)
+        normal, official = next(batches)
+        self.assertEqual(sorted(c.message for c in normal), sorted(f'comment {i}' for i in range(25, 48)))
+        # 每次轮询都会重新获取运营的通知，已处理过的不再返回
+        self.assertEqual(official, [])
+        batches.close()
+
+
+class NchpCacheTest(NchpStubTestCase):
+    def download(self, api):
+        self.start(api)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        cache = comechi.RawCommentCache(tmp_dir.name, 3600)
+        comechi.NchpAdapter('https://nicochannel.jp/foo/live/sm1', cache=cache).download()
+        return os.path.exists(cache.path('nchp', 'sm1'))
+
+    def test_finished(self):
+        self.assertTrue(self.download(NchpApi(make_chats(5))))
+
+    def test_live(self):
+        # 直播中的评论不完整，不应写入缓存
+        api = NchpApi(make_chats(5))
+        api.live_finished_at = None
+        self.assertFalse(self.download(api))
+
+
+if __name__ == '__main__':
+    unittest.main()
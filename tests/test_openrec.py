@@ -0,0 +1,178 @@
+import io
+import os
+import sys
+import datetime
+import contextlib
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_server import StubServer
+import comechi
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+CREATED_AT = datetime.datetime(2022, 5, 1, 19, 0, 0, tzinfo=JST)
+
+
+def make_chats(cnt, step=20):
+    """
+    :return: 从直播创建时间开始每step秒一条的评论
+    """
+    return [{'id': i, 'posted_at': (CREATED_AT + datetime.timedelta(seconds=i * step)).isoformat(),
+             'message': f'comment {i}', 'user': {'nickname': f'user{i % 7}', 'is_official': i % 30 == 0}}
+            for i in range(cnt)]
+
+
+class OpenrecApi:
+    """
+    Openrec接口的stub，每页最多返回page_size条评论
+    """
+
+    def __init__(self, chats, ended=True, page_size=10):
+        """
+        :param chats: 按时间排序的评论
+        :param ended: 直播是否已经结束
+        """
+        self.chats = chats
+        self.ended = ended
+        self.page_size = page_size
+        self.fail_from = set()  # 以这些时间为起点的请求返回404，模拟下载中断
+        self.visible = None  # 模拟直播中，只返回前visible条评论，全部可见之前直播不会结束
+
+    def page(self):
+        ended = self.ended and (self.visible is None or self.visible >= len(self.chats))
+        return {'title': 'Openrec: テスト', 'created_at': CREATED_AT.isoformat(), 'started_at': CREATED_AT.isoformat(),
+                'ended_at': (CREATED_AT + datetime.timedelta(minutes=30)).isoformat() if ended else None}
+
+    def route(self, method, path, query, body):
+        if path == '/movies/abc':
+            return 200, self.page()
+        if path == '/movies/abc/chats':
+            time_from = query['from_created_at'][0]
+            if time_from in self.fail_from:
+                return 404, {}
+            time_from = datetime.datetime.strptime(time_from, '%Y-%m-%dT%H:%M:%S.000Z').replace(
+                tzinfo=datetime.timezone.utc)
+            chats = [c for c in self.chats[:self.visible] if datetime.datetime.fromisoformat(c['posted_at']) >= time_from]
+            return 200, chats[:self.page_size]
+        return 404, {}
+
+
+def utc(minutes, seconds=0):
+    """
+    :return: 直播创建时间之后的时刻，格式与获取评论时的from_created_at相同
+    """
+    time = CREATED_AT + datetime.timedelta(minutes=minutes, seconds=seconds)
+    return time.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class OpenrecStubTestCase(unittest.TestCase):
+    def setUp(self):
+        # 断点记录写在当前目录
+        cwd = os.getcwd()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        os.chdir(tmp_dir.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def start(self, api):
+        stub = StubServer(api.route).__enter__()
+        self.addCleanup(stub.__exit__, None, None, None)
+        patcher = mock.patch.object(comechi, 'OPENREC_API', stub.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return stub
+
+    @staticmethod
+    def chat_requests(stub):
+        return [query['from_created_at'][0] for method, path, query in stub.requests if path == '/movies/abc/chats']
+
+
+class OpenrecDownloadTest(OpenrecStubTestCase):
+    def test_download(self):
+        api = OpenrecApi(make_chats(90))
+        self.start(api)
+
+        comments = comechi.OpenrecAdapter('https://www.openrec.tv/live/abc').download()
+
+        self.assertEqual([c['id'] for c in comments], list(range(90)))
+        self.assertEqual([c['vpos'] for c in comments], [i * 2000 for i in range(90)])
+        self.assertFalse(os.path.exists('openrec abc checkpoint.jsonl'))
+
+    def test_resume(self):
+        # 直播30分钟，分为3个时间段，每段30条评论，每页10条
+        api = OpenrecApi(make_chats(90))
+        stub = self.start(api)
+        # 第二个时间段的第一页之后中断
+        api.fail_from.add(utc(13))
+
+        with self.assertRaises(requests.HTTPError):
+            comechi.OpenrecAdapter('https://www.openrec.tv/live/abc').download()
+        self.assertTrue(os.path.exists('openrec abc checkpoint.jsonl'))
+        requests_before = len(self.chat_requests(stub))
+
+        api.fail_from.clear()
+        comments = comechi.OpenrecAdapter('https://www.openrec.tv/live/abc').download()
+
+        self.assertEqual([c['id'] for c in comments], list(range(90)))
+        # 已完成的时间段不再获取，中断的时间段从断点继续
+        resumed = self.chat_requests(stub)[requests_before:]
+        self.assertEqual(resumed[0], utc(13))
+        self.assertNotIn(utc(0), resumed)
+        self.assertNotIn(utc(10), resumed)
+        self.assertNotIn(utc(20), resumed)
+        self.assertFalse(os.path.exists('openrec abc checkpoint.jsonl'))
+
+
+class OpenrecCacheTest(OpenrecStubTestCase):
+    def download(self, api):
+        self.start(api)
+        cache = comechi.RawCommentCache('cache', 3600)
+        comechi.OpenrecAdapter('https://www.openrec.tv/live/abc', cache=cache).download()
+        return os.path.exists(cache.path('openrec', 'abc'))
+
+    def test_ended(self):
+        self.assertTrue(self.download(OpenrecApi(make_chats(30))))
+
+    def test_live(self):
+        # 直播中的评论不完整，不应写入缓存
+        self.assertFalse(self.download(OpenrecApi(make_chats(30), ended=False)))
+
+
+class LiveTest(OpenrecStubTestCase):
+    def test_live_matches_render(self):
+        # 30分钟内每3秒一条评论，每40条中有两条相隔9秒的运营评论，前一条会被后一条提前结束
+        chats = make_chats(600, step=3)
+        for c in chats:
+            c['message'] = ' '.join(['comment'] * (c['id'] % 5 + 1)) + str(c['id'])
+            c['user']['is_official'] = c['id'] % 40 in (0, 3)
+        api = OpenrecApi(chats)
+        self.start(api)
+        source = 'https://www.openrec.tv/live/abc'
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            cmt = comechi.render(source, 'o', options=comechi.RenderOptions(cache_dir=None))
+        expected = io.StringIO()
+        cmt.write_ass(expected)
+
+        # 每次轮询之间新增50条评论
+        def sleep(interval):
+            api.visible = min(api.visible + 50, len(chats))
+
+        api.visible = 0
+        with mock.patch.object(comechi.time, 'sleep', sleep), contextlib.redirect_stdout(io.StringIO()):
+            cmt_live, path = comechi.render_live(source, 'o', interval=0)
+        with open(path, 'r', encoding='utf_8_sig') as f_ass:
+            got = f_ass.read()
+
+        self.assertEqual(len(cmt_live.d_official), 30)
+        # 实时模式按弹幕确定的顺序写出，行的顺序不同
+        self.assertEqual(sorted(got.splitlines()), sorted(expected.getvalue().splitlines()))
+
+
+if __name__ == '__main__':
+    unittest.main()
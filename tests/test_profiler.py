@@ -0,0 +1,28 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comechi
+
+
+@unittest.skipIf(comechi.resource is None, '无法获取峰值内存')
+class StageProfilerTest(unittest.TestCase):
+    def test_peak_growth(self):
+        # 累计峰值在最耗内存的阶段之后保持不变，峰值增长只计入实际推高峰值的阶段
+        profiler = comechi.StageProfiler()
+        with profiler.stage('allocate'):
+            data = b'x' * (256 * 1024 * 1024)
+            del data
+        with profiler.stage('after'):
+            pass
+
+        allocate, after = profiler.stages
+        self.assertGreater(allocate['peak_rss_growth_mb'], 200)
+        self.assertEqual(after['peak_rss_growth_mb'], 0)
+        self.assertEqual(after['peak_rss_mb'], allocate['peak_rss_mb'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import io
+import os
+import sys
+import contextlib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comechi
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'render')
+
+# 各平台的评论文件、对齐评论时间的依据以及预期的ass文件
+# 预期的ass文件由引入PlatformAdapter之前的comechi.py生成(只修正了运营评论结束时间的判断)，使用默认的style.json
+RENDER_CASES = {
+    'n': ('ncv.xml', {}, 'n.ass'),
+    'y': ('yt.json', {}, 'y.ass'),
+    'z': ('zaiko.txt', {'anchor_index': 5, 'offset': '0:10:00.00'}, 'z.ass'),
+    'a': ('asobi.jsonl', {'anchor_time': '2022-05-01 10:00:20.000000000', 'offset': '0:00:30.00'}, 'a.ass'),
+}
+
+
+class PlatformAdaptersTest(unittest.TestCase):
+    def test_all_platforms(self):
+        self.assertEqual(sorted(comechi.PLATFORM_ADAPTERS), sorted(comechi.PLATFORMS.values()))
+        for platform, adapter in comechi.PLATFORM_ADAPTERS.items():
+            self.assertTrue(issubclass(adapter, comechi.PlatformAdapter))
+            self.assertEqual(adapter.platform, platform)
+
+
+class RenderFixtureTest(unittest.TestCase):
+    def test_render(self):
+        for platform, (source, anchor, expected) in RENDER_CASES.items():
+            with self.subTest(platform=platform):
+                options = comechi.RenderOptions(cache_dir=None, **anchor)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    cmt = comechi.render(os.path.join(DATA_DIR, source), platform, options=options)
+                got = io.StringIO()
+                cmt.write_ass(got)
+
+                with open(os.path.join(DATA_DIR, expected), 'r', encoding='utf_8_sig') as f_ass:
+                    self.assertEqual(got.getvalue().splitlines(), f_ass.read().splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import copy
+import pickle
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comechi
+
+
+class RenderConfigTest(unittest.TestCase):
+    def test_style_read_only(self):
+        config = comechi.RenderConfig.create(max_row_cnt=15)
+        with self.assertRaises(TypeError):
+            config.style['font_size'] = 1
+        with self.assertRaises(TypeError):
+            config.style['official']['font_size'] = 1
+
+    def test_input_not_shared(self):
+        style = comechi.thaw_style(comechi.RenderConfig.create().style)
+        config = comechi.RenderConfig(style, style['video_width'], style['video_height'])
+        style['official']['font_size'] = 1
+        self.assertNotEqual(config.style['official']['font_size'], 1)
+
+    def test_copy(self):
+        config = comechi.RenderConfig.create(max_row_cnt=15, resolution=(1280, 720))
+        for copied in (pickle.loads(pickle.dumps(config)), copy.deepcopy(config)):
+            self.assertEqual(copied, config)
+            with self.assertRaises(TypeError):
+                copied.style['font_size'] = 1
+
+    def test_create_from_config(self):
+        base = comechi.RenderConfig.create(max_row_cnt=15)
+        config = comechi.RenderConfig.create(base.style, resolution=(1280, 720))
+        self.assertEqual((config.width, config.height, config.style['row_cnt_base']), (1280, 720, 15))
+        self.assertEqual(base.style['video_width'], 1920)
+
+
+if __name__ == '__main__':
+    unittest.main()